@@ -0,0 +1,160 @@
+"""
+End-to-end benchmark for process_data_to_d2_with_missing_fields_handling
+
+Generates synthetic D1 dumps (see d1_generator.py) and loads each one in a fresh Python
+process, so peak memory is measured per size. Reports throughput, peak RSS, SQL statement
+counts and per-phase times from the loader's metrics summary.
+
+Each size is loaded into a fresh temporary SQLite file unless --db-url names another
+database (SQLite or PostgreSQL); that one should be a scratch database, since every run adds
+its rows there and --bulk-load drops and rebuilds its indexes. The engine configured in
+db.d2_models is never used. Without the db package (as in this repository) the test
+stand-in for db.d2_models is loaded instead. Use --use-copy to load PostgreSQL through COPY.
+
+Usage:
+    python benchmarks/bench_d2_pipeline.py [--sizes 10000 100000 1000000] [--batch-size 10000]
+        [--db-url postgresql+psycopg2://...] [--db-workers 1] [--preprocess-workers 1] [--use-copy]
+        [--bulk-load] [--output results.jsonl]
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import types
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from d1_generator import write_jsonl  # noqa: E402
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def bind_database(db_url):
+    """
+    Point db.d2_models and d2_operations at the database at db_url, as tests/conftest.py does
+
+    Returns:
+        module: d2_operations, bound to the new engine
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    try:
+        from db import d2_models
+    except ImportError:
+        sys.path.insert(0, os.path.join(REPO_DIR, 'tests'))
+        import d2_models_standin as d2_models
+        db_package = types.ModuleType('db')
+        db_package.__path__ = []
+        db_package.d2_models = d2_models
+        sys.modules['db'] = db_package
+        sys.modules['db.d2_models'] = d2_models
+
+    if hasattr(d2_models, 'use_database'):
+        d2_models.use_database(db_url)
+    else:
+        d2_models.engine = create_engine(db_url)
+        d2_models.Session = sessionmaker(bind=d2_models.engine)
+
+    import d2_operations
+    # d2_operations imported these names from db.d2_models at import time
+    d2_operations.engine = d2_models.engine
+    d2_operations.Session = d2_models.Session
+    d2_operations.table_registry.invalidate()
+    return d2_operations
+
+
+def run_load(dump_path, db_url, options):
+    """Load one dump into the database at db_url in this process and return the loader's result dict"""
+    logging.disable(logging.WARNING)  # Per-item repair messages would dominate the timings
+    d2_operations = bind_database(db_url)
+
+    result = d2_operations.process_data_to_d2_with_missing_fields_handling(dump_path, **options)
+    result['dialect'] = f"{d2_operations.engine.dialect.name}+{d2_operations.engine.dialect.driver}"
+    return result
+
+
+def load_in_subprocess(dump_path, db_url, options):
+    """Run run_load in a fresh interpreter so peak RSS covers this load only"""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--load', dump_path, '--db-url', db_url,
+         '--options', json.dumps(options)],
+        capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Load of {dump_path} failed:\n{completed.stderr[-4000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _format_row(size, result):
+    metrics = result['metrics']
+    phases = metrics['phases']
+    return (f"{size:>9,} {metrics['seconds']:>9.1f} {metrics['items_per_sec'] or 0:>10,.0f} "
+            f"{(metrics['peak_rss_kb'] or 0) / 1024:>9.0f} {metrics['statements']:>10,} "
+            f"{phases.get('preprocess', 0):>8.1f} {phases.get('phase1', 0):>8.1f} "
+            f"{phases.get('phase2', 0):>8.1f} {phases.get('deferred_references', 0):>8.1f} "
+            f"{result['total_skipped']:>8,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='Dump sizes (items)')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--write-chunk-size', type=int, default=500)
+    parser.add_argument('--db-url', help='SQLAlchemy URL of a scratch D2 database shared by all sizes; '
+                                         'defaults to a fresh temporary SQLite file per size')
+    parser.add_argument('--preprocess-workers', type=int, default=1)
+    parser.add_argument('--db-workers', type=int, default=1)
+    parser.add_argument('--use-copy', action='store_true', help='Load through COPY (PostgreSQL only)')
+    parser.add_argument('--bulk-load', action='store_true', help='Relaxed durability and deferred index builds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dump-dir', help='Directory for the generated dumps (kept and reused); '
+                                           'defaults to a temporary directory')
+    parser.add_argument('--output', help='Append one JSON line of results per size to this file')
+    parser.add_argument('--load', help=argparse.SUPPRESS)     # Internal: load one dump and print the result
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        print(json.dumps(run_load(args.load, args.db_url, json.loads(args.options)), default=str))
+        return 0
+
+    options = {
+        'batch_size': args.batch_size,
+        'write_chunk_size': args.write_chunk_size,
+        'preprocess_workers': args.preprocess_workers,
+        'db_workers': args.db_workers,
+        'use_copy': args.use_copy,
+        'bulk_load': args.bulk_load,
+    }
+
+    with tempfile.TemporaryDirectory(prefix='d2-bench-') as temp_dir:
+        dump_dir = args.dump_dir or temp_dir
+        os.makedirs(dump_dir, exist_ok=True)
+
+        print(f"{'items':>9} {'seconds':>9} {'items/sec':>10} {'RSS MiB':>9} {'statements':>10} "
+              f"{'preproc':>8} {'phase1':>8} {'phase2':>8} {'deferred':>8} {'skipped':>8}")
+        for size in args.sizes:
+            dump_path = os.path.join(dump_dir, f"d1_{size}_{args.seed}.jsonl")
+            if not os.path.exists(dump_path):
+                write_jsonl(dump_path, size, seed=args.seed)
+
+            db_url = args.db_url or f"sqlite:///{os.path.join(temp_dir, f'd2_{size}.db')}"
+            result = load_in_subprocess(dump_path, db_url, options)
+            print(_format_row(size, result), flush=True)
+
+            if args.output:
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'size': size, 'options': options, **result}, default=str) + "\n")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Micro-benchmark for find_references
+
+Times the reference extractor in d2_operations on payloads shaped like real D1 objects
+(an http_loadbalancer with its pools, routes and policies), since it runs once per object
+and dominates CPU time in pre-processing.
+
+Usage:
+    python benchmarks/bench_find_references.py [--objects 2000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d2_operations import find_references  # noqa: E402
+
+
+def _ref(rng, kind, tenant, with_uid=False):
+    ref = {
+        'kind': rng.choice([kind, f"ves.io.schema.{kind}.Object"]),
+        'name': f"{kind.replace('_', '-')}-{rng.randint(0, 50)}",
+        'namespace': f"ns-{rng.randint(0, 9)}",
+        'tenant': tenant,
+    }
+    if with_uid:
+        ref['uid'] = f"{rng.getrandbits(64):016x}"
+    return ref
+
+
+def make_payload(rng, index):
+    """Build a D1 value shaped like an http_loadbalancer object with its references"""
+    tenant = f"tenant-{rng.randint(0, 3)}"
+    namespace = f"ns-{rng.randint(0, 9)}"
+    uid = f"{rng.getrandbits(128):032x}"
+    return {
+        'metadata': {
+            'name': f"lb-{index}",
+            'namespace': namespace,
+            'uid': uid,
+            'labels': {'app': f"app-{index % 17}", 'tier': 'edge'},
+            'annotations': {'owner': 'platform'},
+            'description': 'load balancer',
+        },
+        'system_metadata': {
+            'uid': uid,
+            'tenant': tenant,
+            'creation_timestamp': {'seconds': 1600000000 + index, 'nanos': 0},
+            'modification_timestamp': {'seconds': 1700000000 + index, 'nanos': 0},
+            'creator_class': 'prism',
+            'namespace': [{'kind': 'namespace', 'name': namespace, 'uid': f"ns-uid-{namespace}", 'tenant': tenant}],
+            'owner_view': None,
+            'labels': {},
+        },
+        'spec': {
+            'gc_spec': {
+                'domains': [f"app{index}.example.com", f"www.app{index}.example.com"],
+                'advertise_policies': [_ref(rng, 'advertise_policy', tenant, with_uid=True)],
+                'default_route_pools': [
+                    {'pool': _ref(rng, 'origin_pool', tenant), 'weight': 1, 'priority': 1}
+                    for _ in range(rng.randint(1, 3))
+                ],
+                'routes': [
+                    {
+                        'simple_route': {
+                            'path': {'prefix': f"/api/v{v}"},
+                            'origin_pools': [{'pool': _ref(rng, 'origin_pool', tenant), 'weight': 1}],
+                            'headers': [{'name': 'x-version', 'exact': str(v)}],
+                        }
+                    }
+                    for v in range(rng.randint(0, 6))
+                ],
+                'app_firewall': _ref(rng, 'app_firewall', tenant),
+                'active_service_policies': {
+                    'policies': [_ref(rng, 'service_policy', tenant) for _ in range(rng.randint(0, 4))]
+                },
+                'healthcheck': [_ref(rng, 'healthcheck', tenant)],
+                'virtual_host': [_ref(rng, 'virtual_host', tenant, with_uid=True)],
+                'tls_parameters': {'tls_config': {'default_security': {}}, 'no_mtls': {}},
+            }
+        },
+        'status': [{'conditions': [{'type': 'Ready', 'status': 'True'}]}],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=2000, help='Number of payloads per run')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs (best is reported)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = [make_payload(rng, i) for i in range(args.objects)]
+
+    references = sum(len(find_references(payload, 'akar')) for payload in payloads)
+    timer = timeit.Timer(lambda: [find_references(payload, 'akar') for payload in payloads])
+    best = min(timer.repeat(repeat=args.repeat, number=1))
+    print(f"find_references: {best * 1000:8.1f} ms for {args.objects} objects "
+          f"({args.objects / best:,.0f} objects/sec, {references / args.objects:.1f} references/object)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
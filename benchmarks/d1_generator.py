@@ -0,0 +1,258 @@
+"""
+Synthetic D1 dump generator
+
+Produces items shaped like the D1 export read by process_data_to_d2_with_missing_fields_handling:
+{'key': '/<service>/db/ves.io.schema.<kind>.Object.default/primary/<uid>', 'value': {...}, 'size': ...}
+
+The dump contains namespace objects, objects of several kinds spread over several services
+with references to other objects (by name/namespace, some with a uid, some pointing at
+objects that only appear later in the dump), plus the irregular items the loader has to
+repair or skip: missing namespaces, missing names, StatusObjects without a name and values
+that aren't objects. Output is deterministic for a given seed and streamed, so dumps larger
+than memory can be written.
+
+Usage:
+    python benchmarks/d1_generator.py --items 100000 --output d1_100k.jsonl [--seed 42]
+"""
+import argparse
+import json
+import random
+import sys
+import uuid
+
+DEFAULT_KINDS = {
+    # kind -> relative frequency
+    'http_loadbalancer': 4,
+    'origin_pool': 6,
+    'healthcheck': 4,
+    'route': 5,
+    'virtual_host': 3,
+    'app_firewall': 2,
+    'service_policy': 3,
+    'advertise_policy': 1,
+}
+
+# Kinds each kind refers to
+DEFAULT_REFERENCE_KINDS = {
+    'http_loadbalancer': ('origin_pool', 'app_firewall', 'service_policy', 'healthcheck', 'advertise_policy'),
+    'origin_pool': ('healthcheck',),
+    'route': ('origin_pool', 'virtual_host'),
+    'virtual_host': ('advertise_policy', 'service_policy'),
+    'app_firewall': (),
+    'healthcheck': (),
+    'service_policy': (),
+    'advertise_policy': (),
+}
+
+DEFAULT_SERVICES = ('akar', 'ares', 'maurice', 'vulpix')
+
+
+class D1Generator:
+    """
+    Deterministic stream of synthetic D1 items
+
+    Object j of a kind is named '<kind>-<j>' and placed in a service, namespace and tenant
+    derived from j, so a reference can name any object of the dump without the generator
+    keeping the dump in memory.
+
+    Args:
+        items: Number of non-namespace items to generate
+        seed: Random seed
+        namespaces: Number of namespace objects
+        tenants: Number of tenants the namespaces are spread over
+        services: Service names
+        kinds: Kind -> relative frequency
+        max_references: Maximum references per object
+        uid_reference_rate: Fraction of references that carry the target's uid
+        dangling_reference_rate: Fraction of references to objects that don't exist
+        missing_namespace_rate: Fraction of objects without metadata.namespace
+        missing_name_rate: Fraction of objects without metadata.name
+        status_object_rate: Fraction of items that are StatusObjects without a name
+        invalid_rate: Fraction of items whose value isn't an object
+        padding_fields: Extra spec fields per object, to tune the item size
+    """
+
+    def __init__(self, items, seed=42, namespaces=20, tenants=4, services=DEFAULT_SERVICES,
+                 kinds=None, max_references=6, uid_reference_rate=0.2, dangling_reference_rate=0.02,
+                 missing_namespace_rate=0.05, missing_name_rate=0.01, status_object_rate=0.02,
+                 invalid_rate=0.005, padding_fields=8):
+        self.items = items
+        self.seed = seed
+        self.namespaces = [f"ns-{i}" for i in range(max(1, namespaces))]
+        self.tenants = [f"tenant-{i}" for i in range(max(1, tenants))]
+        self.services = list(services)
+        self.kinds = dict(kinds or DEFAULT_KINDS)
+        self.max_references = max_references
+        self.uid_reference_rate = uid_reference_rate
+        self.dangling_reference_rate = dangling_reference_rate
+        self.missing_namespace_rate = missing_namespace_rate
+        self.missing_name_rate = missing_name_rate
+        self.status_object_rate = status_object_rate
+        self.invalid_rate = invalid_rate
+        self.padding_fields = padding_fields
+
+        # Expected number of objects per kind, used to pick reference targets
+        total_weight = sum(self.kinds.values())
+        self._kind_names = list(self.kinds)
+        self._kind_weights = [self.kinds[kind] / total_weight for kind in self._kind_names]
+        self._expected = {kind: max(1, int(items * weight)) for kind, weight in zip(self._kind_names, self._kind_weights)}
+
+    def _uid(self, *parts):
+        """Stable uid for an object, so references can carry it"""
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(part) for part in (self.seed, *parts))))
+
+    def _placement(self, kind, index):
+        """(service, namespace, tenant) of object index of kind"""
+        service = self.services[index % len(self.services)]
+        namespace_index = (index // len(self.services) + len(kind)) % len(self.namespaces)
+        return service, self.namespaces[namespace_index], self._tenant_of(namespace_index)
+
+    def _tenant_of(self, namespace_index):
+        return self.tenants[namespace_index % len(self.tenants)]
+
+    def _reference(self, rng, ref_kind, service):
+        """Reference to an object of ref_kind in the same service (lookups are per service)"""
+        services = len(self.services)
+        slots = max(1, self._expected[ref_kind] // services)
+        index = rng.randrange(slots) * services + self.services.index(service)
+        _, namespace, tenant = self._placement(ref_kind, index)
+        if rng.random() < self.dangling_reference_rate:
+            index += self._expected[ref_kind] * services  # Never generated
+        ref = {
+            'kind': rng.choice((ref_kind, f"ves.io.schema.{ref_kind}.Object")),
+            'name': f"{ref_kind.replace('_', '-')}-{index}",
+            'namespace': namespace,
+            'tenant': tenant,
+        }
+        if rng.random() < self.uid_reference_rate:
+            ref['uid'] = self._uid(ref_kind, index)
+        return ref
+
+    def _namespace_item(self, namespace_index):
+        name = self.namespaces[namespace_index]
+        uid = self._uid('namespace', name)
+        return {
+            'key': f"/{self.services[0]}/db/ves.io.schema.namespace.Object.default/primary/{uid}",
+            'value': {
+                'metadata': {'name': name, 'uid': uid},
+                'system_metadata': {
+                    'uid': uid,
+                    'tenant': self._tenant_of(namespace_index),
+                    'creation_timestamp': {'seconds': 1600000000 + namespace_index, 'nanos': 0},
+                    'modification_timestamp': {'seconds': 1650000000 + namespace_index, 'nanos': 0},
+                },
+            },
+            'size': 256,
+        }
+
+    def _object_item(self, rng, kind, index, sequence):
+        service, namespace, tenant = self._placement(kind, index)
+        uid = self._uid(kind, index)
+        key = f"/{service}/db/ves.io.schema.{kind}.Object.default/primary/{uid}"
+        namespace_ref = {'kind': 'namespace', 'name': namespace, 'uid': self._uid('namespace', namespace), 'tenant': tenant}
+
+        ref_kinds = DEFAULT_REFERENCE_KINDS.get(kind) or tuple(self._kind_names)
+        references = [self._reference(rng, rng.choice(ref_kinds), service)
+                      for _ in range(rng.randint(0, self.max_references))]
+
+        metadata = {
+            'name': f"{kind.replace('_', '-')}-{index}",
+            'namespace': namespace,
+            'uid': uid,
+            'labels': {'app': f"app-{index % 31}", 'tier': rng.choice(('edge', 'core', 'internal'))},
+            'annotations': {'owner': 'platform'},
+            'description': f"{kind} {index}",
+        }
+        system_metadata = {
+            'uid': uid,
+            'tenant': tenant,
+            'creation_timestamp': {'seconds': 1600000000 + sequence, 'nanos': 0},
+            'modification_timestamp': {'seconds': 1650000000 + sequence, 'nanos': rng.randrange(10 ** 9)},
+            'creator_class': 'prism',
+            'namespace': [namespace_ref],
+        }
+        spec = {
+            'references': references,
+            'primary': references[0] if references else None,
+            'routes': [{'match': {'prefix': f"/api/v{v}"}, 'targets': references[v:v + 2]}
+                       for v in range(min(len(references), 3))],
+        }
+        for field in range(self.padding_fields):
+            spec[f"option_{field}"] = {'enabled': field % 2 == 0, 'value': f"{kind}-{index}-{field}"}
+        value = {'metadata': metadata, 'system_metadata': system_metadata, 'spec': {'gc_spec': spec}}
+
+        roll = rng.random()
+        if roll < self.invalid_rate:
+            value = "<unparseable>"
+        elif roll < self.invalid_rate + self.status_object_rate:
+            # StatusObjects carry no name and get one derived from their uid
+            value['kind'] = 'ves.io.schema.views.StatusObject'
+            del metadata['name']
+        elif roll < self.invalid_rate + self.status_object_rate + self.missing_name_rate:
+            del metadata['name']
+        elif roll < (self.invalid_rate + self.status_object_rate + self.missing_name_rate
+                     + self.missing_namespace_rate):
+            # Repaired from system_metadata.namespace
+            del metadata['namespace']
+
+        return {'key': key, 'value': value, 'size': 600 + 40 * (len(references) + self.padding_fields)}
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        counters = dict.fromkeys(self._kind_names, 0)
+        # Namespaces are spread over the first part of the dump, not all up front
+        namespace_positions = {
+            position: namespace_index for namespace_index, position in
+            enumerate(sorted(rng.sample(range(max(self.items // 10, len(self.namespaces))), len(self.namespaces))))
+        }
+        for sequence in range(max(self.items, max(namespace_positions) + 1)):
+            if sequence in namespace_positions:
+                yield self._namespace_item(namespace_positions[sequence])
+            if sequence >= self.items:
+                continue
+            kind = rng.choices(self._kind_names, self._kind_weights)[0]
+            index = counters[kind]
+            counters[kind] += 1
+            yield self._object_item(rng, kind, index, sequence)
+
+
+def generate_items(items, **options):
+    """Iterate over a synthetic D1 dump (see D1Generator for the options)"""
+    return iter(D1Generator(items, **options))
+
+
+def write_jsonl(path, items, **options):
+    """
+    Write a synthetic D1 dump as JSON lines
+
+    Returns:
+        int: Number of items written
+    """
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in generate_items(items, **options):
+            f.write(json.dumps(item, separators=(',', ':')) + "\n")
+            written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='Number of non-namespace items')
+    parser.add_argument('--output', required=True, help='JSON-lines file to write')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--namespaces', type=int, default=20)
+    parser.add_argument('--tenants', type=int, default=4)
+    parser.add_argument('--max-references', type=int, default=6)
+    parser.add_argument('--padding-fields', type=int, default=8, help='Extra spec fields per object')
+    args = parser.parse_args()
+
+    written = write_jsonl(args.output, args.items, seed=args.seed, namespaces=args.namespaces,
+                          tenants=args.tenants, max_references=args.max_references,
+                          padding_fields=args.padding_fields)
+    print(f"Wrote {written} items to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,141 +1,245 @@
+import hashlib
+import io
 import json
 import logging
+import logging.handlers
+import os
+import re
+import queue
+import sys
+import tempfile
+import threading
+import time
 import uuid  # Add this import for generating UIDs
-from collections import Counter # Import Counter for error summary
-from sqlalchemy import select, insert, update, Table, MetaData, text, PrimaryKeyConstraint, inspect # Added inspect
+from collections import Counter, OrderedDict, deque # Import Counter for error summary
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager, nullcontext
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain, islice
+from typing import Callable, NamedTuple, Optional
+from sqlalchemy import select, insert, update, delete, Table, MetaData, text, PrimaryKeyConstraint, inspect, bindparam, tuple_, and_, or_, Index, Column, String, BigInteger, DateTime, func # Added inspect
+from sqlalchemy import event
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+from sqlalchemy.types import ARRAY, JSON
+try:
+    import resource  # Peak RSS; not available on Windows
+except ImportError:
+    resource = None
 from db.d2_models import engine, Session, get_or_create_table, get_all_tables, find_table_by_kind_service, D2SkippedData, init_d2_db # Added init_d2_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bound on distinct kinds / key segments memoised by the key and kind parsers
+PARSER_CACHE_SIZE = 4096
 
-def find_references(data_obj, parent_service=None):
+# Nesting depth below which find_references stops searching a value for references
+MAX_REFERENCE_DEPTH = 200
+
+# Number of D1 items pre-processed and written per batch
+DEFAULT_BATCH_SIZE = 10000  # Adjust this value based on your system's memory capacity
+
+# Number of rows written per transaction by the bulk write paths
+DEFAULT_WRITE_CHUNK_SIZE = 500
+
+# Error details kept in memory before older entries are dropped or spilled to disk
+DEFAULT_ERROR_STORE_SIZE = 10000
+
+# Number of (name, namespace[, tenant]) keys per reference UID lookup query
+DEFAULT_LOOKUP_CHUNK_SIZE = 500
+
+# Number of (kind, service, name, namespace, tenant) entries kept by the reference resolution cache
+DEFAULT_REFERENCE_CACHE_SIZE = 100000
+
+# Unresolved references kept in memory before the deferred queue spills to disk, and the
+# number of queued references resolved together by the final pass
+DEFAULT_DEFERRED_MEMORY_SIZE = 50000
+DEFAULT_DEFERRED_RESOLVE_CHUNK = 20000
+
+# Format version of the checkpoint file written by resumable runs
+CHECKPOINT_VERSION = 4
+
+# Buffered D2SkippedData rows are flushed when either limit is reached
+DEFAULT_SKIPPED_FLUSH_ROWS = 1000
+DEFAULT_SKIPPED_FLUSH_SECONDS = 30.0
+
+
+def _make_reference(item, parent_service, path):
+    """Build a reference dict for an object with a 'kind' field, or None if it is incomplete"""
+    # Store both original and normalized kind
+    original_kind = item.get('kind')
+    normalized_kind = normalize_kind(original_kind)
+
+    ref = {
+        'kind': normalized_kind,  # Store normalized kind as the primary kind
+        'original_kind': original_kind,  # Store original kind for reference
+        'name': item.get('name'),
+        'namespace': item.get('namespace'),
+        'uid': item.get('uid'),
+        'tenant': item.get('tenant'),  # Capture tenant information
+        'service': item.get('service', parent_service),  # Use parent's service as default
+        'path': path
+    }
+    if ref['kind'] and (ref['uid'] or (ref['name'] and ref['namespace'])):
+        return ref
+    return None
+
+
+def _make_namespace_reference(item, parent_service, path):
+    """Build a reference for an entry of system_metadata.namespace, or None if it is incomplete"""
+    ref = {
+        'kind': 'namespace',
+        'original_kind': 'namespace',  # Original and normalized are the same here
+        'name': item.get('name'),
+        'namespace': 'system',  # Default namespace for namespaces
+        'uid': item.get('uid'),
+        'tenant': item.get('tenant'),  # Capture tenant information
+        'service': item.get('service', parent_service),  # Use parent's service as default
+        'path': path
+    }
+    if ref['uid'] or ref['name']:
+        return ref
+    return None
+
+
+def find_references(data_obj, parent_service=None, max_depth=MAX_REFERENCE_DEPTH):
     """
     Find all objects with a 'kind' field in the data object
     Returns a list of references with their kind, name, namespace, tenant, and uid
     
+    A reference that is found again (for example a list entry seen both from its parent
+    and on its own) is only returned the first time, with the path it was first found at.
+    Nesting deeper than max_depth levels is not searched, so malformed input can't run
+    into the interpreter's recursion limit.
+    
     Args:
         data_obj: The object to extract references from
         parent_service: The service of the parent object (used for context)
+        max_depth: Maximum nesting depth searched
         
     Returns:
         List of reference objects
     """
     references = []
-    
-    def _extract_refs(obj, path=""):
+    seen = set()
+    too_deep = []  # Paths where the search stopped at max_depth
+
+    def _emit(ref):
+        if ref is None:
+            return
+        identity = (ref['kind'], ref['original_kind'], ref['name'], ref['namespace'],
+                    ref['uid'], ref['tenant'], ref['service'])
+        try:
+            if identity in seen:
+                return
+            seen.add(identity)
+        except TypeError:
+            # Unhashable field values (malformed data) are kept without de-duplication
+            pass
+        references.append(ref)
+
+    def _extract_refs(obj, path="", depth=0):
+        if depth > max_depth:
+            too_deep.append(path)
+            return
+
         if isinstance(obj, dict):
             # Check if this is a reference (has 'kind' field)
-            if 'kind' in obj and isinstance(obj.get('kind'), str):
-                # Store both original and normalized kind
-                original_kind = obj.get('kind')
-                normalized_kind = normalize_kind(original_kind)
-                
-                # Extract service from the reference if available
-                ref_service = obj.get('service', parent_service)
-                
-                ref = {
-                    'kind': normalized_kind,  # Store normalized kind as the primary kind
-                    'original_kind': original_kind,  # Store original kind for reference
-                    'name': obj.get('name'),
-                    'namespace': obj.get('namespace'),
-                    'uid': obj.get('uid'),
-                    'tenant': obj.get('tenant'),  # Capture tenant information
-                    'service': ref_service,  # Use parent's service as default
-                    'path': path
-                }
-                if ref['kind'] and (ref['uid'] or (ref['name'] and ref['namespace'])):
-                    references.append(ref)
-            
+            if isinstance(obj.get('kind'), str):
+                _emit(_make_reference(obj, parent_service, path))
+
             # Also look for reference arrays like "any_name": [{"kind": "endpoint", ...}]
             for key, value in obj.items():
                 if isinstance(value, list):
                     for item in value:
-                        if isinstance(item, dict) and 'kind' in item and isinstance(item.get('kind'), str):
-                            # Store both original and normalized kind
-                            original_kind = item.get('kind')
-                            normalized_kind = normalize_kind(original_kind)
-                            
-                            # Extract service or use parent's
-                            ref_service = item.get('service', parent_service)
-                            
-                            ref = {
-                                'kind': normalized_kind,  # Store normalized kind as the primary kind
-                                'original_kind': original_kind,  # Store original kind for reference
-                                'name': item.get('name'),
-                                'namespace': item.get('namespace'),
-                                'uid': item.get('uid'),
-                                'tenant': item.get('tenant'),  # Capture tenant information
-                                'service': ref_service,  # Use parent's service as default
-                                'path': f"{path}.{key}" if path else key
-                            }
-                            if ref['kind'] and (ref['uid'] or (ref['name'] and ref['namespace'])):
-                                references.append(ref)
-            
-            # Special handling for namespace data - FIXED VERSION
-            # This now handles both direct "system_metadata.namespace" and array indices like "system_metadata.namespace[0]"
-            if (path == "system_metadata.namespace" or 
-                path.startswith("system_metadata.namespace[") or
-                (path == "system_metadata" and "namespace" in obj and isinstance(obj["namespace"], list))):
-                
-                # If we're at the system_metadata level and it contains namespace array
-                if path == "system_metadata" and "namespace" in obj and isinstance(obj["namespace"], list):
-                    namespace_items = obj["namespace"]
-                # Otherwise if we're already at the namespace array or item
-                elif isinstance(obj, list):
-                    namespace_items = obj
-                else:
-                    namespace_items = [obj]
-                
-                # Process all namespace items
+                        if isinstance(item, dict) and isinstance(item.get('kind'), str):
+                            _emit(_make_reference(item, parent_service, f"{path}.{key}" if path else key))
+
+            # Special handling for namespace data: both "system_metadata.namespace" and its
+            # array entries like "system_metadata.namespace[0]"
+            if (path == "system_metadata.namespace" or
+                    path.startswith("system_metadata.namespace[") or
+                    (path == "system_metadata" and isinstance(obj.get('namespace'), list))):
+                # At the system_metadata level the namespace array holds the items
+                namespace_items = obj['namespace'] if path == "system_metadata" else [obj]
+                namespace_path = path if path.startswith("system_metadata.namespace") else "system_metadata.namespace"
                 for item in namespace_items:
                     if isinstance(item, dict) and item.get('kind') == 'namespace':
-                        # Extract service or use parent's
-                        ref_service = item.get('service', parent_service)
-                        
-                        ref = {
-                            'kind': 'namespace',
-                            'original_kind': 'namespace',  # Original and normalized are the same here
-                            'name': item.get('name'),
-                            'namespace': 'system',  # Default namespace for namespaces
-                            'uid': item.get('uid'),
-                            'tenant': item.get('tenant'),  # Capture tenant information
-                            'service': ref_service,  # Use parent's service as default
-                            'path': path if path.startswith("system_metadata.namespace") else "system_metadata.namespace"
-                        }
-                        if ref['uid'] or ref['name']:
-                            references.append(ref)
-            
-            # Recursively search nested dictionaries
+                        _emit(_make_namespace_reference(item, parent_service, namespace_path))
+
+            # Recursively search nested containers; scalars hold no references
             for key, value in obj.items():
-                new_path = f"{path}.{key}" if path else key
-                _extract_refs(value, new_path)
-        
+                if isinstance(value, (dict, list)):
+                    _extract_refs(value, f"{path}.{key}" if path else key, depth + 1)
+
         elif isinstance(obj, list):
             # Recursively search list items
             for i, item in enumerate(obj):
-                new_path = f"{path}[{i}]"
-                _extract_refs(item, new_path)
-    
+                if isinstance(item, (dict, list)):
+                    _extract_refs(item, f"{path}[{i}]", depth + 1)
+
     _extract_refs(data_obj)
+    if too_deep:
+        logger.warning(f"Nesting deeper than {max_depth} levels not searched for references "
+                       f"({len(too_deep)} subtrees, first at '{too_deep[0][:200]}')")
     return references
 
 
+def reference_kinds(data_obj):
+    """
+    Normalized kinds of the references find_references would return for data_obj, without
+    building the references themselves (used by schema planning)
+
+    Namespace entries under system_metadata.namespace are not treated specially: every
+    non-namespace object gets a namespace reference column anyway.
+
+    Args:
+        data_obj: The object's value dict
+
+    Returns:
+        set: Normalized reference kinds
+    """
+    kinds = set()
+    stack = [data_obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            kind = obj.get('kind')
+            if isinstance(kind, str) and (obj.get('uid') or (obj.get('name') and obj.get('namespace'))):
+                normalized = normalize_kind(kind)
+                if normalized:
+                    kinds.add(normalized)
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            stack.extend(obj)
+    return kinds
+
+
 def extract_kind_from_key(key):
     """Extract kind from object key path"""
     # Example key: /akar/db/ves.io.schema.advertise_policy.Object.default/primary/uid
     if not key or not isinstance(key, str):
         return None
     
-    parts = key.split('/')
+    # Only the first four segments matter, so don't split the rest of the key
+    parts = key.split('/', 4)
     if len(parts) < 4:
         return None
     
+    # Extract schema part; the same few hundred schema segments repeat across all keys
+    schema_part = parts[3]  # ves.io.schema.advertise_policy.Object.default
+    kind = _kind_from_schema_segment(schema_part)
+    if kind and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Extracted kind '%s' from key: %s", kind, key)
+    return kind
+
+
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def _kind_from_schema_segment(schema_part):
+    """Extract the kind from a schema segment such as 'ves.io.schema.advertise_policy.Object.default'"""
     try:
-        # Extract schema part
-        schema_part = parts[3]  # ves.io.schema.advertise_policy.Object.default
-        
         # Split schema into components
         schema_components = schema_part.split('.')
         
@@ -143,23 +247,20 @@ def extract_kind_from_key(key):
         for i, comp in enumerate(schema_components):
             if comp == "Object" and i > 0:
                 # Return the component before "Object"
-                kind = schema_components[i-1]
-                logger.debug(f"Extracted kind '{kind}' from key: {key}")
-                return kind
+                return schema_components[i-1]
                 
         # If we didn't find "Object", try another approach - use the last component
         if len(schema_components) > 1:
             potential_kind = schema_components[-2]  # Try second-to-last component
             if potential_kind and potential_kind != "default" and potential_kind != "schema":
-                logger.debug(f"Extracted fallback kind '{potential_kind}' from key: {key}")
+                logger.debug("Extracted fallback kind '%s' from schema segment: %s", potential_kind, schema_part)
                 return potential_kind
     except Exception as e:
-        logger.error(f"Error extracting kind from key '{key}': {e}")
+        logger.error("Error extracting kind from schema segment '%s': %s", schema_part, e)
     
     return None
 
 
-
 def extract_service_from_key(key):
     """
     Extract service from object key path
@@ -178,993 +279,3628 @@ def extract_service_from_key(key):
     if not key or not isinstance(key, str):
         return None
     
-    # Split the key into path segments
-    parts = key.split('/')
-    
-    # The service should be in the first non-empty segment
-    # Usually at index 1 in the path /service/db/...
-    for part in parts:
-        if part and part != "":
-            return part
+    # The service is the first non-empty segment, usually at index 1 in the path /service/db/...
+    service = key.lstrip('/').partition('/')[0]
+    if not service:
+        return None
     
-    return None
+    # Share one string per service across all records instead of one copy per key
+    return _intern_key_segment(service)
+
+
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def _intern_key_segment(segment):
+    """Return a shared instance of a key segment (service names repeat across millions of keys)"""
+    return segment
 
 
 def normalize_kind(kind):
     """Enhanced normalization with better debugging"""
-    original = kind
-    
     if not kind or not isinstance(kind, str):
-        logger.warning(f"normalize_kind received invalid input: {kind}")
+        logger.warning("normalize_kind received invalid input: %s", kind)
         return kind
         
     # Check if this is already a simple kind
     if '.' not in kind:
         return kind
     
+    return _normalize_dotted_kind(kind)
+
+
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def _normalize_dotted_kind(kind):
+    """Normalize a dotted kind such as 'ves.io.schema.endpoint.Object'; results are memoised"""
     # Special case for known problematic kinds
     if "service_policy_set" in kind:
-        logger.info(f"Found service_policy_set in {kind}, normalizing")
+        logger.debug("Found service_policy_set in %s, normalizing", kind)
         return "service_policy_set"
         
     # Handle schema path pattern like "ves.io.schema.endpoint.Object"
     parts = kind.split('.')
     
     # Debug the parts
-    logger.debug(f"Kind parts: {parts}")
+    logger.debug("Kind parts: %s", parts)
     
     # Look for the schema type before "Object"
     for i, part in enumerate(parts):
         if part == "Object" and i > 0:
             # Return the component before "Object"
             result = parts[i-1]
-            logger.debug(f"Normalized {original} -> {result} (before Object)")
+            logger.debug("Normalized %s -> %s (before Object)", kind, result)
             return result
     
     # If we don't find "Object" in the schema path, try to extract
     # the last meaningful component that's not "schema" or "default"
     for part in reversed(parts):
         if part and part not in ["Object", "schema", "default", "io", "ves"]:
-            logger.debug(f"Normalized {original} -> {part} (fallback)")
+            logger.debug("Normalized %s -> %s (fallback)", kind, part)
             return part
             
     # If all else fails, return the original
-    logger.warning(f"Failed to normalize {original}, returning as is")
+    logger.warning("Failed to normalize %s, returning as is", kind)
     return kind
 
 
-def process_data_to_d2_with_missing_fields_handling(raw_data_list):
+def parser_cache_info():
     """
-    Enhanced process to transform data from D1 to D2 with special handling for records
-    with missing namespace or name/UID fields, optimized with batch processing for memory efficiency
+    Report hit/miss counters of the memoised key and kind parsers
+
+    Returns:
+        dict: Parser name -> {'hits', 'misses', 'size', 'maxsize'}
     """
-    import gc  # Import garbage collector for explicit memory management
-    
-    # Ensure the D2 database and necessary tables (like d2_skipped_data) are initialized
-    try:
-        init_d2_db() 
-        # Verify d2_skipped_data table exists after init
-        inspector = inspect(engine)
-        if not inspector.has_table(D2SkippedData.__tablename__):
-             logger.error(f"Table '{D2SkippedData.__tablename__}' still does not exist after init_d2_db().")
-             # Optionally raise an error or handle appropriately
-             # raise RuntimeError(f"Failed to create required table: {D2SkippedData.__tablename__}")
-        else:
-             logger.info(f"Table '{D2SkippedData.__tablename__}' confirmed to exist.")
-             
-    except Exception as e:
-        logger.error(f"Failed to initialize D2 database: {e}")
-        # Decide if you want to proceed without the skipped table or stop
-        # return # Example: Stop processing if DB init fails
+    caches = {
+        'normalize_kind': _normalize_dotted_kind,
+        'extract_kind_from_key': _kind_from_schema_segment,
+        'extract_service_from_key': _intern_key_segment,
+    }
+    info = {}
+    for name, cached in caches.items():
+        stats = cached.cache_info()
+        info[name] = {
+            'hits': stats.hits,
+            'misses': stats.misses,
+            'size': stats.currsize,
+            'maxsize': stats.maxsize,
+        }
+    return info
 
-    if not raw_data_list:
-        logger.warning("No data provided to process_data_to_d2")
+
+def clear_parser_caches():
+    """Empty the memoised key and kind parsers (and reset their counters)"""
+    _normalize_dotted_kind.cache_clear()
+    _kind_from_schema_segment.cache_clear()
+    _intern_key_segment.cache_clear()
+
+
+def iter_raw_data(source, skip=0, positions=False):
+    """
+    Yield D1 items one at a time from an in-memory sequence, any iterable, or a JSON-lines file
+
+    Input records are the elements of a sequence/iterable, or the non-blank lines of a file
+    (an invalid JSON line is a record, but not an item).
+
+    Args:
+        source: List/iterable of item dicts, or a path to a file with one JSON item per line
+        skip: Number of leading records to pass over (when resuming); skipped file lines
+            are not parsed
+        positions: Yield (records read, item) pairs, where records read counts the records
+            consumed so far including skip; resuming with that as skip continues after the item
+
+    Yields:
+        dict: One D1 item (or a (records read, item) tuple)
+    """
+    records_read = skip
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                records_read += 1
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Skipping invalid JSON on line {line_number} of {source}: {e}")
+                    continue
+                yield (records_read, item) if positions else item
+    elif positions:
+        yield from enumerate(islice(source, skip, None), start=skip + 1)
+    else:
+        yield from islice(source, skip, None)
+
+
+def iter_batches(items, batch_size):
+    """
+    Group an iterable into lists of at most batch_size items without materialising the rest
+
+    Args:
+        items: Any iterable
+        batch_size: Maximum number of items per batch
+
+    Yields:
+        list: The next batch of items
+    """
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable while a background thread computes the next items ahead
+
+    At most depth items wait in a bounded queue (plus the one the thread is computing),
+    so the work done by iterable for item N+1 overlaps whatever the caller does with
+    item N. Exceptions raised by iterable are re-raised to the caller in order. Closing
+    the generator (or leaving it early) stops the thread once its current item is done.
+
+    Args:
+        iterable: Any iterable; it is only advanced from the background thread
+        depth: Maximum number of items computed ahead (0 or None iterates inline)
+
+    Yields:
+        The items of iterable, in order
+    """
+    if not depth or depth < 1:
+        yield from iterable
         return
-        
-    # Define batch size for processing
-    BATCH_SIZE = 10000  # Adjust this value based on your system's memory capacity
-    initial_total_items = len(raw_data_list) # Store initial count
-    total_batches = (initial_total_items + BATCH_SIZE - 1) // BATCH_SIZE  # Ceiling division
-    
-    logger.info(f"Processing {initial_total_items} objects from D1 to D2 with missing fields handling (in {total_batches} batches)")
-    
-    # Initialize global tracking data structures (preserved across batches)
-    namespace_cache = {}  # Cache for namespace UIDs by (name, tenant)
-    error_records = {}    # Will store detailed errors by key
-    
-    # Global counters for final reporting
-    total_processed_items = 0
-    total_skipped_items = 0 # Renamed from total_error_items for clarity
-    total_fixed_namespace_items = 0
-    total_fixed_name_uid_items = 0
-    skipped_by_error_type = Counter() # Use Counter for easy counting
 
-    # Helper function to save to D2SkippedData with required composite key fields
-    def save_to_d2_skipped_data(key, kind=None, service=None, name=None, uid=None, 
-                               namespace=None, tenant=None, error_type="unknown_error", 
-                               error_message="", size_bytes=0):
-        # Ensure we have valid values for the composite key fields
-        record_uid = uid if uid else f"generated-{str(uuid.uuid4())}"
-        record_service = service if service else "unknown"
-        record_object_type = kind if kind else "unknown"  # Using 'kind' as 'object_type'
-        
-        # Increment global skipped counter and error type counter
-        nonlocal total_skipped_items
-        total_skipped_items += 1
-        skipped_by_error_type[error_type] += 1
-        
-        skipped_session = Session()
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up once the consumer has gone, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
         try:
-            # Corrected: Removed name, namespace, tenant from the constructor call
-            skipped_data = D2SkippedData(
-                uid=record_uid,
-                service=record_service,
-                object_type=record_object_type,
-                key=key,
-                size_bytes=size_bytes, # Corrected variable name
-                error_type=error_type,
-                error_message=error_message[:1000] 
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    producer = threading.Thread(target=produce, name='d2-prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            has_item, payload = ready.get()
+            if not has_item:
+                if payload is not None:
+                    raise payload
+                return
+            yield payload
+    finally:
+        stop.set()
+        producer.join()
+
+
+class D2Object(NamedTuple):
+    """
+    Compact per-object record carried from pre-processing to the write phases
+
+    Only the fields Phase 1 and Phase 2 use are kept; the D1 value dict itself is
+    released once pre-processing of its batch is done.
+    """
+    key: str
+    uid: str
+    name: str
+    namespace: str
+    tenant: Optional[str]
+    service: Optional[str]
+    size: Optional[int]
+    original_kind: str
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    references: list
+    content_hash: Optional[str] = None  # Set in incremental mode (see content_hash_of)
+
+
+def timestamp_from_metadata(system_metadata, field):
+    """
+    Convert a {'seconds': ..., 'nanos': ...} timestamp in system_metadata to a UTC datetime
+
+    Args:
+        system_metadata: The object's system_metadata dict (may be empty)
+        field: Timestamp field name, e.g. 'creation_timestamp'
+
+    Returns:
+        datetime or None if the timestamp is missing or malformed
+    """
+    if not system_metadata or field not in system_metadata:
+        return None
+    ts = system_metadata[field]
+    if isinstance(ts, dict) and 'seconds' in ts:
+        # Convert to UTC datetime
+        return datetime.fromtimestamp(ts['seconds'], tz=timezone.utc)
+    return None
+
+
+def content_hash_of(value):
+    """
+    Stable SHA-256 of a D1 value, independent of key order
+
+    Args:
+        value: The object's value dict
+
+    Returns:
+        str: Hex digest
+    """
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def build_d2_row(obj):
+    """
+    Build the column values written to a kind table for one pre-processed object
+
+    Args:
+        obj: D2Object collected during pre-processing
+
+    Returns:
+        dict: Column name -> value for the insert/update
+    """
+    data = {
+        'uid': obj.uid,
+        'name': obj.name,
+        'namespace': obj.namespace,
+        'tenant': obj.tenant,
+        'service': obj.service or '',  # Ensure service is never NULL
+        'raw_key': obj.key,
+        'size_bytes': obj.size
+    }
+
+    # Timestamps are only written when system_metadata had them
+    if obj.created_at is not None:
+        data['created_at'] = obj.created_at
+    if obj.updated_at is not None:
+        data['updated_at'] = obj.updated_at
+
+    return data
+
+
+def _group_rows_by_columns(rows):
+    """Group row dicts by their column set, since one statement needs one parameter shape"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row.keys()), []).append(row)
+    return groups
+
+
+def _execute_upsert(session, table, rows, key_column='uid'):
+    """
+    Upsert rows keyed on uid (or key_column) using the dialect's native conflict handling.
+
+    PostgreSQL and SQLite use INSERT ... ON CONFLICT (uid) DO UPDATE, MySQL/MariaDB use
+    INSERT ... ON DUPLICATE KEY UPDATE. The rows are passed as executemany parameters so the
+    driver can pack them into multi-row statements within its parameter limits.
+    Other dialects fall back to one SELECT of the existing uids followed by an executemany
+    INSERT for new rows and an executemany UPDATE for existing ones.
+    key_column may also be a tuple of column names for a composite key.
+    """
+    dialect = session.get_bind().dialect.name
+    key_columns = (key_column,) if isinstance(key_column, str) else tuple(key_column)
+
+    for columns, shaped_rows in _group_rows_by_columns(rows).items():
+        update_columns = [col for col in columns if col not in key_columns]
+
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            stmt = dialect_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c[col] for col in key_columns],
+                set_={col: stmt.excluded[col] for col in update_columns}
             )
-            skipped_session.add(skipped_data)
-            skipped_session.commit()
-        except Exception as e:
-            skipped_session.rollback()
-            # Log the specific record details that failed
-            logger.error(f"Error saving skipped data record (uid={record_uid}, service={record_service}, object_type={record_object_type}): {e}")
-        finally:
-            skipped_session.close()
-    
-    # Process data in batches
-    for batch_num, batch_start in enumerate(range(0, initial_total_items, BATCH_SIZE)):
-        batch_end = min(batch_start + BATCH_SIZE, initial_total_items)
-        current_batch = raw_data_list[batch_start:batch_end]
-        
-        logger.info(f"Processing batch {batch_num+1}/{total_batches} (items {batch_start} to {batch_end-1})")
-        
-        # Per-batch data structures that will be cleared after each batch
-        objects_by_kind_service = {}  # Objects grouped by kind and service
-        kind_service_references = {}  # References by kind and service
-        
-        # Batch counters - These are useful for per-batch logging but totals are tracked globally
-        batch_processed_items_counter = 0 # Use a different name to avoid confusion with global
-        batch_skipped_items_counter = 0
-        batch_fixed_namespace_items_counter = 0
-        batch_fixed_name_uid_items_counter = 0
-        
-        # Pre-process pass: Extract all objects, get namespaces, normalize kinds, and collect references
-        logger.info(f"Batch {batch_num+1}: Initial pass - collecting objects, namespaces, and references...")
-        
-        for item_index, item in enumerate(current_batch):
-            # Global index for logging purposes
-            global_item_index = batch_start + item_index
-            
-            key = item.get('key', '')
-            value = item.get('value')
-            
-            # Handle size field consistently
-            size = item.get('size')  # Get size from the item
-            if not size:
-                size = item.get('size_bytes')
-            if not size:
-                size = item.get('size(Bytes)')
-            # Ensure size is an integer or None
-            try:
-                size = int(size) if size is not None else None
-            except (ValueError, TypeError):
-                logger.warning(f"Invalid size value '{size}' for item #{global_item_index}, setting to None: {key}")
-                size = None
-
-            # Skip items without proper value
-            if not isinstance(value, dict):
-                logger.warning(f"Skipping item #{global_item_index} with invalid value: {key}")
-                batch_skipped_items_counter += 1
-                error_records[key] = {
-                    "value": value,
-                    "error": "Invalid value (not a dictionary)",
-                    "item_index": global_item_index
+            session.execute(stmt, shaped_rows)
+
+        elif dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(table)
+            stmt = stmt.on_duplicate_key_update(
+                {col: stmt.inserted[col] for col in update_columns}
+            )
+            session.execute(stmt, shaped_rows)
+
+        else:
+            # Generic fallback: split into existing and new rows with a single lookup
+            keys = [tuple(row[col] for col in key_columns) for row in shaped_rows]
+            if len(key_columns) == 1:
+                key = table.c[key_columns[0]]
+                existing_keys = {
+                    (row[0],) for row in session.execute(select(key).where(key.in_([k[0] for k in keys])))
                 }
-                
-                # Extract object_type from item if available
-                object_type = item.get('object_type', 'unknown')
-                item_uid = item.get('uid', f"generated-{str(uuid.uuid4())}")
-                
-                # Use helper function to save to D2SkippedData
-                save_to_d2_skipped_data(
-                    key=key,
-                    uid=item_uid,
-                    kind=object_type,
-                    service=item.get('service', 'unknown'),
-                    error_type="invalid_value",
-                    error_message="Invalid value (not a dictionary)",
-                    size_bytes=size
-                )
-                
-                continue
-                
-            # Extract basic information
-            metadata = value.get('metadata', {})
-            system_metadata = value.get('system_metadata', {})
-            
-            # Extract service from item or key
-            service = item.get('service')
-            if not service:
-                service = extract_service_from_key(key)
-                if not service:
-                    logger.warning(f"Could not extract service for item #{global_item_index}: {key}")
-                    batch_skipped_items_counter += 1
-                    error_records[key] = {
-                        "value": value,
-                        "error": "Could not extract service",
-                        "item_index": global_item_index
-                    }
-                    
-                    # Use helper function to save to D2SkippedData
-                    save_to_d2_skipped_data(
-                        key=key,
-                        error_type="missing_service",
-                        error_message="Could not extract service",
-                        size_bytes=size
+            else:
+                key = tuple_(*(table.c[col] for col in key_columns))
+                existing_keys = {
+                    tuple(row) for row in session.execute(
+                        select(*(table.c[col] for col in key_columns)).where(key.in_(keys))
                     )
-                    
-                    continue
-            
-            # Try to get kind from multiple possible locations
-            original_kind = value.get('kind')
-            object_type = item.get('object_type')
-            if not original_kind and object_type:
-                original_kind = object_type
-            
-            if not original_kind:
-                # Try to find kind in metadata
-                original_kind = metadata.get('kind')
-                
-                # Try to extract from key if still not found
-                if not original_kind:
-                    original_kind = extract_kind_from_key(key)
-                    
-                    # If still not found but has system_metadata.owner_view.kind, use that
-                    if not original_kind and system_metadata and 'owner_view' in system_metadata:
-                        owner_view = system_metadata.get('owner_view', {})
-                        original_kind = owner_view.get('kind')
-            
-            # Skip if we can't determine the kind
-            if not original_kind:
-                logger.warning(f"Skipping item #{global_item_index} with unknown kind: {key}")
-                batch_skipped_items_counter += 1
-                error_records[key] = {
-                    "value": value,
-                    "error": "Could not determine kind",
-                    "item_index": global_item_index
-                }
-                
-                # Use helper function to save to D2SkippedData
-                save_to_d2_skipped_data(
-                    key=key,
-                    service=service,
-                    error_type="unknown_kind",
-                    error_message="Could not determine kind",
-                    size_bytes=size
-                )
-                
-                continue
-            
-            # Normalize the kind (once)
-            normalized_kind = normalize_kind(original_kind)
-            
-            name = metadata.get('name')
-            uid = metadata.get('uid')
-            namespace = metadata.get('namespace')
-            
-            # Extract tenant from system_metadata
-            tenant = None
-            if system_metadata:
-                tenant = system_metadata.get('tenant')
-
-            # Special handling for namespace objects - identify and cache them
-            is_namespace = normalized_kind == 'namespace' or object_type == 'namespace'
-            if is_namespace:
-                # Namespaces don't have a namespace field in their metadata
-                # Set a default namespace for them
-                if name and uid and not namespace:
-                    namespace = 'system'  # Default namespace for namespaces
-                    logger.debug(f"Setting default namespace 'system' for namespace object: {name}")
-                    
-                # Cache namespace UIDs for later use - keep this cache across batches
-                if name and uid:
-                    # For namespace objects, don't include service in the cache key
-                    cache_key = (name, tenant) if tenant else (name, None)
-                    namespace_cache[cache_key] = uid
-                    logger.debug(f"Cached namespace: {name}, tenant: {tenant}, UID: {uid} (shared across services)")
-                    
-                # For namespace objects, we'll use the common 'namespace' table
-                service = None
-            
-            # FIX 1: Handle missing name or UID
-            fixed_name_uid_this_item = False # Track fix for this item
-            if not (name and uid):
-                # Try to extract from system_metadata
-                if system_metadata and 'uid' in system_metadata:
-                    uid = system_metadata.get('uid')
-                    
-                # For StatusObjects or similar objects that may not have a name
-                if not name and normalized_kind.lower().endswith('statusobject'):
-                    if uid:
-                        # Use a derived name based on the UID for StatusObjects
-                        name = f"status-{uid[:8]}"
-                        logger.info(f"Generated name '{name}' for StatusObject with UID {uid}")
-                        fixed_name_uid_this_item = True
-                    else:
-                        # If we can extract a UID from the key path as last resort
-                        key_parts = key.split('/')
-                        if len(key_parts) > 0:
-                            potential_uid = key_parts[-1]
-                            if len(potential_uid) > 8:  # Simple validation for UID-like string
-                                uid = potential_uid
-                                name = f"derived-{potential_uid[:8]}"
-                                logger.info(f"Extracted UID '{uid}' and generated name '{name}' from key: {key}")
-                                fixed_name_uid_this_item = True
-            
-            # Increment global counter if fixed
-            if fixed_name_uid_this_item:
-                total_fixed_name_uid_items += 1
-                batch_fixed_name_uid_items_counter += 1
-
-            # Still missing name or UID after fix attempts?
-            if not (name and uid):
-                logger.warning(f"Still missing name or UID after fix attempts for item #{global_item_index}: {key}")
-                batch_skipped_items_counter += 1
-                error_records[key] = {
-                    "value": value,
-                    "error": "Still missing name or UID after fix attempts",
-                    "metadata": metadata,
-                    "system_metadata": system_metadata,
-                    "item_index": global_item_index
                 }
-                
-                # Use helper function to save to D2SkippedData
-                save_to_d2_skipped_data(
-                    key=key,
-                    kind=normalized_kind,
-                    service=service,
-                    name=name,
-                    uid=uid,
-                    tenant=tenant,
-                    error_type="missing_name_uid",
-                    error_message="Still missing name or UID after fix attempts",
-                    size_bytes=size
+
+            new_rows = [row for row, k in zip(shaped_rows, keys) if k not in existing_keys]
+            if new_rows:
+                session.execute(insert(table), new_rows)
+
+            existing_rows = [row for row, k in zip(shaped_rows, keys) if k in existing_keys]
+            if existing_rows and update_columns:
+                # bindparam names must not clash with the column names in the SET clause
+                stmt = (
+                    update(table)
+                    .where(and_(*(table.c[col] == bindparam(f"b_{col}") for col in key_columns)))
+                    .values({col: bindparam(f"b_{col}") for col in update_columns})
                 )
-                
-                continue
-            
-            # FIX 2: Handle missing namespace
-            fixed_namespace_this_item = False # Track fix for this item
-            if not namespace:
-                # Check system_metadata.namespace array
-                if system_metadata and 'namespace' in system_metadata:
-                    ns_data = system_metadata.get('namespace')
-                    if isinstance(ns_data, list) and len(ns_data) > 0 and isinstance(ns_data[0], dict):
-                        namespace = ns_data[0].get('name')
-                        logger.info(f"Extracted namespace '{namespace}' from system_metadata.namespace")
-                        fixed_namespace_this_item = True
-                
-                # If not found and this is a deployment or status object, try setting default namespace
-                if not namespace and ('deployment' in normalized_kind.lower() or 'status' in normalized_kind.lower()):
-                    namespace = 'system'
-                    logger.info(f"Setting default namespace 'system' for {normalized_kind}: {name}")
-                    fixed_namespace_this_item = True
-                    
-                # Try to extract from key path
-                if not namespace:
-                    # Check if path has namespace information (common patterns in the system)
-                    if 'namespace/' in key:
-                        path_parts = key.split('namespace/')
-                        if len(path_parts) > 1:
-                            potential_ns = path_parts[1].split('/')[0]
-                            if potential_ns:
-                                namespace = potential_ns
-                                logger.info(f"Extracted namespace '{namespace}' from key path: {key}")
-                                fixed_namespace_this_item = True
-                                
-                # Handle application objects with no namespace in metadata or system_metadata
-                if not namespace and 'application' in normalized_kind.lower():
-                    # For application objects, often they belong to "system" namespace by default
-                    namespace = 'system'
-                    logger.info(f"Setting default namespace 'system' for application object: {key}")
-                    fixed_namespace_this_item = True
-
-                # Extract namespace from the key if possible
-                if not namespace:
-                    # Try to find namespace in the key path using common patterns
-                    key_parts = key.split('/')
-                    
-                    # Pattern: .../namespace/NAME/...
-                    for i, part in enumerate(key_parts):
-                        if part == 'namespace' and i + 1 < len(key_parts):
-                            namespace = key_parts[i + 1]
-                            logger.info(f"Extracted namespace '{namespace}' from key path at position {i+1}")
-                            fixed_namespace_this_item = True
-                            break
-                    
-                    # Pattern: .../by-namespace/NAME/...
-                    if not namespace:
-                        for i, part in enumerate(key_parts):
-                            if part == 'by-namespace' and i + 1 < len(key_parts):
-                                namespace = key_parts[i + 1]
-                                logger.info(f"Extracted namespace '{namespace}' from key path at position {i+1}")
-                                fixed_namespace_this_item = True
-                                break
-                    
-                    # Maurice-specific pattern: Objects in maurice service often belong to system namespace
-                    if not namespace and 'maurice' in service.lower():
-                        namespace = 'system'
-                        logger.info(f"Setting default namespace 'system' for maurice service object: {key}")
-                        fixed_namespace_this_item = True
-
-                # For kubernetes-related objects, they're often in system namespace
-                if not namespace and isinstance(value, dict):
-                    # Check spec structure for kubernetes configuration without relying on object name
-                    has_kubernetes = False
-                    
-                    # Look through the object structure for kubernetes configurations
-                    if (isinstance(value.get('spec'), dict) and 
-                        isinstance(value.get('spec').get('app_spec'), dict) and
-                        isinstance(value.get('spec').get('app_spec').get('App'), dict)):
-                        
-                        app_spec = value.get('spec').get('app_spec').get('App', {})
-                        # Check if any key in app_spec is 'kubernetes'
-                        if 'kubernetes' in app_spec:
-                            has_kubernetes = True
+                session.execute(stmt, [{f"b_{col}": value for col, value in row.items()} for row in existing_rows])
+
+
+def _write_isolating_failures(write_chunk, rows, chunk_size, on_row_error=None):
+    """
+    Write rows in chunks, one transaction per chunk.
+
+    When a chunk fails it is rolled back and split in half, recursively, until the failing
+    rows are isolated. Each of those is passed to on_row_error(row, error); every other row
+    in the chunk is still written.
+
+    Args:
+        write_chunk: Callable (session, rows) that issues the statements for one chunk
+        rows: List of row dicts to write
+        chunk_size: Maximum number of rows committed per transaction
+        on_row_error: Optional callback for rows that could not be written
+
+    Returns:
+        int: Number of rows written successfully
+    """
+    written = 0
+    # Chunks are popped from the end, so push them in reverse to keep input order
+    pending = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    pending.reverse()
+
+    while pending:
+        chunk = pending.pop()
+        session = Session()
+        try:
+            write_chunk(session, chunk)
+            session.commit()
+            written += len(chunk)
+        except Exception as e:
+            session.rollback()
+            if len(chunk) == 1:
+                if on_row_error:
+                    on_row_error(chunk[0], e)
+                else:
+                    logger.error(f"Error writing row (uid={chunk[0].get('uid')}): {e}")
+            else:
+                # Bisect the chunk so only the bad rows are rejected
+                middle = len(chunk) // 2
+                logger.debug(f"Chunk of {len(chunk)} rows failed, bisecting: {e}")
+                pending.append(chunk[middle:])
+                pending.append(chunk[:middle])
+        finally:
+            session.close()
+
+    return written
+
+
+def _execute_reference_updates(session, table, rows):
+    """Set the ref_* columns of existing rows with one executemany UPDATE per column set"""
+    for columns, shaped_rows in _group_rows_by_columns(rows).items():
+        ref_columns = [col for col in columns if col != 'uid']
+        # bindparam names must not clash with the column names in the SET clause
+        stmt = (
+            update(table)
+            .where(table.c.uid == bindparam('b_uid'))
+            .values({col: bindparam(f"b_{col}") for col in ref_columns})
+        )
+        session.execute(stmt, [{f"b_{col}": value for col, value in row.items()} for row in shaped_rows])
+
+
+# DB-API drivers whose cursors can stream COPY FROM STDIN (psycopg2 and psycopg 3)
+_COPY_DRIVERS = ('psycopg2', 'psycopg')
+
+
+def copy_supported(bind=None):
+    """True if the engine (or given bind) is PostgreSQL on a driver the COPY loader supports"""
+    bind = bind if bind is not None else engine
+    return bind.dialect.name == 'postgresql' and bind.dialect.driver in _COPY_DRIVERS
+
+
+def _copy_text_escape(text_value):
+    """Escape a field for COPY's text format"""
+    return (text_value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _pg_array_literal(values):
+    """Render a list as a PostgreSQL array literal, e.g. ['a', None] -> {"a",NULL}"""
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+
+def _copy_field(value, column_type):
+    """Format one value for COPY's text format according to its column type"""
+    if value is None:
+        return '\\N'
+    if isinstance(column_type, ARRAY):
+        text_value = _pg_array_literal(value)
+    elif isinstance(column_type, JSON):
+        text_value = json.dumps(value, default=str)
+    elif isinstance(value, datetime):
+        text_value = value.isoformat()
+    elif isinstance(value, bool):
+        text_value = 't' if value else 'f'
+    else:
+        text_value = str(value)
+    return _copy_text_escape(text_value)
+
+
+def _copy_into_stage(session, table, columns, rows, stage_name):
+    """
+    Create a temporary table with the given columns of table (dropped at commit) and fill it
+    with COPY FROM STDIN from an in-memory buffer
+
+    Returns:
+        Table: The staging table
+    """
+    preparer = session.get_bind().dialect.identifier_preparer
+    quoted_columns = ', '.join(preparer.quote(col) for col in columns)
+    session.execute(text(
+        f"CREATE TEMPORARY TABLE {preparer.quote(stage_name)} ON COMMIT DROP AS "
+        f"SELECT {quoted_columns} FROM {preparer.format_table(table)} WITH NO DATA"
+    ))
+
+    column_types = [table.c[col].type for col in columns]
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_field(row[col], column_type)
+                               for col, column_type in zip(columns, column_types)))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    copy_sql = f"COPY {preparer.quote(stage_name)} ({quoted_columns}) FROM STDIN"
+    # The session's own connection, so the COPY is part of the chunk's transaction
+    cursor = session.connection().connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(copy_sql, buffer)  # psycopg2
+        else:
+            with cursor.copy(copy_sql) as copy:   # psycopg 3
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+    return Table(stage_name, MetaData(), *(Column(col, column_type) for col, column_type in zip(columns, column_types)))
+
+
+def _copy_upsert(session, table, rows):
+    """
+    PostgreSQL COPY variant of _execute_upsert: stage the rows in a temporary table with
+    COPY, then merge them with one INSERT ... SELECT ... ON CONFLICT (uid) DO UPDATE
+    """
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    for shape, (columns, shaped_rows) in enumerate(_group_rows_by_columns(rows).items()):
+        columns = list(columns)
+        stage = _copy_into_stage(session, table, columns, shaped_rows, f"d2_stage_{shape}")
+        stmt = pg_insert(table).from_select(columns, select(*(stage.c[col] for col in columns)))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.uid],
+            set_={col: stmt.excluded[col] for col in columns if col != 'uid'}
+        )
+        session.execute(stmt)
+
+
+def _copy_reference_updates(session, table, rows):
+    """
+    PostgreSQL COPY variant of _execute_reference_updates: stage uid and the ref_* columns
+    with COPY, then set them with one UPDATE ... FROM the staging table
+    """
+    for shape, (columns, shaped_rows) in enumerate(_group_rows_by_columns(rows).items()):
+        columns = list(columns)
+        stage = _copy_into_stage(session, table, columns, shaped_rows, f"d2_stage_refs_{shape}")
+        session.execute(
+            update(table)
+            .where(table.c.uid == stage.c.uid)
+            .values({col: stage.c[col] for col in columns if col != 'uid'})
+        )
+
+
+def bulk_upsert_rows(table, rows, chunk_size=DEFAULT_WRITE_CHUNK_SIZE, on_row_error=None, use_copy=False):
+    """
+    Insert or update rows of a kind table keyed on uid, committing in chunks
+
+    Args:
+        table: SQLAlchemy Table to write to
+        rows: List of row dicts (see build_d2_row); uids must be unique within the list
+        chunk_size: Maximum number of rows committed per transaction
+        on_row_error: Optional callback (row, error) for rows that could not be written
+        use_copy: Load through COPY and a staging table (PostgreSQL with psycopg2/psycopg only,
+            see copy_supported); otherwise the dialect upsert is used
+
+    Returns:
+        int: Number of rows written successfully
+    """
+    write_chunk = _copy_upsert if use_copy else _execute_upsert
+    return _write_isolating_failures(
+        lambda session, chunk: write_chunk(session, table, chunk),
+        rows, chunk_size, on_row_error
+    )
+
+
+def bulk_update_references(table, rows, chunk_size=DEFAULT_WRITE_CHUNK_SIZE, on_row_error=None, use_copy=False):
+    """
+    Write the reference columns of a kind table for many records, committing in chunks
+
+    Args:
+        table: SQLAlchemy Table to update
+        rows: List of dicts holding 'uid' and the ref_<kind> columns to set; uids must be unique
+        chunk_size: Maximum number of rows committed per transaction
+        on_row_error: Optional callback (row, error) for rows that could not be updated
+        use_copy: Stage the columns through COPY (see bulk_upsert_rows)
+
+    Returns:
+        int: Number of rows updated successfully
+    """
+    write_chunk = _copy_reference_updates if use_copy else _execute_reference_updates
+    return _write_isolating_failures(
+        lambda session, chunk: write_chunk(session, table, chunk),
+        rows, chunk_size, on_row_error
+    )
+
+
+class ErrorRecordStore:
+    """
+    Bounded store of per-key error details (key, error type and message only)
+
+    At most max_records entries are kept in memory. When spill_path is given, full
+    batches of entries are appended to that JSON-lines file instead of being dropped;
+    otherwise the oldest entries are discarded. Counts by error type cover every entry.
+    Like DeferredReferenceQueue, the spill file is emptied when the store is created, so
+    entries of an earlier run are never mixed in; only restore() keeps appending to it.
+    """
+
+    def __init__(self, max_records=DEFAULT_ERROR_STORE_SIZE, spill_path=None):
+        self.max_records = max_records
+        self.spill_path = spill_path
+        self.total_count = 0
+        self.spilled_count = 0
+        self.counts_by_type = Counter()
+        self._records = deque(maxlen=None if spill_path else max_records)
+        if spill_path and os.path.exists(spill_path):
+            self._truncate_spill_file(0)
+
+    def _truncate_spill_file(self, size):
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            f.truncate(size)
+
+    def __len__(self):
+        return self.total_count
+
+    def add(self, key, error_type, message):
+        """Record one error; the message is truncated like D2SkippedData.error_message"""
+        self.total_count += 1
+        self.counts_by_type[error_type] += 1
+        self._records.append((key, error_type, (message or "")[:1000]))
+
+        if self.spill_path and len(self._records) >= self.max_records:
+            self.spill()
+
+    def spill(self):
+        """Append the in-memory entries to spill_path and clear them"""
+        if not self.spill_path or not self._records:
+            return
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            for key, error_type, message in self._records:
+                f.write(json.dumps({"key": key, "error_type": error_type, "error": message}) + "\n")
+        self.spilled_count += len(self._records)
+        self._records.clear()
+
+    def persist(self):
+        """
+        Move the in-memory entries to the spill file (if any), e.g. before writing a checkpoint
+
+        Returns:
+            dict: State for ErrorRecordStore.restore
+        """
+        self.spill()
+        return {
+            'size': os.path.getsize(self.spill_path) if self.spilled_count else 0,
+            'total_count': self.total_count,
+            'spilled_count': self.spilled_count,
+            'counts_by_type': dict(self.counts_by_type),
+        }
+
+    @classmethod
+    def restore(cls, state, max_records=DEFAULT_ERROR_STORE_SIZE, spill_path=None):
+        """
+        Reopen a store saved by persist(); entries appended to spill_path after it was saved
+        are dropped
+
+        Args:
+            state: Dict returned by persist()
+            max_records, spill_path: See ErrorRecordStore
+        """
+        store = cls(max_records)
+        store.spill_path = spill_path
+        store._records = deque(maxlen=None if spill_path else max_records)
+        if spill_path and os.path.exists(spill_path):
+            # Also when nothing was saved: the crashed batch may have spilled entries since
+            store._truncate_spill_file(state.get('size', 0))
+        store.total_count = state.get('total_count', 0)
+        store.spilled_count = state.get('spilled_count', 0) if spill_path else 0
+        store.counts_by_type = Counter(state.get('counts_by_type', {}))
+        return store
+
+    def recent(self):
+        """Return the entries still held in memory as dicts"""
+        return [
+            {"key": key, "error_type": error_type, "error": message}
+            for key, error_type, message in self._records
+        ]
+
+
+def _generated_skipped_uid(key):
+    """uid for a skipped record without one: stable for a D1 key, random without a key"""
+    if key:
+        return f"generated-{uuid.uuid5(uuid.NAMESPACE_URL, str(key))}"
+    return f"generated-{uuid.uuid4()}"
+
+
+class SkippedDataSink:
+    """
+    Buffer D2SkippedData rows in memory and write them with bulk inserts
+
+    Rows are flushed when the buffer holds max_rows rows or max_seconds have passed since
+    the last flush, and whenever flush() is called (e.g. at the end of a batch). Used as a
+    context manager it also flushes when the block exits with an exception.
+
+    Rows are upserted on the table's primary key, and a record without a uid gets one
+    derived from its D1 key, so writing the same records again (a batch redone after a
+    resume) updates the rows written the first time instead of adding duplicates.
+    """
+
+    def __init__(self, max_rows=DEFAULT_SKIPPED_FLUSH_ROWS, max_seconds=DEFAULT_SKIPPED_FLUSH_SECONDS):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.flushed_count = 0  # Rows written to D2SkippedData so far
+        self.failed_count = 0   # Rows that could not be written
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, key, kind=None, service=None, uid=None, error_type="unknown_error",
+            error_message="", size_bytes=0):
+        """Queue one skipped record, flushing if a size or time limit is reached"""
+        # Ensure we have valid values for the composite key fields
+        self._buffer.append({
+            'uid': uid if uid else _generated_skipped_uid(key),
+            'service': service if service else "unknown",
+            'object_type': kind if kind else "unknown",  # Using 'kind' as 'object_type'
+            'key': key,
+            'size_bytes': size_bytes,
+            'error_type': error_type,
+            'error_message': error_message[:1000]
+        })
+
+        if (len(self._buffer) >= self.max_rows or
+                time.monotonic() - self._last_flush >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows to D2SkippedData
+
+        Returns:
+            int: Number of rows written by this flush
+        """
+        rows, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if not rows:
+            return 0
+
+        # One statement can't upsert the same key twice; the last record for a key wins
+        table = D2SkippedData.__table__
+        key_columns = tuple(col.name for col in table.primary_key.columns)
+        rows = list({tuple(row.get(col) for col in key_columns): row for row in rows}.values())
+
+        written = _write_isolating_failures(
+            lambda session, chunk: _execute_upsert(session, table, chunk, key_column=key_columns),
+            rows, self.max_rows, self._record_failure
+        )
+        self.flushed_count += written
+        logger.debug(f"Flushed {written} skipped records to '{D2SkippedData.__tablename__}'")
+        return written
+
+    def _record_failure(self, row, e):
+        self.failed_count += 1
+        # Log the specific record details that failed
+        logger.error(f"Error saving skipped data record (uid={row['uid']}, service={row['service']}, object_type={row['object_type']}): {e}")
+
+
+class DeferredReference(NamedTuple):
+    """A reference whose target was not found when its owner's references were written"""
+    kind: str  # Owner's kind and service identify its table
+    service: Optional[str]
+    owner_uid: str
+    ref_kind: str
+    name: str
+    namespace: str
+    tenant: Optional[str]
+
+
+class DeferredReferenceQueue:
+    """
+    Queue of unresolved references, kept for a final resolution pass after the last batch
+
+    Up to max_in_memory entries are held in memory; beyond that they are appended to a
+    JSON-lines spill file (spill_path, or a temporary file removed by close()).
+    Entries are yielded in the order they were added. A spill_path given by the caller
+    is emptied when the queue is created and again by close(), so entries of an earlier
+    run are never read back.
+    """
+
+    def __init__(self, max_in_memory=DEFAULT_DEFERRED_MEMORY_SIZE, spill_path=None):
+        self.max_in_memory = max_in_memory
+        self.spill_path = spill_path
+        self.total_count = 0
+        self.spilled_count = 0
+        self._entries = []
+        self._owns_spill_file = False
+        self._lock = threading.Lock()
+        if spill_path and os.path.exists(spill_path):
+            self._truncate_spill_file(0)
+
+    def __len__(self):
+        return self.total_count
+
+    def add(self, kind, service, owner_uid, ref_kind, name, namespace, tenant):
+        """Queue one reference of owner_uid (a kind/service row) that has no uid yet"""
+        with self._lock:
+            self._entries.append(DeferredReference(kind, service, owner_uid, ref_kind, name, namespace, tenant))
+            self.total_count += 1
+            if len(self._entries) >= self.max_in_memory:
+                self._spill()
+
+    def _truncate_spill_file(self, size):
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            f.truncate(size)
+
+    def _spill(self):
+        if not self.spill_path:
+            fd, self.spill_path = tempfile.mkstemp(prefix='d2_deferred_refs_', suffix='.jsonl')
+            os.close(fd)
+            self._owns_spill_file = True
+        with open(self.spill_path, 'a', encoding='utf-8') as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry) + "\n")
+        self.spilled_count += len(self._entries)
+        self._entries.clear()
+
+    def persist(self):
+        """
+        Move every queued entry to the spill file, e.g. before writing a checkpoint
+
+        Returns:
+            dict: State for DeferredReferenceQueue.restore
+        """
+        with self._lock:
+            if self._entries:
+                self._spill()
+            size = os.path.getsize(self.spill_path) if self.spilled_count else 0
+            return {
+                'spill_path': self.spill_path,
+                'count': self.spilled_count,
+                'size': size,
+                'owns_spill_file': self._owns_spill_file,
+            }
+
+    @classmethod
+    def restore(cls, state, max_in_memory=DEFAULT_DEFERRED_MEMORY_SIZE):
+        """
+        Reopen a queue saved by persist(); entries appended after it was saved are dropped
+
+        Args:
+            state: Dict returned by persist()
+            max_in_memory: See DeferredReferenceQueue
+        """
+        queue = cls(max_in_memory)
+        queue.spill_path = state.get('spill_path')
+        if queue.spill_path and os.path.exists(queue.spill_path):
+            # Also when nothing was saved: the crashed batch may have spilled entries since
+            queue._truncate_spill_file(state.get('size', 0))
+        queue.total_count = queue.spilled_count = state.get('count', 0)
+        queue._owns_spill_file = state.get('owns_spill_file', False)
+        return queue
+
+    def iter_chunks(self, size):
+        """Yield the queued entries as lists of at most size DeferredReference records"""
+        def entries():
+            if self.spilled_count:
+                with open(self.spill_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        yield DeferredReference(*json.loads(line))
+            yield from self._entries
+        yield from iter_batches(entries(), size)
+
+    def close(self):
+        """Drop the queued entries; remove a temporary spill file, empty a caller's one"""
+        self._entries.clear()
+        if self.spill_path and os.path.exists(self.spill_path):
+            if self._owns_spill_file:
+                os.remove(self.spill_path)
+            else:
+                self._truncate_spill_file(0)
+        self.total_count = self.spilled_count = 0
+
+
+# Per-object state of the last load, used by incremental runs to skip unchanged objects
+load_state_table = Table(
+    'd2_load_state', MetaData(),
+    Column('raw_key', String(768), primary_key=True),
+    Column('uid', String(255)),
+    Column('modified_seconds', BigInteger),
+    Column('content_hash', String(64)),
+    Column('loaded_at', DateTime(timezone=True)),
+    Column('seen_run', String(36)),  # Id of the last incremental run whose input had the key
+)
+
+
+def modified_seconds_of(obj):
+    """modification_timestamp of a D2Object in whole seconds, as kept in d2_load_state"""
+    return int(obj.updated_at.timestamp()) if obj.updated_at else None
+
+
+def ensure_load_state_table():
+    """Create the d2_load_state table if it doesn't exist, adding columns missing from older versions"""
+    load_state_table.create(bind=engine, checkfirst=True)
+    existing = {col['name'] for col in inspect(engine).get_columns(load_state_table.name)}
+    for column in load_state_table.c:
+        if column.name not in existing:
+            preparer = engine.dialect.identifier_preparer
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f"ALTER TABLE {preparer.format_table(load_state_table)} "
+                    f"ADD COLUMN {preparer.quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                ))
+            logger.info(f"Added column '{column.name}' to '{load_state_table.name}'")
+
+
+def count_load_state():
+    """Number of objects recorded by previous loads"""
+    session = Session()
+    try:
+        return session.execute(select(func.count()).select_from(load_state_table)).scalar() or 0
+    finally:
+        session.close()
+
+
+def delete_unseen_load_state(run_id):
+    """
+    Forget the objects recorded by previous loads whose keys were not in run_id's input
+
+    Called once run_id's input has been read completely, so each deleted object is
+    reported by one run only; if it comes back, the next run counts it as new.
+
+    Returns:
+        int: Number of state rows removed
+    """
+    session = Session()
+    try:
+        result = session.execute(delete(load_state_table).where(
+            or_(load_state_table.c.seen_run.is_(None), load_state_table.c.seen_run != run_id)
+        ))
+        session.commit()
+        return result.rowcount or 0
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def mark_load_state_seen(keys, run_id, chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE):
+    """
+    Record that the recorded objects with these D1 keys are in run_id's input
+
+    Marking is idempotent, so a key that appears in several batches (or in a batch redone
+    after a resume) is still counted once by delete_unseen_load_state.
+
+    Args:
+        keys: D1 keys of a batch; keys without a recorded state are ignored
+        run_id: Id of the current incremental run
+        chunk_size: Maximum number of keys per UPDATE
+
+    Returns:
+        int: Number of keys processed successfully
+    """
+    keys = list(dict.fromkeys(key for key in keys if key))
+
+    def record_error(key, e):
+        logger.error(f"Error marking load state of {key} as seen: {e}")
+
+    return _write_isolating_failures(
+        lambda session, chunk: session.execute(
+            update(load_state_table).where(load_state_table.c.raw_key.in_(chunk)).values(seen_run=run_id)
+        ),
+        keys, chunk_size, record_error
+    )
+
+
+def fetch_load_state(keys, chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE):
+    """
+    Fetch the recorded state of the given D1 keys
+
+    Args:
+        keys: D1 keys of a batch
+        chunk_size: Maximum number of keys per query
+
+    Returns:
+        dict: key -> (modified_seconds, content_hash) for keys loaded before
+    """
+    keys = list(dict.fromkeys(key for key in keys if key))
+    state = {}
+    session = Session()
+    try:
+        for start in range(0, len(keys), chunk_size):
+            stmt = select(
+                load_state_table.c.raw_key, load_state_table.c.modified_seconds, load_state_table.c.content_hash
+            ).where(load_state_table.c.raw_key.in_(keys[start:start + chunk_size]))
+            for raw_key, modified_seconds, content_hash in session.execute(stmt):
+                state[raw_key] = (modified_seconds, content_hash)
+    finally:
+        session.close()
+    return state
+
+
+def save_load_state(objects, chunk_size=DEFAULT_WRITE_CHUNK_SIZE):
+    """
+    Record the state of loaded objects so the next incremental run can skip them if unchanged
+
+    Args:
+        objects: D2Object records written successfully (with content_hash set)
+        chunk_size: Maximum number of rows committed per transaction
+
+    Returns:
+        int: Number of state rows written
+    """
+    loaded_at = datetime.now(timezone.utc)
+    rows = {}
+    for obj in objects:
+        rows[obj.key] = {
+            'raw_key': obj.key,
+            'uid': obj.uid,
+            'modified_seconds': modified_seconds_of(obj),
+            'content_hash': obj.content_hash,
+            'loaded_at': loaded_at,
+        }
+
+    def record_error(row, e):
+        logger.error(f"Error recording load state for {row['raw_key']}: {e}")
+
+    return _write_isolating_failures(
+        lambda session, chunk: _execute_upsert(session, load_state_table, chunk, key_column='raw_key'),
+        list(rows.values()), chunk_size, record_error
+    )
+
+
+# Per-item warning events of the hot loops, with the level their messages are logged at;
+# repair rule hits (see RepairRules) are events named after the rule, logged at INFO.
+# Each event is counted per batch and summarised once; only the first
+# ITEM_LOG_SAMPLE_SIZE occurrences per batch (per group in Phase 2) are logged at that
+# level, the rest only when DEBUG is enabled.
+ITEM_EVENTS = {
+    'invalid_size': logging.WARNING,
+    'invalid_value': logging.WARNING,
+    'missing_service': logging.WARNING,
+    'unknown_kind': logging.WARNING,
+    'missing_name_uid': logging.WARNING,
+    'missing_namespace': logging.WARNING,
+    'namespace_uid_not_found': logging.WARNING,
+    'reference_column_missing': logging.WARNING,
+}
+
+ITEM_LOG_SAMPLE_SIZE = 5
+
+
+def log_item_event(counts, event, message, *args):
+    """
+    Count a per-item event and log its message if it is among the sampled occurrences
+
+    The message is %-formatted lazily, so occurrences that aren't logged cost no formatting.
+
+    Args:
+        counts: Counter of events for the current batch (or group)
+        event: Key of ITEM_EVENTS
+        message: Log message with %-style placeholders
+        args: Values for the placeholders
+    """
+    counts[event] += 1
+    if counts[event] <= ITEM_LOG_SAMPLE_SIZE:
+        logger.log(ITEM_EVENTS.get(event, logging.INFO), message, *args)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+
+
+def log_item_event_summary(prefix, counts):
+    """Log the events counted with log_item_event once: warnings and repairs on a line each"""
+    for level, label in ((logging.WARNING, 'warnings'), (logging.INFO, 'repairs')):
+        summary = ', '.join(f"{event}={count}" for event, count in sorted(counts.items())
+                            if ITEM_EVENTS.get(event, logging.INFO) == level)
+        if summary:
+            logger.log(level, f"{prefix} {label}: {summary}")
+
+
+@contextmanager
+def queued_log_handlers(target=None):
+    """
+    Put a QueueHandler in front of a logger's handlers for the duration of the block
+
+    Records are queued by the logging thread and written by the original handlers in a
+    QueueListener thread, so slow handlers (files, consoles, network) don't block the load.
+
+    Args:
+        target: Logger whose handlers are moved (the root logger by default)
+    """
+    target = target or logging.getLogger()
+    handlers = list(target.handlers)
+    if not handlers:
+        yield
+        return
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        target.removeHandler(handler)
+    target.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield
+    finally:
+        target.removeHandler(queue_handler)
+        listener.stop()  # Writes whatever is still queued
+        for handler in handlers:
+            target.addHandler(handler)
+
+
+class RepairContext:
+    """
+    The fields of one D1 item the repair rules look at
+
+    The key is split into its '/'-separated segments once, on first use by a rule
+    (segments, segment_position), however many rules read it.
+    """
+    __slots__ = ('key', 'value', 'metadata', 'system_metadata', 'kind', 'kind_lower', 'service', 'name', 'uid',
+                 '_segments')
+
+    def __init__(self, key, value, metadata, system_metadata, kind, service, name, uid):
+        self.key = key
+        self.value = value
+        self.metadata = metadata
+        self.system_metadata = system_metadata
+        self.kind = kind
+        self.kind_lower = kind.lower()
+        self.service = service
+        self.name = name
+        self.uid = uid
+        self._segments = None
+
+    @property
+    def segments(self):
+        """The key split on '/' (a leading '/' gives an empty first segment)"""
+        if self._segments is None:
+            self._segments = self.key.split('/')
+        return self._segments
+
+    def segment_position(self, segment):
+        """Index of the first segment equal to segment that has another segment after it, or None"""
+        segments = self.segments
+        try:
+            return segments.index(segment, 0, len(segments) - 1)
+        except ValueError:
+            return None
+
+
+class RepairRule(NamedTuple):
+    """
+    One repair heuristic
+
+    apply(context) returns None when the rule doesn't apply, otherwise (value, log_args):
+    the repaired value and the arguments of message. name is also the log_item_event event
+    counting the rule's hits.
+    """
+    name: str
+    apply: Callable
+    message: str
+
+
+class RepairRules:
+    """
+    Ordered table of repair rules for one field
+
+    The rules run in order and the first one that produces a value wins; a rule that
+    applies but finds an empty value still counts as a hit and the next rules are tried.
+    Hits are counted per rule in the item_events of the batch.
+
+    Rules registered at runtime apply to pre-processing in this process (and in worker
+    processes started by fork).
+    """
+
+    def __init__(self, rules):
+        self._rules = list(rules)
+
+    @property
+    def names(self):
+        return [rule.name for rule in self._rules]
+
+    def register(self, rule, before=None, after=None):
+        """
+        Add a rule, at the end or before/after the rule with the given name
+
+        Args:
+            rule: RepairRule; a rule with the same name is replaced
+            before: Name of the rule to insert before
+            after: Name of the rule to insert after
+        """
+        self._rules = [existing for existing in self._rules if existing.name != rule.name]
+        if before is not None:
+            position = self.names.index(before)
+        elif after is not None:
+            position = self.names.index(after) + 1
+        else:
+            position = len(self._rules)
+        self._rules.insert(position, rule)
+
+    def remove(self, name):
+        """Remove the rule with the given name"""
+        self._rules = [rule for rule in self._rules if rule.name != name]
+
+    def reorder(self, names):
+        """
+        Put the named rules first, in the given order; the others keep their relative order
+
+        Since the first rule that produces a value wins, moving a rule ahead of another
+        that applies to the same items changes which repair those items get.
+        """
+        position = {name: index for index, name in enumerate(names)}
+        self._rules.sort(key=lambda rule: position.get(rule.name, len(position)))
+
+    def reorder_by_hits(self, hits):
+        """Order the rules by descending hit count (e.g. a run's item_events); see reorder"""
+        self.reorder(sorted((rule.name for rule in self._rules if hits.get(rule.name)),
+                            key=lambda name: -hits[name]))
+
+    def apply(self, context, events):
+        """
+        Run the rules against one item
+
+        Args:
+            context: RepairContext of the item
+            events: Counter receiving the hits (see log_item_event)
+
+        Returns:
+            tuple: (value, hit) - the value of the last rule that hit (None if none did)
+            and whether any rule hit
+        """
+        value = None
+        hit = False
+        for rule in self._rules:
+            outcome = rule.apply(context)
+            if outcome is None:
+                continue
+            value, log_args = outcome
+            hit = True
+            log_item_event(events, rule.name, rule.message, *log_args)
+            if value:
+                break
+        return value, hit
+
+
+def _status_object_name_from_uid(item):
+    # StatusObjects may not have a name; derive one from the UID
+    if not item.name and item.uid and item.kind_lower.endswith('statusobject'):
+        name = f"status-{item.uid[:8]}"
+        return (name, item.uid), (name, item.uid)
+    return None
+
+
+def _name_uid_from_key(item):
+    # Last resort for StatusObjects without a UID: the last segment of the key
+    if not item.name and not item.uid and item.kind_lower.endswith('statusobject'):
+        potential_uid = item.segments[-1]
+        if len(potential_uid) > 8:  # Simple validation for UID-like string
+            name = f"derived-{potential_uid[:8]}"
+            return (name, potential_uid), (potential_uid, name, item.key)
+    return None
+
+
+NAME_UID_RULES = RepairRules([
+    RepairRule('status_object_name_from_uid', _status_object_name_from_uid,
+               "Generated name '%s' for StatusObject with UID %s"),
+    RepairRule('name_uid_from_key', _name_uid_from_key,
+               "Extracted UID '%s' and generated name '%s' from key: %s"),
+])
+
+
+# Precompiled matchers for the namespace rules
+_SYSTEM_NAMESPACE_KIND_RE = re.compile(r'deployment|status')
+_KUBERNETES_RE = re.compile(r'kubernetes', re.IGNORECASE)
+
+
+def _namespace_from_system_metadata(item):
+    system_metadata = item.system_metadata
+    if system_metadata and 'namespace' in system_metadata:
+        ns_data = system_metadata.get('namespace')
+        if isinstance(ns_data, list) and len(ns_data) > 0 and isinstance(ns_data[0], dict):
+            namespace = ns_data[0].get('name')
+            return namespace, (namespace,)
+    return None
+
+
+def _namespace_default_for_kind(item):
+    # Deployment and status objects default to the system namespace
+    if _SYSTEM_NAMESPACE_KIND_RE.search(item.kind_lower):
+        return 'system', (item.kind, item.name)
+    return None
+
+
+def _namespace_from_key(item):
+    # ...namespace/NAME anywhere in the key: the segment after the first one ending in
+    # 'namespace'; NAME also ends where another 'namespace/' starts
+    if 'namespace/' not in item.key:
+        return None
+    segments = item.segments
+    for position in range(len(segments) - 1):
+        if segments[position].endswith('namespace'):
+            namespace = segments[position + 1]
+            if namespace.endswith('namespace') and position + 2 < len(segments):
+                namespace = namespace[:-len('namespace')]
+            if namespace:
+                return namespace, (namespace, item.key)
+            return None
+    return None
+
+
+def _namespace_default_application(item):
+    # Application objects often belong to the system namespace
+    if 'application' in item.kind_lower:
+        return 'system', (item.key,)
+    return None
+
+
+def _namespace_from_segment(segment):
+    # .../SEGMENT/NAME/... with SEGMENT a whole key segment; logs NAME's segment position
+    def rule(item):
+        position = item.segment_position(segment)
+        if position is not None:
+            return item.segments[position + 1], (item.segments[position + 1], position + 1)
+        return None
+    return rule
+
+
+def _namespace_default_maurice(item):
+    # Objects in the maurice service often belong to the system namespace
+    if 'maurice' in item.service.lower():
+        return 'system', (item.key,)
+    return None
+
+
+def _namespace_default_kubernetes(item):
+    # Kubernetes-related objects are often in the system namespace: an app_spec.App with a
+    # kubernetes configuration, or 'kubernetes' in any label or annotation
+    spec = item.value.get('spec')
+    if isinstance(spec, dict) and isinstance(spec.get('app_spec'), dict):
+        app = spec['app_spec'].get('App')
+        if isinstance(app, dict) and 'kubernetes' in app:
+            return 'system', (item.key,)
+    if isinstance(item.metadata, dict):
+        for field in ('labels', 'annotations'):
+            entries = item.metadata.get(field)
+            if isinstance(entries, dict):
+                for k, v in entries.items():
+                    if _KUBERNETES_RE.search(str(k)) or _KUBERNETES_RE.search(str(v)):
+                        return 'system', (item.key,)
+    return None
+
+
+def _namespace_from_tenant(item):
+    system_metadata = item.system_metadata
+    if system_metadata and 'tenant' in system_metadata and system_metadata['tenant']:
+        tenant_value = system_metadata['tenant']
+        namespace = f"tenant-{tenant_value}"
+        return namespace, (namespace, tenant_value)
+    return None
+
+
+NAMESPACE_RULES = RepairRules([
+    RepairRule('namespace_from_system_metadata', _namespace_from_system_metadata,
+               "Extracted namespace '%s' from system_metadata.namespace"),
+    RepairRule('namespace_default_for_kind', _namespace_default_for_kind,
+               "Setting default namespace 'system' for %s: %s"),
+    RepairRule('namespace_from_key', _namespace_from_key,
+               "Extracted namespace '%s' from key path: %s"),
+    RepairRule('namespace_default_application', _namespace_default_application,
+               "Setting default namespace 'system' for application object: %s"),
+    RepairRule('namespace_from_namespace_segment', _namespace_from_segment('namespace'),
+               "Extracted namespace '%s' from key path at position %d"),
+    RepairRule('namespace_from_by_namespace_segment', _namespace_from_segment('by-namespace'),
+               "Extracted namespace '%s' from key path at position %d"),
+    RepairRule('namespace_default_maurice', _namespace_default_maurice,
+               "Setting default namespace 'system' for maurice service object: %s"),
+    RepairRule('namespace_default_kubernetes', _namespace_default_kubernetes,
+               "Setting default namespace 'system' for kubernetes-related object: %s"),
+    RepairRule('namespace_from_tenant', _namespace_from_tenant,
+               "Setting tenant namespace '%s' based on tenant: %s"),
+])
+
+
+# Sorts before any modification timestamp when coalescing duplicate uids
+_NO_TIMESTAMP = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def _reference_identity(ref):
+    """What makes two extracted references the same reference (the path they were found at doesn't)"""
+    return (ref.get('kind'), ref.get('name'), ref.get('namespace'), ref.get('uid'), ref.get('tenant'), ref.get('service'))
+
+
+class PreprocessedBatch:
+    """
+    Result of the pre-processing pass over a batch (or a slice of one)
+
+    Holds the D2Object records grouped by (kind, service), the reference kinds seen per
+    group, namespace UIDs discovered for the cross-batch namespace cache, and the
+    records to be written to D2SkippedData, all in input order. In incremental mode it
+    also counts new, changed and unchanged objects; unchanged ones are not kept.
+    After coalesce_duplicates() each group holds one record per uid.
+    """
+
+    def __init__(self):
+        self.objects_by_kind_service = {}  # Objects grouped by kind and service
+        self.kind_service_references = {}  # References by kind and service
+        self.namespace_uids = {}           # (name, tenant) -> uid of namespace objects
+        self.skipped = []                  # save_to_d2_skipped_data keyword arguments
+        self.fixed_namespace_count = 0
+        self.fixed_name_uid_count = 0
+        self.new_count = 0
+        self.changed_count = 0
+        self.unchanged_count = 0
+        self.reference_seconds = 0.0       # Time spent in find_references
+        self.item_events = Counter()       # log_item_event counts
+        self.coalesced = []                # (dropped copy, key of the record kept for its uid)
+
+    def skip(self, **skipped_record):
+        """Queue a record for D2SkippedData"""
+        self.skipped.append(skipped_record)
+
+    def merge(self, other):
+        """Append the results of a later slice of the same batch"""
+        for kind_service_key, objects in other.objects_by_kind_service.items():
+            self.objects_by_kind_service.setdefault(kind_service_key, []).extend(objects)
+        for kind_service_key, ref_kinds in other.kind_service_references.items():
+            self.kind_service_references.setdefault(kind_service_key, set()).update(ref_kinds)
+        self.namespace_uids.update(other.namespace_uids)
+        self.skipped.extend(other.skipped)
+        self.fixed_namespace_count += other.fixed_namespace_count
+        self.fixed_name_uid_count += other.fixed_name_uid_count
+        self.new_count += other.new_count
+        self.changed_count += other.changed_count
+        self.unchanged_count += other.unchanged_count
+        self.reference_seconds += other.reference_seconds
+        self.item_events.update(other.item_events)
+        self.coalesced.extend(other.coalesced)
+
+    def coalesce_duplicates(self):
+        """
+        Keep one record per (kind, service, uid) so each row is written once per batch
+
+        The copy with the latest modification timestamp wins, the later one in input order
+        on a tie; copies without a timestamp lose to copies with one. The winner takes the
+        references of all copies: its own first, then those of the other copies it doesn't
+        already have, except their namespace references (the row keeps the winner's
+        namespace). The kept record sits at the position of the uid's first copy.
+
+        Returns:
+            int: Number of copies dropped in this call
+        """
+        dropped = 0
+        for kind_service_key, objects in self.objects_by_kind_service.items():
+            positions_by_uid = {}
+            for position, obj in enumerate(objects):
+                positions_by_uid.setdefault(obj.uid, []).append(position)
+            if len(positions_by_uid) == len(objects):
+                continue
+
+            kept = []
+            for positions in positions_by_uid.values():
+                if len(positions) == 1:
+                    kept.append(objects[positions[0]])
+                    continue
+                winner_position = max(positions, key=lambda position: (
+                    objects[position].updated_at is not None,
+                    objects[position].updated_at or _NO_TIMESTAMP,
+                    position
+                ))
+                winner = objects[winner_position]
+                references = list(winner.references)
+                seen = {_reference_identity(ref) for ref in references}
+                for position in positions:
+                    if position == winner_position:
+                        continue
+                    loser = objects[position]
+                    for ref in loser.references:
+                        if ref.get('kind') == 'namespace':
+                            continue
+                        identity = _reference_identity(ref)
+                        if identity not in seen:
+                            seen.add(identity)
+                            references.append(ref)
+                    self.coalesced.append((loser, winner.key))
+                    dropped += 1
+                kept.append(winner._replace(references=references))
+            self.objects_by_kind_service[kind_service_key] = kept
+        return dropped
+
+
+def _preprocess_items(items, start_index=0, prior_state=None, schema_only=False):
+    """
+    Pre-process pass over D1 items: repair missing namespace/name/UID fields, detect
+    kind and service, extract references and group the resulting D2Object records
+
+    This is pure CPU work with no database access, so slices of a batch can run in
+    worker processes and be merged afterwards (see PreprocessedBatch.merge).
+
+    Args:
+        items: List of D1 items
+        start_index: Position of items[0] in the whole input, for log messages
+        prior_state: Incremental mode only - key -> (modified_seconds, content_hash) recorded
+            by the last load for the keys of these items; objects that match are skipped
+        schema_only: Only fill kind_service_references, using reference_kinds instead of
+            extracting references (see plan_table_schemas)
+
+    Returns:
+        PreprocessedBatch
+    """
+    result = PreprocessedBatch()
+
+    for item_index, item in enumerate(items):
+        # Global index for logging purposes
+        global_item_index = start_index + item_index
+    
+        key = item.get('key', '')
+        value = item.get('value')
+    
+        # Handle size field consistently
+        size = item.get('size')  # Get size from the item
+        if not size:
+            size = item.get('size_bytes')
+        if not size:
+            size = item.get('size(Bytes)')
+        # Ensure size is an integer or None
+        try:
+            size = int(size) if size is not None else None
+        except (ValueError, TypeError):
+            log_item_event(result.item_events, 'invalid_size',
+                           "Invalid size value '%s' for item #%d, setting to None: %s", size, global_item_index, key)
+            size = None
+
+        # Skip items without proper value
+        if not isinstance(value, dict):
+            log_item_event(result.item_events, 'invalid_value',
+                           "Skipping item #%d with invalid value: %s", global_item_index, key)
+
+            # Extract object_type from item if available
+            object_type = item.get('object_type', 'unknown')
+            item_uid = item.get('uid')  # Without one the sink derives a uid from the key
+        
+            # Queue the record for D2SkippedData
+            result.skip(
+                key=key,
+                uid=item_uid,
+                kind=object_type,
+                service=item.get('service', 'unknown'),
+                error_type="invalid_value",
+                error_message="Invalid value (not a dictionary)",
+                size_bytes=size
+            )
+        
+            continue
+        
+        # Extract basic information
+        metadata = value.get('metadata', {})
+        system_metadata = value.get('system_metadata', {})
+    
+        # Extract service from item or key
+        service = item.get('service')
+        if not service:
+            service = extract_service_from_key(key)
+            if not service:
+                log_item_event(result.item_events, 'missing_service',
+                               "Could not extract service for item #%d: %s", global_item_index, key)
+
+                # Queue the record for D2SkippedData
+                result.skip(
+                    key=key,
+                    error_type="missing_service",
+                    error_message="Could not extract service",
+                    size_bytes=size
+                )
+            
+                continue
+    
+        # Try to get kind from multiple possible locations
+        original_kind = value.get('kind')
+        object_type = item.get('object_type')
+        if not original_kind and object_type:
+            original_kind = object_type
+    
+        if not original_kind:
+            # Try to find kind in metadata
+            original_kind = metadata.get('kind')
+        
+            # Try to extract from key if still not found
+            if not original_kind:
+                original_kind = extract_kind_from_key(key)
+            
+                # If still not found but has system_metadata.owner_view.kind, use that
+                if not original_kind and system_metadata and 'owner_view' in system_metadata:
+                    owner_view = system_metadata.get('owner_view', {})
+                    original_kind = owner_view.get('kind')
+    
+        # Skip if we can't determine the kind
+        if not original_kind:
+            log_item_event(result.item_events, 'unknown_kind',
+                           "Skipping item #%d with unknown kind: %s", global_item_index, key)
+
+            # Queue the record for D2SkippedData
+            result.skip(
+                key=key,
+                service=service,
+                error_type="unknown_kind",
+                error_message="Could not determine kind",
+                size_bytes=size
+            )
+        
+            continue
+    
+        # Normalize the kind (once)
+        normalized_kind = normalize_kind(original_kind)
+    
+        name = metadata.get('name')
+        uid = metadata.get('uid')
+        namespace = metadata.get('namespace')
+    
+        # Extract tenant from system_metadata
+        tenant = None
+        if system_metadata:
+            tenant = system_metadata.get('tenant')
+
+        # Special handling for namespace objects - identify and cache them
+        is_namespace = normalized_kind == 'namespace' or object_type == 'namespace'
+        if is_namespace:
+            # Namespaces don't have a namespace field in their metadata
+            # Set a default namespace for them
+            if name and uid and not namespace:
+                namespace = 'system'  # Default namespace for namespaces
+                logger.debug(f"Setting default namespace 'system' for namespace object: {name}")
+            
+            # Report namespace UIDs so the caller can cache them across batches
+            if name and uid:
+                # For namespace objects, don't include service in the cache key
+                cache_key = (name, tenant) if tenant else (name, None)
+                result.namespace_uids[cache_key] = uid
+                logger.debug(f"Cached namespace: {name}, tenant: {tenant}, UID: {uid} (shared across services)")
+            
+            # For namespace objects, we'll use the common 'namespace' table
+            service = None
+    
+        # FIX 1: Handle missing name or UID (see NAME_UID_RULES)
+        if not (name and uid):
+            # Try to extract from system_metadata
+            if system_metadata and 'uid' in system_metadata:
+                uid = system_metadata.get('uid')
+
+            repaired, fixed_name_uid_this_item = NAME_UID_RULES.apply(
+                RepairContext(key, value, metadata, system_metadata, normalized_kind, service, name, uid),
+                result.item_events
+            )
+            if fixed_name_uid_this_item:
+                name, uid = repaired
+                result.fixed_name_uid_count += 1
+
+        # Still missing name or UID after fix attempts?
+        if not (name and uid):
+            log_item_event(result.item_events, 'missing_name_uid',
+                           "Still missing name or UID after fix attempts for item #%d: %s", global_item_index, key)
+
+            # Queue the record for D2SkippedData
+            result.skip(
+                key=key,
+                kind=normalized_kind,
+                service=service,
+                name=name,
+                uid=uid,
+                tenant=tenant,
+                error_type="missing_name_uid",
+                error_message="Still missing name or UID after fix attempts",
+                size_bytes=size
+            )
+        
+            continue
+    
+        # FIX 2: Handle missing namespace (see NAMESPACE_RULES)
+        if not namespace:
+            repaired, fixed_namespace_this_item = NAMESPACE_RULES.apply(
+                RepairContext(key, value, metadata, system_metadata, normalized_kind, service, name, uid),
+                result.item_events
+            )
+            if fixed_namespace_this_item:
+                namespace = repaired
+                result.fixed_namespace_count += 1
+
+        # Still missing namespace after fix attempts?
+        if not namespace:
+            log_item_event(result.item_events, 'missing_namespace',
+                           "Still missing namespace after fix attempts for item #%d: %s", global_item_index, key)
+
+            # Queue the record for D2SkippedData
+            result.skip(
+                key=key,
+                kind=normalized_kind,
+                service=service,
+                name=name,
+                uid=uid,
+                tenant=tenant,
+                error_type="missing_namespace",
+                error_message="Still missing namespace after fix attempts",
+                size_bytes=size
+            )
+        
+            continue
+        
+        # Schema planning only needs the group and the kinds it refers to
+        if schema_only:
+            ref_kinds = {ref_kind for ref_kind in reference_kinds(value) if ref_kind != normalized_kind}
+            if not is_namespace:
+                ref_kinds.add('namespace')
+            result.kind_service_references.setdefault((normalized_kind, service), set()).update(ref_kinds)
+            continue
+
+        updated_at = timestamp_from_metadata(system_metadata, 'modification_timestamp')
+
+        # Incremental mode: skip objects unchanged since the last load before any further work
+        content_hash = None
+        if prior_state is not None:
+            content_hash = content_hash_of(value)
+            previous = prior_state.get(key)
+            if previous is None:
+                result.new_count += 1
+            elif previous == (int(updated_at.timestamp()) if updated_at else None, content_hash):
+                result.unchanged_count += 1
+                continue
+            else:
+                result.changed_count += 1
+
+        # Find all references in the object (do this only once)
+        references_started = time.perf_counter()
+        references = find_references(value, service)
+        result.reference_seconds += time.perf_counter() - references_started
+    
+        # Extract reference kinds for table schema generation
+        ref_kinds = set()
+        for ref in references:
+            ref_kind = ref.get('kind')  # This is already normalized by find_references
+            if ref_kind and ref_kind != normalized_kind:  # Don't include self-references by kind
+                ref_kinds.add(ref_kind)
+    
+        # Always add namespace reference for non-namespace objects
+        if not is_namespace:
+            ref_kinds.add('namespace')
+    
+        # Update result.kind_service_references - use kind+service as the key
+        kind_service_key = (normalized_kind, service)
+        if kind_service_key not in result.kind_service_references:
+            result.kind_service_references[kind_service_key] = set()
+        result.kind_service_references[kind_service_key].update(ref_kinds)
+    
+        # Store object info - grouped by kind+service
+        if kind_service_key not in result.objects_by_kind_service:
+            result.objects_by_kind_service[kind_service_key] = []
+        
+        result.objects_by_kind_service[kind_service_key].append(D2Object(
+            key=key,
+            uid=uid,
+            name=name,
+            namespace=namespace,
+            tenant=tenant,
+            service=service,
+            size=size,
+            original_kind=original_kind,
+            created_at=timestamp_from_metadata(system_metadata, 'creation_timestamp'),
+            updated_at=updated_at,
+            references=references,  # Store references to avoid re-extraction
+            content_hash=content_hash
+        ))
+
+    return result
+
+
+def _preprocess_slice(args):
+    """Process-pool entry point for _preprocess_items"""
+    items, start_index, prior_state = args
+    return _preprocess_items(items, start_index, prior_state)
+
+
+def preprocess_batch(items, start_index=0, pool=None, workers=1, prior_state=None):
+    """
+    Run the pre-processing pass over a batch, optionally fanned out across a process pool
+
+    Args:
+        items: List of D1 items in the batch
+        start_index: Position of items[0] in the whole input
+        pool: Optional concurrent.futures.ProcessPoolExecutor
+        workers: Number of worker processes in the pool
+        prior_state: Incremental mode only - recorded state of the batch's keys (see fetch_load_state)
+
+    Returns:
+        PreprocessedBatch: Results merged in input order
+    """
+    if pool is None or workers <= 1 or len(items) < 2 * workers:
+        return _preprocess_items(items, start_index, prior_state)
+
+    # Several slices per worker keep the pool busy when items differ a lot in size
+    slice_size = max(1, -(-len(items) // (workers * 4)))  # Ceiling division
+    slices = []
+    for i in range(0, len(items), slice_size):
+        slice_items = items[i:i + slice_size]
+        slice_state = None
+        if prior_state is not None:
+            # Only ship each worker the state of its own keys
+            slice_state = {
+                item.get('key', ''): prior_state[item.get('key', '')]
+                for item in slice_items if item.get('key', '') in prior_state
+            }
+        slices.append((slice_items, start_index + i, slice_state))
+
+    merged = PreprocessedBatch()
+    for partial in pool.map(_preprocess_slice, slices):
+        merged.merge(partial)
+    return merged
+
+
+@contextmanager
+def _logger_level(level):
+    """Temporarily change this module's logger level"""
+    previous = logger.level
+    logger.setLevel(level)
+    try:
+        yield
+    finally:
+        logger.setLevel(previous)
+
+
+def is_reiterable(source):
+    """True if source can be read more than once (a JSON-lines path or a sequence, not an iterator)"""
+    return isinstance(source, (str, os.PathLike)) or iter(source) is not source
+
+
+def plan_table_schemas(source, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Pre-scan the whole input for the final reference column set of every kind table
+
+    Items go through the same kind, service and repair decisions as the load, but only
+    their reference kinds are collected. Per-item repair and skip messages are left to
+    the load itself, so they are silenced here.
+
+    Args:
+        source: Re-iterable input as accepted by iter_raw_data
+        batch_size: Number of items scanned at a time
+
+    Returns:
+        dict: (kind, service) -> set of reference kinds
+    """
+    plan = {}
+    scanned = 0
+    with _logger_level(logging.ERROR):
+        for batch in iter_batches(iter_raw_data(source), batch_size):
+            partial = _preprocess_items(batch, scanned, schema_only=True)
+            for kind_service_key, ref_kinds in partial.kind_service_references.items():
+                plan.setdefault(kind_service_key, set()).update(ref_kinds)
+            scanned += len(batch)
+    logger.info(f"Schema plan: {len(plan)} tables from {scanned} items")
+    return plan
+
+
+def create_planned_tables(plan):
+    """
+    Create every planned table with all of its ref_<kind> columns and lookup index
+
+    The tables are registered in table_registry, so the load itself issues no DDL
+    for them.
+
+    Args:
+        plan: Result of plan_table_schemas
+
+    Returns:
+        int: Number of tables ready
+    """
+    ready = 0
+    for (kind, service), ref_kinds in plan.items():
+        try:
+            table_registry.get_or_create(kind, service, ref_kinds)
+            ready += 1
+        except Exception as e:
+            logger.error(f"Failed to create/get planned table for kind {kind}, service {service or 'default'}: {e}")
+    return ready
+
+
+@contextmanager
+def _optional_process_pool(workers):
+    """Yield a ProcessPoolExecutor with the given number of workers, or None for inline processing"""
+    if not workers or workers <= 1:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield pool
+
+
+class GroupWriteResult(NamedTuple):
+    """Outcome of writing one (kind, service) group in Phase 1 or Phase 2"""
+    written: int   # Objects written successfully
+    skipped: list  # save_to_d2_skipped_data keyword arguments for objects that failed
+    lookup_seconds: float = 0.0  # Phase 2 only: time spent resolving reference UIDs
+    item_events: Optional[Counter] = None  # Phase 2 only: log_item_event counts
+
+
+# Tables whose (name, namespace, tenant) lookup index is known to exist
+_lookup_indexed_tables = set()
+
+
+def _index_name(table_name, suffix):
+    """Index name for a table, shortened with a hash to stay within identifier limits (63 on PostgreSQL)"""
+    name = f"ix_{table_name}_{suffix}"
+    if len(name) <= 63:
+        return name
+    digest = hashlib.sha1(table_name.encode('utf-8')).hexdigest()[:8]
+    return f"ix_{table_name[:63 - len(suffix) - 13]}_{digest}_{suffix}"
+
+
+def ensure_lookup_index(table):
+    """
+    Create the (name, namespace, tenant) index used by reference UID lookups, once per table
+
+    Args:
+        table: SQLAlchemy Table of a kind
+    """
+    if table.name in _lookup_indexed_tables:
+        return
+    if not all(col in table.c for col in ('name', 'namespace', 'tenant')):
+        return
+
+    index_name = _index_name(table.name, 'name_ns_tenant')
+    try:
+        index = next((ix for ix in table.indexes if ix.name == index_name), None)
+        if index is None:
+            index = Index(index_name, table.c.name, table.c.namespace, table.c.tenant)
+        index.create(bind=engine, checkfirst=True)
+        _lookup_indexed_tables.add(table.name)
+    except Exception as e:
+        logger.warning(f"Could not create lookup index '{index_name}' on '{table.name}': {e}")
+
+
+class TableRegistry:
+    """
+    Process-local cache of kind tables in front of get_or_create_table and
+    find_table_by_kind_service
+
+    Each (kind, service) table is kept together with the reference kinds it is known to
+    have ref_<kind> columns for, so get_or_create_table (reflection and possibly ALTER TABLE)
+    only runs the first time a group is seen and when its reference set grows. Lookups by
+    find_table_by_kind_service are cached too; misses are forgotten whenever a table is
+    created. The lock also serialises the DDL of concurrent group writers.
+    Call invalidate() when tables are changed or dropped outside this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}  # (kind, service) -> (Table, frozenset of reference kinds)
+        self._found = {}   # (kind, service) -> Table or None, from find_table_by_kind_service
+        self.schema_calls = 0  # get_or_create_table / find_table_by_kind_service calls made
+        self.schema_seconds = 0.0  # Time spent in those calls
+        self.hits = 0
+
+    def get_or_create(self, kind, service, ref_kinds):
+        """
+        Table for a (kind, service) group with ref_<kind> columns for every kind in ref_kinds
+
+        Args:
+            kind: Normalized kind
+            service: Service (None for namespaces)
+            ref_kinds: Reference kinds the table needs columns for
+
+        Returns:
+            Table
+        """
+        ref_kinds = frozenset(ref_kinds)
+        with self._lock:
+            cached = self._tables.get((kind, service))
+            if cached is not None and ref_kinds <= cached[1]:
+                self.hits += 1
+                return cached[0]
+
+            self.schema_calls += 1
+            started = time.perf_counter()
+            table = get_or_create_table(kind, service, list(ref_kinds))
+            ensure_lookup_index(table)
+            self.schema_seconds += time.perf_counter() - started
+            known = ref_kinds | cached[1] if cached is not None else ref_kinds
+            self._tables[(kind, service)] = (table, known)
+            # A table may now exist under a name an earlier lookup missed
+            self._found = {key: found for key, found in self._found.items() if found is not None}
+            return table
+
+    def find(self, kind, service):
+        """
+        Cached find_table_by_kind_service
+
+        Returns:
+            Table or None if the table doesn't exist
+        """
+        with self._lock:
+            cached = self._tables.get((kind, service))
+            if cached is not None:
+                self.hits += 1
+                return cached[0]
+            if (kind, service) in self._found:
+                self.hits += 1
+                return self._found[(kind, service)]
+
+            self.schema_calls += 1
+            started = time.perf_counter()
+            table = find_table_by_kind_service(kind, service)
+            self.schema_seconds += time.perf_counter() - started
+            self._found[(kind, service)] = table
+            return table
+
+    def invalidate(self, kind=None, service=None):
+        """
+        Forget cached tables: all of them, or only the (kind, service) one when kind is given
+        """
+        with self._lock:
+            if kind is None:
+                dropped = [table for table, _ in self._tables.values()]
+                dropped.extend(table for table in self._found.values() if table is not None)
+                self._tables.clear()
+                self._found.clear()
+            else:
+                cached = self._tables.pop((kind, service), None)
+                found = self._found.pop((kind, service), None)
+                dropped = [table for table in (cached[0] if cached else None, found) if table is not None]
+            for table in dropped:
+                _lookup_indexed_tables.discard(table.name)
+
+
+table_registry = TableRegistry()
+
+
+def _skipped_object(obj, kind, service, error_type, error_message):
+    """Keyword arguments for save_to_d2_skipped_data describing a failed object"""
+    return dict(
+        key=obj.key,
+        kind=kind,
+        service=service,
+        name=obj.name,
+        uid=obj.uid,
+        namespace=obj.namespace,
+        tenant=obj.tenant,
+        error_type=error_type,
+        error_message=error_message,
+        size_bytes=obj.size
+    )
+
+
+def load_group_rows(kind, service, objects, ref_kinds, chunk_size=DEFAULT_WRITE_CHUNK_SIZE,
+                    reference_cache=None, use_copy=False):
+    """
+    Phase 1 for one (kind, service) group: create or get its table and upsert the objects
+
+    Args:
+        kind: Normalized kind of the group
+        service: Service of the group (None for namespaces)
+        objects: D2Object records of the group
+        ref_kinds: Reference kinds the table needs ref_<kind> columns for
+        chunk_size: Maximum number of rows committed per transaction
+        reference_cache: Optional ReferenceResolutionCache that learns the written objects
+        use_copy: Load through PostgreSQL COPY (see bulk_upsert_rows)
+
+    Returns:
+        GroupWriteResult
+    """
+    skipped = []
+
+    # Create or get table with service-aware naming
+    try:
+        table = table_registry.get_or_create(kind, service, ref_kinds)
+    except Exception as e:
+        logger.error(f"Failed to create/get table for kind {kind}, service {service or 'default'}: {e}")
+        # Mark all objects of this kind/service as failed
+        for obj in objects:
+            skipped.append(_skipped_object(obj, kind, service, "table_creation_error", str(e)))
+        return GroupWriteResult(0, skipped)
+
+    # Build one row per uid; a later copy of the same uid replaces the earlier one,
+    # matching what the sequential writes used to leave in the table
+    rows_by_uid = {}
+    copies_by_uid = Counter()
+    for obj in objects:
+        rows_by_uid[obj.uid] = build_d2_row(obj)
+        copies_by_uid[obj.uid] += 1
+
+    failed_uids = set()
+
+    def record_error(row, e):
+        logger.error(f"Error processing object {kind}/{row['name']} (service: {service or 'default'}): {e}")
+        failed_uids.add(row['uid'])
+        skipped.append(dict(
+            key=row['raw_key'],
+            kind=kind,
+            service=service,
+            name=row['name'],
+            uid=row['uid'],
+            namespace=row['namespace'],
+            tenant=row['tenant'],
+            error_type="database_error",
+            error_message=str(e),
+            size_bytes=row['size_bytes']
+        ))
+
+    # Upsert all objects of this kind+service in chunked transactions
+    bulk_upsert_rows(table, list(rows_by_uid.values()), chunk_size=chunk_size, on_row_error=record_error,
+                     use_copy=use_copy)
+
+    written = len(objects) - sum(copies_by_uid[uid] for uid in failed_uids)
+    if reference_cache is not None:
+        for uid, row in rows_by_uid.items():
+            if uid not in failed_uids:
+                reference_cache.put(kind, service, row['name'], row['namespace'], row['tenant'], uid)
+    logger.info(f"Phase 1 - Wrote {written} objects to '{table.name}'")
+    return GroupWriteResult(written, skipped)
+
+
+class ReferenceResolutionCache:
+    """
+    Bounded LRU of (kind, service, name, namespace, tenant) -> uid shared across batches
+
+    Entries come from Phase 1 writes and from reference lookups. Each entry describes the
+    row with exactly that tenant (None for tenant-less rows), so a reference with a tenant
+    is answered from its own entry, falling back to the tenant-less one as the database
+    lookup does. Lookups that find nothing are cached as absent entries until the object
+    is written, unless cache_misses is False.
+    """
+    _ABSENT = object()
+
+    def __init__(self, max_entries=DEFAULT_REFERENCE_CACHE_SIZE, cache_misses=True):
+        self.max_entries = max_entries
+        self.cache_misses = cache_misses
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(kind, service, name, namespace, tenant):
+        # Namespaces live in one common table whatever service refers to them
+        scope = None if kind.lower() == 'namespace' else service
+        return (kind, scope, name, namespace, tenant or None)
+
+    def _store(self, key, value, replace=True):
+        if not replace and key in self._entries:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, kind, service, name, namespace, tenant, uid):
+        """Record a written object; replaces an absent entry for the same key"""
+        with self._lock:
+            self._store(self._key(kind, service, name, namespace, tenant), uid)
+
+    def resolve(self, kind, service, name, namespace, tenant):
+        """
+        Answer a reference lookup from the cache
+
+        Returns:
+            tuple: (found, uid) - found is False when the database has to be asked;
+            uid is None when the reference is known not to resolve
+        """
+        with self._lock:
+            value = None
+            if tenant:
+                value = self._lookup(self._key(kind, service, name, namespace, tenant))
+                if value is None:
+                    self.misses += 1
+                    return False, None
+            if value is None or value is self._ABSENT:
+                value = self._lookup(self._key(kind, service, name, namespace, None))
+                if value is None:
+                    self.misses += 1
+                    return False, None
+            if value is self._ABSENT:
+                self.negative_hits += 1
+                return True, None
+            self.hits += 1
+            return True, value
+
+    def record_lookup(self, kind, service, refs, uid_map):
+        """
+        Cache the outcome of a database lookup
+
+        Args:
+            kind: Referenced kind
+            service: Service whose tables were searched
+            refs: References that were looked up
+            uid_map: (name, namespace, tenant or None) -> uid as returned by the lookup
+        """
+        with self._lock:
+            for ref in refs:
+                name, namespace, tenant = ref.get('name'), ref.get('namespace'), ref.get('tenant') or None
+                for exact in {tenant, None}:
+                    uid = uid_map.get((name, namespace, exact))
+                    if uid:
+                        self._store(self._key(kind, service, name, namespace, exact), uid)
+                    elif self.cache_misses:
+                        self._store(self._key(kind, service, name, namespace, exact), self._ABSENT, replace=False)
+
+    def stats(self):
+        """Hit/miss counters, the hit rate over all lookups and the current size"""
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+
+_TUPLE_IN_DIALECTS = ('postgresql', 'mysql', 'mariadb', 'sqlite')
+
+
+def _select_uids_by_name(session, table, refs, chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE):
+    """
+    Fetch the uids of the rows matching the given references' name/namespace/tenant
+
+    Each distinct key is looked up once, in chunks of tuple IN lists that the
+    (name, namespace, tenant) index answers directly. References with a tenant match
+    on all three columns; every key is also matched against tenant-less rows, which
+    is the fallback used when no tenant-specific row exists.
+
+    Args:
+        session: Open session
+        table: Table of the referenced kind
+        refs: Reference dicts with name and namespace set
+        chunk_size: Maximum number of keys per query
+
+    Returns:
+        dict: (name, namespace, tenant or None) -> uid
+    """
+    tenant_keys = list(dict.fromkeys(
+        (ref['name'], ref['namespace'], ref.get('tenant')) for ref in refs if ref.get('tenant')
+    ))
+    name_keys = list(dict.fromkeys((ref['name'], ref['namespace']) for ref in refs))
+    columns = (table.c.name, table.c.namespace, table.c.tenant, table.c.uid)
+    use_tuple_in = session.get_bind().dialect.name in _TUPLE_IN_DIALECTS
+
+    def _key_filter(key_columns, keys):
+        if use_tuple_in:
+            return tuple_(*key_columns).in_(keys)
+        return or_(*(and_(*(col == value for col, value in zip(key_columns, key))) for key in keys))
+
+    uid_map = {}
+    for key_columns, keys, extra in (
+        ((table.c.name, table.c.namespace, table.c.tenant), tenant_keys, None),
+        ((table.c.name, table.c.namespace), name_keys, or_(table.c.tenant.is_(None), table.c.tenant == '')),
+    ):
+        for start in range(0, len(keys), chunk_size):
+            condition = _key_filter(key_columns, keys[start:start + chunk_size])
+            if extra is not None:
+                condition = and_(condition, extra)
+            for name, namespace, tenant, uid in session.execute(select(*columns).where(condition)):
+                uid_map[(name, namespace, tenant or None)] = uid
+    return uid_map
+
+
+def lookup_reference_uids(kind, service, objects, reference_cache=None):
+    """
+    Fill in the uid of references that only carry name/namespace, by looking them up
+    in the referenced kind's table. References are updated in place.
+
+    Args:
+        kind: Normalized kind of the referring group
+        service: Service of the referring group; lookups use this service's tables
+        objects: D2Object records whose references should be resolved
+        reference_cache: Optional ReferenceResolutionCache consulted before the database
+    """
+    all_refs = []
+    for obj in objects:
+        all_refs.extend(obj.references)
+
+    # Only process refs without UIDs but with name/namespace
+    refs_missing_uid = [
+        ref for ref in all_refs 
+        if not ref.get('uid') and ref.get('name') and ref.get('namespace') and ref.get('kind')
+    ]
+    if not refs_missing_uid:
+        return
+
+    logger.info(f"Looking up UIDs for {len(refs_missing_uid)} references for kind '{kind}' in service '{service or 'default'}'")
+    resolve_reference_uids(service, refs_missing_uid, reference_cache)
+
+
+def resolve_reference_uids(service, refs, reference_cache=None):
+    """
+    Look up the uid of each reference by name/namespace/tenant in the referenced kind's
+    table of the given service (the common table for namespaces). References are updated
+    in place; those that can't be resolved keep their empty uid.
+
+    Args:
+        service: Service whose tables are searched
+        refs: Reference dicts with kind, name and namespace set
+        reference_cache: Optional ReferenceResolutionCache consulted before the database
+    """
+    # Group references by kind for efficient batch lookup
+    refs_by_kind = {}
+    for ref in refs:
+        ref_kind = ref.get('kind')
+        if ref_kind not in refs_by_kind:
+            refs_by_kind[ref_kind] = []
+        refs_by_kind[ref_kind].append(ref)
+
+    # Look up UIDs in batches by kind
+    session = Session()
+    try:
+        for ref_kind, refs in refs_by_kind.items():
+            # Skip if no references to look up
+            if not refs:
+                continue
+                
+            # Answer what the resolution cache already knows; only the rest goes to the database
+            if reference_cache is not None:
+                pending = []
+                for ref in refs:
+                    found, uid = reference_cache.resolve(ref_kind, service, ref.get('name'),
+                                                         ref.get('namespace'), ref.get('tenant'))
+                    if not found:
+                        pending.append(ref)
+                    elif uid:
+                        ref['uid'] = uid
+                refs = pending
+                if not refs:
+                    continue
+
+            # Special case for namespace - use common table
+            if ref_kind.lower() == 'namespace':
+                table = table_registry.find('namespace', None)
+            else:
+                # Always use the current service's table for lookups
+                table = table_registry.find(ref_kind, service)
+            
+            if table is None:
+                logger.warning(f"Table not found for '{ref_kind}' in service '{service or 'default'}'")
+                continue
+            
+            try:
+                uid_map = _select_uids_by_name(session, table, refs)
+                if reference_cache is not None:
+                    reference_cache.record_lookup(ref_kind, service, refs, uid_map)
+                
+                # Update references with UIDs
+                for ref in refs:
+                    name = ref.get('name')
+                    namespace = ref.get('namespace')
+                    tenant = ref.get('tenant')
                     
-                    # Also check for kubernetes in any labels or annotations
-                    if not has_kubernetes and isinstance(metadata, dict):
-                        if isinstance(metadata.get('labels'), dict):
-                            for k, v in metadata.get('labels', {}).items():
-                                if 'kubernetes' in str(k).lower() or 'kubernetes' in str(v).lower():
-                                    has_kubernetes = True
-                                    break
-                        
-                        if not has_kubernetes and isinstance(metadata.get('annotations'), dict):
-                            for k, v in metadata.get('annotations', {}).items():
-                                if 'kubernetes' in str(k).lower() or 'kubernetes' in str(v).lower():
-                                    has_kubernetes = True
-                                    break
+                    # Try with tenant first, then without
+                    key_with_tenant = (name, namespace, tenant)
+                    key_without_tenant = (name, namespace, None)
                     
-                    if has_kubernetes:
-                        namespace = 'system'
-                        logger.info(f"Setting default namespace 'system' for kubernetes-related object: {key}")
-                        fixed_namespace_this_item = True
-
-                # Set a default tenant namespace if there's a tenant in system_metadata
-                if not namespace and system_metadata and 'tenant' in system_metadata and system_metadata['tenant']:
-                    tenant_value = system_metadata['tenant']
-                    namespace = f"tenant-{tenant_value}"
-                    logger.info(f"Setting tenant namespace '{namespace}' based on tenant: {tenant_value}")
-                    fixed_namespace_this_item = True
+                    if key_with_tenant in uid_map:
+                        ref['uid'] = uid_map[key_with_tenant]
+                    elif key_without_tenant in uid_map:
+                        ref['uid'] = uid_map[key_without_tenant]
+                    else:
+                        logger.debug(f"No match found for {ref_kind}/{name}/{namespace} in service '{service or 'default'}'")
             
-            # Increment global counter if fixed
-            if fixed_namespace_this_item:
-                total_fixed_namespace_items += 1
-                batch_fixed_namespace_items_counter += 1
-
-            # Still missing namespace after fix attempts?
-            if not namespace:
-                logger.warning(f"Still missing namespace after fix attempts for item #{global_item_index}: {key}")
-                batch_skipped_items_counter += 1
-                error_records[key] = {
-                    "value": value,
-                    "error": "Still missing namespace after fix attempts",
-                    "metadata": metadata,
-                    "system_metadata": system_metadata,
-                    "item_index": global_item_index
-                }
+            except Exception as e:
+                logger.error(f"Error looking up UIDs for {ref_kind} in service '{service or 'default'}': {e}")
+                continue
                 
-                # Use helper function to save to D2SkippedData
-                save_to_d2_skipped_data(
-                    key=key,
-                    kind=normalized_kind,
-                    service=service,
-                    name=name,
-                    uid=uid,
-                    tenant=tenant,
-                    error_type="missing_namespace",
-                    error_message="Still missing namespace after fix attempts",
-                    size_bytes=size
+    except Exception as e:
+        logger.error(f"Error in reference lookup: {e}")
+    finally:
+        session.close()
+
+
+def write_group_references(kind, service, objects, ref_kinds, namespace_cache,
+                           chunk_size=DEFAULT_WRITE_CHUNK_SIZE, reference_cache=None, deferred=None,
+                           use_copy=False):
+    """
+    Phase 2 for one (kind, service) group: resolve missing reference UIDs and write the
+    ref_<kind> columns of every object in the group
+
+    Args:
+        kind: Normalized kind of the group
+        service: Service of the group (None for namespaces)
+        objects: D2Object records of the group (already written by Phase 1)
+        ref_kinds: Reference kinds expected for this table
+        namespace_cache: (name, tenant) -> uid of known namespaces
+        chunk_size: Maximum number of rows committed per transaction
+        reference_cache: Optional ReferenceResolutionCache used for the UID lookups
+        deferred: Optional DeferredReferenceQueue receiving the references left without a uid
+        use_copy: Stage the reference columns through PostgreSQL COPY (see bulk_update_references)
+
+    Returns:
+        GroupWriteResult
+    """
+    skipped = []
+    item_events = Counter()
+
+    # Look up UIDs for references without them
+    lookup_started = time.perf_counter()
+    lookup_reference_uids(kind, service, objects, reference_cache)
+    lookup_seconds = time.perf_counter() - lookup_started
+
+    # Ensure table exists before attempting to update references
+    try:
+        table = table_registry.get_or_create(kind, service, ref_kinds)
+    except Exception as e:
+         logger.error(f"Failed to get/create table for reference update (kind={kind}, service={service}): {e}")
+         # Skip updating references for these objects if table is problematic
+         return GroupWriteResult(0, skipped, lookup_seconds, item_events)
+
+    ref_rows_by_uid = {}  # uid -> {'uid': ..., 'ref_<kind>': [...]}
+    objects_by_uid = {}
+
+    for obj in objects:
+        uid = obj.uid
+        name = obj.name
+        namespace_name = obj.namespace
+        tenant = obj.tenant
+
+        try:
+            # Group references by kind
+            refs_by_kind = {}
+            for ref in obj.references:
+                ref_kind = ref.get('kind')
+                # Ensure the reference kind is valid and expected for this table
+                if ref_kind and ref_kind != kind and ref_kind in ref_kinds:
+                    if ref_kind not in refs_by_kind:
+                        refs_by_kind[ref_kind] = []
+                    refs_by_kind[ref_kind].append(ref)
+            
+            # Special handling for namespace reference
+            # Make sure every object references its namespace
+            if kind != 'namespace' and 'namespace' in ref_kinds:
+                # Check if we already have a namespace reference
+                has_namespace_ref = 'namespace' in refs_by_kind and any(
+                    ref.get('uid') for ref in refs_by_kind['namespace']
                 )
                 
+                if not has_namespace_ref:
+                    # Look up the namespace UID from the cache
+                    cache_key = (namespace_name, tenant) if tenant else (namespace_name, None)
+                    namespace_uid = namespace_cache.get(cache_key)
+                    
+                    # Try without tenant if not found
+                    if not namespace_uid and tenant:
+                        cache_key = (namespace_name, None)
+                        namespace_uid = namespace_cache.get(cache_key)
+                    
+                    if not namespace_uid and deferred is not None:
+                        deferred.add(kind, service, uid, 'namespace', namespace_name, 'system', tenant)
+                    elif namespace_uid:
+                        # Add namespace reference
+                        if 'namespace' not in refs_by_kind:
+                            refs_by_kind['namespace'] = []
+                        
+                        refs_by_kind['namespace'].append({
+                            'kind': 'namespace',
+                            'name': namespace_name,
+                            'namespace': 'system',
+                            'uid': namespace_uid,
+                            'tenant': tenant,
+                            'service': None  # Namespaces use common table with no service
+                        })
+                    else:
+                        log_item_event(item_events, 'namespace_uid_not_found',
+                                       "Could not find UID for namespace %s (tenant: %s) for object %s",
+                                       namespace_name, tenant, uid)
+            
+            # Prepare updates for each reference kind
+            updates = {}
+            for ref_kind, refs in refs_by_kind.items():
+                ref_uids = []
+                
+                for ref in refs:
+                    ref_uid = ref.get('uid')
+                    if ref_uid and ref_uid not in ref_uids:
+                        ref_uids.append(ref_uid)
+                    elif not ref_uid and deferred is not None and ref.get('name') and ref.get('namespace'):
+                        # The target may arrive in a later batch; resolve it after the last one
+                        deferred.add(kind, service, uid, ref_kind, ref['name'], ref['namespace'], ref.get('tenant'))
+                
+                if ref_uids:
+                    # Add the reference UIDs to our updates as a simple array
+                    ref_col = f"ref_{ref_kind.lower()}"
+                    # Ensure the column exists in the table before trying to update
+                    if ref_col in table.c:
+                        updates[ref_col] = ref_uids
+                    else:
+                        log_item_event(item_events, 'reference_column_missing',
+                                       "Reference column '%s' not found in table '%s' for object %s. Skipping update.",
+                                       ref_col, table.name, uid)
+
+            # Queue the record's reference columns; a later copy of the same uid
+            # overrides the columns it also sets, as sequential updates would
+            if updates:
+                ref_rows_by_uid.setdefault(uid, {'uid': uid}).update(updates)
+                objects_by_uid[uid] = obj
+                        
+        except Exception as e:
+            logger.error(f"Error processing references for {kind}/{name} (service: {service or 'default'}, uid: {uid}): {e}")
+            skipped.append(_skipped_object(obj, kind, service, "reference_processing_error", str(e)))
+
+    if not ref_rows_by_uid:
+        return GroupWriteResult(0, skipped, lookup_seconds, item_events)
+
+    def record_error(row, e):
+        obj = objects_by_uid[row['uid']]
+        logger.error(f"Error updating references for {kind}/{obj.name} (service: {service or 'default'}, uid: {obj.uid}): {e}")
+        skipped.append(_skipped_object(obj, kind, service, "reference_update_error", str(e)))
+
+    # One executemany UPDATE per column set for the whole group, in chunked transactions
+    written = bulk_update_references(
+        table, list(ref_rows_by_uid.values()), chunk_size=chunk_size, on_row_error=record_error,
+        use_copy=use_copy
+    )
+    logger.info(f"Phase 2 - Updated references for {written} objects in '{table.name}'")
+    return GroupWriteResult(written, skipped, lookup_seconds, item_events)
+
+
+class DeferredResolutionResult(NamedTuple):
+    """Outcome of the final pass over the deferred reference queue"""
+    resolved: int    # Queued references that now have a uid
+    unresolved: int  # Queued references whose target still doesn't exist
+    updated: int     # Rows whose ref_<kind> columns were rewritten
+
+
+def resolve_deferred_references(deferred, namespace_cache=None, reference_cache=None,
+                                chunk_size=DEFAULT_WRITE_CHUNK_SIZE,
+                                resolve_chunk=DEFAULT_DEFERRED_RESOLVE_CHUNK):
+    """
+    Final pass: resolve the queued references now that every batch has been written and
+    merge the found uids into the owners' existing ref_<kind> columns
+
+    The queue is processed resolve_chunk entries at a time. Within a chunk, lookups are
+    made per (referenced kind, service) with the set-based UID lookup, the owners' current
+    reference columns are read with one query per chunk of uids, and the merged columns
+    are written back with the bulk reference writer.
+
+    Args:
+        deferred: DeferredReferenceQueue filled by write_group_references
+        namespace_cache: (name, tenant) -> uid of known namespaces, tried first for namespaces
+        reference_cache: Optional ReferenceResolutionCache used for the UID lookups
+        chunk_size: Maximum number of rows committed per transaction
+        resolve_chunk: Number of queued references handled together
+
+    Returns:
+        DeferredResolutionResult
+    """
+    namespace_cache = namespace_cache or {}
+    resolved = unresolved = updated = 0
+
+    for entries in deferred.iter_chunks(resolve_chunk):
+        # One reference dict per distinct target and lookup scope
+        refs = {}
+        for entry in entries:
+            target = (entry.ref_kind, entry.service, entry.name, entry.namespace, entry.tenant)
+            if target not in refs:
+                refs[target] = {
+                    'kind': entry.ref_kind, 'name': entry.name, 'namespace': entry.namespace,
+                    'tenant': entry.tenant, 'uid': None,
+                }
+
+        refs_by_service = {}
+        for (ref_kind, service, name, _, tenant), ref in refs.items():
+            if ref_kind == 'namespace':
+                ref['uid'] = namespace_cache.get((name, tenant or None)) or namespace_cache.get((name, None))
+            if not ref['uid']:
+                refs_by_service.setdefault(service, []).append(ref)
+        for service, service_refs in refs_by_service.items():
+            resolve_reference_uids(service, service_refs, reference_cache)
+
+        # Resolved uids per owner row, in queue order
+        found_by_table = {}
+        for entry in entries:
+            ref_uid = refs[(entry.ref_kind, entry.service, entry.name, entry.namespace, entry.tenant)]['uid']
+            if not ref_uid:
+                unresolved += 1
+                continue
+            resolved += 1
+            owner_refs = found_by_table.setdefault((entry.kind, entry.service), {}).setdefault(entry.owner_uid, {})
+            owner_refs.setdefault(f"ref_{entry.ref_kind.lower()}", []).append(ref_uid)
+
+        for (kind, service), found_by_owner in found_by_table.items():
+            updated += _merge_reference_columns(kind, service, found_by_owner, chunk_size)
+
+    return DeferredResolutionResult(resolved, unresolved, updated)
+
+
+def _merge_reference_columns(kind, service, found_by_owner, chunk_size):
+    """
+    Append resolved uids to the ref_<kind> columns of existing rows of one table
+
+    Args:
+        kind: Owner kind
+        service: Owner service
+        found_by_owner: owner uid -> {ref column: [uid, ...]}
+        chunk_size: Maximum number of rows read or committed per transaction
+
+    Returns:
+        int: Number of rows updated
+    """
+    table = table_registry.find(kind, service)
+    if table is None:
+        logger.warning(f"Table not found for '{kind}' in service '{service or 'default'}'; "
+                       f"{len(found_by_owner)} objects keep their unresolved references")
+        return 0
+
+    columns = sorted({col for found in found_by_owner.values() for col in found if col in table.c})
+    if not columns:
+        return 0
+
+    rows = []
+    owner_uids = list(found_by_owner)
+    session = Session()
+    try:
+        for start in range(0, len(owner_uids), chunk_size):
+            chunk = owner_uids[start:start + chunk_size]
+            stmt = select(table.c.uid, *(table.c[col] for col in columns)).where(table.c.uid.in_(chunk))
+            for existing in session.execute(stmt):
+                current = dict(zip(columns, existing[1:]))
+                row = {'uid': existing[0]}
+                for col, ref_uids in found_by_owner[existing[0]].items():
+                    if col not in table.c:
+                        continue
+                    merged = list(current.get(col) or [])
+                    for ref_uid in ref_uids:
+                        if ref_uid not in merged:
+                            merged.append(ref_uid)
+                    if merged != (current.get(col) or []):
+                        row[col] = merged
+                if len(row) > 1:
+                    rows.append(row)
+    except Exception as e:
+        logger.error(f"Error reading reference columns of '{table.name}' for the deferred pass: {e}")
+        return 0
+    finally:
+        session.close()
+
+    def record_error(row, e):
+        logger.error(f"Error merging deferred references into {kind} {row['uid']} (service: {service or 'default'}): {e}")
+
+    written = bulk_update_references(table, rows, chunk_size=chunk_size, on_row_error=record_error)
+    logger.info(f"Deferred pass - Updated references for {written} objects in '{table.name}'")
+    return written
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB, or None where resource isn't available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS, KiB elsewhere
+
+
+class PipelineMetrics:
+    """
+    Per-batch and per-phase metrics of a run
+
+    Phase wall times are measured with phase(); time spent inside the phases (reference
+    extraction, table DDL, UID lookups) is added with add_time(). Every SQL statement the
+    engine executes while attached is counted with its latency. At the end of each batch a
+    record is emitted to the callback and/or appended to a JSON-lines file; summary()
+    returns the totals for the whole run.
+    """
+    # Upper bounds (ms) of the statement latency histogram buckets
+    LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self, callback=None, jsonl_path=None):
+        self.callback = callback
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._run_started = time.perf_counter()
+        self._attached = None
+        self.run_phases = Counter()
+        self.run_statements = 0
+        self.run_statement_seconds = 0.0
+        self.run_latency = Counter()
+        self.rows_by_group = Counter()  # (kind, service) -> rows written in Phase 1
+        self.item_events = Counter()    # log_item_event counts, including repair rule hits
+        self.batches = 0
+        self._begin_batch_counters()
+
+    def _begin_batch_counters(self):
+        self._batch_started = time.perf_counter()
+        self.batch_phases = Counter()
+        self.batch_statements = 0
+        self.batch_latency = Counter()
+
+    def _latency_bucket(self, seconds):
+        ms = seconds * 1000
+        for bound in self.LATENCY_BUCKETS_MS:
+            if ms <= bound:
+                return f"<={bound}ms"
+        return f">{self.LATENCY_BUCKETS_MS[-1]}ms"
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['d2_metrics_started'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('d2_metrics_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        bucket = self._latency_bucket(elapsed)
+        with self._lock:
+            self.batch_statements += 1
+            self.batch_latency[bucket] += 1
+            self.run_statements += 1
+            self.run_statement_seconds += elapsed
+            self.run_latency[bucket] += 1
+
+    def attach(self, bind):
+        """Start counting the statements executed through bind (an Engine)"""
+        event.listen(bind, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(bind, 'after_cursor_execute', self._after_cursor_execute)
+        self._attached = bind
+
+    def detach(self):
+        """Stop counting statements"""
+        if self._attached is not None:
+            event.remove(self._attached, 'before_cursor_execute', self._before_cursor_execute)
+            event.remove(self._attached, 'after_cursor_execute', self._after_cursor_execute)
+            self._attached = None
+
+    @contextmanager
+    def attached(self, bind):
+        """Count the statements executed through bind while the block runs, even if it raises"""
+        self.attach(bind)
+        try:
+            yield self
+        finally:
+            self.detach()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the wall time of a block as phase name of the current batch"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        """Add seconds to phase name (may be summed over threads or worker processes)"""
+        with self._lock:
+            self.batch_phases[name] += seconds
+            self.run_phases[name] += seconds
+
+    def add_group_rows(self, kind, service, rows):
+        with self._lock:
+            self.rows_by_group[(kind, service)] += rows
+
+    def emit(self, record):
+        """Hand a record to the callback and append it to the JSON-lines file"""
+        if self.callback is not None:
+            try:
+                self.callback(record)
+            except Exception as e:
+                logger.warning(f"Metrics callback failed: {e}")
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def end_batch(self, batch, items, **counts):
+        """
+        Emit the current batch's record and start counting the next batch
+
+        Args:
+            batch: Batch number (1-based)
+            items: Number of items read in the batch
+            counts: Extra per-batch counts to include (written, skipped, ...)
+        """
+        seconds = time.perf_counter() - self._batch_started
+        with self._lock:
+            record = {
+                'type': 'batch',
+                'batch': batch,
+                'items': items,
+                'seconds': round(seconds, 6),
+                'items_per_sec': round(items / seconds, 1) if seconds else None,
+                'phases': {name: round(value, 6) for name, value in self.batch_phases.items()},
+                'statements': self.batch_statements,
+                'statement_latency': dict(self.batch_latency),
+                'peak_rss_kb': peak_rss_kb(),
+            }
+            record.update(counts)
+            self.item_events.update(counts.get('item_events') or {})
+            self.batches += 1
+            self._begin_batch_counters()
+        self.emit(record)
+        return record
+
+    def summary(self, items, skipped_by_error_type=None):
+        """
+        Totals for the whole run
+
+        Args:
+            items: Number of items read
+            skipped_by_error_type: Counts of skipped items by error type
+        """
+        seconds = time.perf_counter() - self._run_started
+        with self._lock:
+            return {
+                'type': 'summary',
+                'batches': self.batches,
+                'items': items,
+                'seconds': round(seconds, 6),
+                'items_per_sec': round(items / seconds, 1) if seconds else None,
+                'phases': {name: round(value, 6) for name, value in self.run_phases.items()},
+                'statements': self.run_statements,
+                'statement_seconds': round(self.run_statement_seconds, 6),
+                'statement_latency': dict(self.run_latency),
+                'rows_by_group': [
+                    {'kind': kind, 'service': service, 'rows': rows}
+                    for (kind, service), rows in sorted(self.rows_by_group.items(), key=lambda item: -item[1])
+                ],
+                'skipped_by_error_type': dict(skipped_by_error_type or {}),
+                'item_events': dict(self.item_events),
+                'peak_rss_kb': peak_rss_kb(),
+            }
+
+
+def write_checkpoint(path, state):
+    """
+    Atomically replace the checkpoint file at path with state
+
+    The JSON is written to a temporary file next to it, synced and then moved into place,
+    so a crash leaves either the previous or the new checkpoint, never a partial one.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    """
+    Load a checkpoint written by write_checkpoint
+
+    Returns:
+        dict or None if there is no usable checkpoint at path
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if state.get('version') != CHECKPOINT_VERSION:
+        logger.warning(f"Ignoring checkpoint {path} with unsupported version {state.get('version')}")
+        return None
+    return state
+
+
+def _is_in_memory_sqlite(bind):
+    """True if bind is an in-memory SQLite database, which exists only on its own connection"""
+    return bind.dialect.name == 'sqlite' and bind.url.database in (None, '', ':memory:')
+
+
+def engine_pool_capacity():
+    """
+    Number of connections the D2 engine's pool keeps open, or None if it has no fixed size
+
+    An in-memory SQLite database and the single-connection pools (StaticPool shares one
+    connection between threads, SingletonThreadPool opens one per thread, each with its own
+    empty in-memory database) only ever allow one writer.
+
+    Returns:
+        int or None
+    """
+    if _is_in_memory_sqlite(engine) or isinstance(engine.pool, (StaticPool, SingletonThreadPool)):
+        return 1
+    size = getattr(engine.pool, 'size', None)
+    if callable(size):
+        size = size()
+    return size if isinstance(size, int) and size > 0 else None
+
+
+def _relaxed_durability_statements(bind):
+    """Per-connection statements that trade durability for write speed on bind's dialect"""
+    if bind.dialect.name == 'sqlite':
+        return ["PRAGMA synchronous=OFF"]
+    if bind.dialect.name == 'postgresql':
+        return ["SET synchronous_commit TO off"]
+    return []
+
+
+def _deferrable_indexes(bind):
+    """
+    Non-unique secondary indexes of the kind tables that can be dropped and rebuilt
+
+    The reference lookup index (see ensure_lookup_index) is kept, since Phase 2 reads
+    through it during the load; expression indexes are left alone.
+
+    Returns:
+        list: Detached Index objects, bound to copies of their tables
+    """
+    skip_tables = {D2SkippedData.__tablename__, load_state_table.name}
+    inspector = inspect(bind)
+    indexes = []
+    for table in get_all_tables():
+        if table.name in skip_tables or not inspector.has_table(table.name):
+            continue
+        copy = None
+        for reflected in inspector.get_indexes(table.name):
+            columns = reflected.get('column_names') or []
+            if (reflected.get('unique') or not reflected.get('name') or not columns or None in columns
+                    or reflected['name'] == _index_name(table.name, 'name_ns_tenant')
+                    or not all(col in table.c for col in columns)):
                 continue
-                
-            # Find all references in the object (do this only once)
-            references = find_references(value, service)
-            
-            # Extract reference kinds for table schema generation
-            ref_kinds = set()
-            for ref in references:
-                ref_kind = ref.get('kind')  # This is already normalized by find_references
-                if ref_kind and ref_kind != normalized_kind:  # Don't include self-references by kind
-                    ref_kinds.add(ref_kind)
-            
-            # Always add namespace reference for non-namespace objects
-            if not is_namespace:
-                ref_kinds.add('namespace')
-            
-            # Update kind_service_references - use kind+service as the key
-            kind_service_key = (normalized_kind, service)
-            if kind_service_key not in kind_service_references:
-                kind_service_references[kind_service_key] = set()
-            kind_service_references[kind_service_key].update(ref_kinds)
-            
-            # Store object info - grouped by kind+service
-            if kind_service_key not in objects_by_kind_service:
-                objects_by_kind_service[kind_service_key] = []
-                
-            objects_by_kind_service[kind_service_key].append({
-                'key': key,
-                'uid': uid,
-                'name': name,
-                'namespace': namespace,
-                'tenant': tenant,
-                'service': service,
-                'value': value,
-                'size': size,
-                'original_kind': original_kind,
-                'references': references  # Store references to avoid re-extraction
-            })
-        
-        # Log progress for this batch
-        logger.info(f"Batch {batch_num+1}: Found {len(objects_by_kind_service)} different kind-service combinations")
-        logger.info(f"Batch {batch_num+1}: Fixed {batch_fixed_namespace_items_counter} items with missing namespace")
-        logger.info(f"Batch {batch_num+1}: Fixed {batch_fixed_name_uid_items_counter} items with missing name/UID")
-        logger.info(f"Batch {batch_num+1}: Skipped {batch_skipped_items_counter} items in pre-processing")
-
-        # Phase 1: Create tables and load data for this batch
-        logger.info(f"Batch {batch_num+1}: Phase 1 - Creating tables and loading data...")
+            if copy is None:
+                copy = Table(table.name, MetaData(), *(Column(col.name, col.type) for col in table.c))
+            indexes.append(Index(reflected['name'], *(copy.c[col] for col in columns)))
+    return indexes
+
+
+@contextmanager
+def bulk_load_mode(bind=None):
+    """
+    Bulk-load session for a full migration: relaxed durability and deferred index builds
+
+    While the block runs:
+      - SQLite runs in WAL journal mode with synchronous=OFF; PostgreSQL sessions use
+        synchronous_commit=off (a crash may lose the last commits, never corrupt data)
+      - non-unique secondary indexes of existing kind tables (except the reference lookup
+        index) are dropped
+    On exit, whether or not the block raised, the indexes are rebuilt, the journal mode is
+    restored and pooled connections are discarded so none keeps the relaxed settings. If
+    the process dies inside the block the dropped indexes are listed in the log.
+
+    Args:
+        bind: Engine to tune (the D2 engine by default)
+    """
+    bind = bind if bind is not None else engine
+    statements = _relaxed_durability_statements(bind)
+    in_memory = _is_in_memory_sqlite(bind)
+    if in_memory:
+        statements = []  # Nothing to make durable, and disposing the pool would drop the database
+
+    def relax(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        dbapi_connection.commit()  # SET is transactional on PostgreSQL
+
+    previous_journal_mode = None
+    if bind.dialect.name == 'sqlite' and not in_memory:
+        with bind.connect() as conn:
+            previous_journal_mode = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    if statements:
+        event.listen(bind, 'connect', relax)
+        bind.dispose()  # Pooled connections were opened without the settings
+
+    dropped = []
+    try:
+        for index in _deferrable_indexes(bind):
+            try:
+                index.drop(bind=bind)
+                dropped.append(index)
+            except Exception as e:
+                logger.warning(f"Could not drop index '{index.name}' on '{index.table.name}' for the bulk load: {e}")
+        if dropped:
+            logger.info(f"Bulk load: dropped {len(dropped)} secondary indexes, rebuilt after the load: "
+                        + ", ".join(f"{index.table.name}.{index.name}" for index in dropped))
+        yield
+    finally:
+        if statements:
+            event.remove(bind, 'connect', relax)
+            bind.dispose()
+        for index in dropped:
+            started = time.perf_counter()
+            try:
+                index.create(bind=bind, checkfirst=True)
+                logger.info(f"Bulk load: rebuilt index '{index.name}' on '{index.table.name}' "
+                            f"in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                logger.error(f"Failed to rebuild index '{index.name}' on '{index.table.name}': {e}")
+        if previous_journal_mode and previous_journal_mode.lower() != 'wal':
+            try:
+                with bind.connect() as conn:
+                    conn.exec_driver_sql(f"PRAGMA journal_mode={previous_journal_mode}")
+            except Exception as e:
+                logger.error(f"Failed to restore SQLite journal_mode={previous_journal_mode}: {e}")
+
+
+def schedule_groups(group_keys, kind_service_references):
+    """
+    Order (kind, service) groups so that referenced kinds are written before the kinds
+    that refer to them, namespaces first
+
+    The dependency graph is kind-level: kind A depends on kind B if any group of A refers
+    to B. Kinds are taken in topological layers, alphabetically within a layer. When only
+    kinds in a cycle are left, the one with the fewest unscheduled dependencies (then the
+    first alphabetically) goes next, so the order never depends on input order. Groups of
+    the same kind follow in service order.
+
+    Args:
+        group_keys: (kind, service) keys of the batch's groups
+        kind_service_references: (kind, service) -> set of reference kinds
+
+    Returns:
+        list: The group keys in write order
+    """
+    group_keys = list(group_keys)
+    kinds = {kind for kind, _ in group_keys}
+    dependencies = {kind: set() for kind in kinds}
+    for (kind, _), ref_kinds in kind_service_references.items():
+        if kind in dependencies:
+            dependencies[kind].update(ref_kind for ref_kind in ref_kinds if ref_kind in kinds and ref_kind != kind)
+
+    rank = {}
+    while len(rank) < len(kinds):
+        remaining = [kind for kind in kinds if kind not in rank]
+        ready = [kind for kind in remaining if all(dep in rank for dep in dependencies[kind])]
+        if not ready:
+            # Break the cycle at the kind closest to being ready
+            ready = [min(remaining, key=lambda kind: (sum(dep not in rank for dep in dependencies[kind]), kind))]
+        for kind in sorted(ready, key=lambda kind: (kind != 'namespace', kind)):
+            rank[kind] = len(rank)
+
+    return sorted(group_keys, key=lambda key: (rank[key[0]], key[1] or ''))
+
+
+def run_group_writers(write_group, groups, pool=None, max_in_flight=1):
+    """
+    Apply write_group to each group, optionally on a thread pool, yielding results in input order
+
+    At most max_in_flight groups are submitted at a time, so a slow group holds back new
+    submissions instead of queueing the whole batch.
+
+    Args:
+        write_group: Callable taking the elements of one group tuple as arguments
+        groups: Iterable of argument tuples
+        pool: Optional concurrent.futures.ThreadPoolExecutor
+        max_in_flight: Maximum number of submitted but not yet consumed groups
+
+    Yields:
+        The result of write_group for each group, in the order of groups
+    """
+    if pool is None:
+        for group in groups:
+            yield write_group(*group)
+        return
+
+    in_flight = deque()
+    for group in groups:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(pool.submit(write_group, *group))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+@contextmanager
+def _optional_thread_pool(workers):
+    """Yield a ThreadPoolExecutor with the given number of workers, or None to run inline"""
+    if not workers or workers <= 1:
+        yield None
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='d2-writer') as pool:
+        yield pool
+
+
+def process_data_to_d2_with_missing_fields_handling(raw_data_list, batch_size=DEFAULT_BATCH_SIZE,
+                                                    write_chunk_size=DEFAULT_WRITE_CHUNK_SIZE,
+                                                    error_store_size=DEFAULT_ERROR_STORE_SIZE,
+                                                    error_spill_path=None,
+                                                    preprocess_workers=None,
+                                                    db_workers=None,
+                                                    reference_cache_size=DEFAULT_REFERENCE_CACHE_SIZE,
+                                                    cache_reference_misses=True,
+                                                    resolve_deferred=True,
+                                                    deferred_spill_path=None,
+                                                    incremental=False,
+                                                    checkpoint_path=None,
+                                                    resume=False,
+                                                    plan_schema=False,
+                                                    use_copy=False,
+                                                    metrics_path=None,
+                                                    metrics_callback=None,
+                                                    pipeline_depth=None,
+                                                    queue_logging=False,
+                                                    coalesce_duplicates=True,
+                                                    bulk_load=False):
+    """
+    Enhanced process to transform data from D1 to D2 with special handling for records
+    with missing namespace or name/UID fields, optimized with batch processing for memory efficiency
+
+    The input is consumed batch_size items at a time, so a generator or a JSON-lines file
+    keeps peak memory proportional to the batch size rather than to the size of the dump.
+
+    Args:
+        raw_data_list: D1 items (dicts with 'key', 'value' and optional size fields) as a list,
+            any iterable, or a path to a JSON-lines file
+        batch_size: Number of items pre-processed and written per batch
+        write_chunk_size: Number of rows committed per transaction by the bulk writers
+        error_store_size: Number of error details kept in memory
+        error_spill_path: Optional JSON-lines file that receives error details beyond error_store_size;
+            emptied first unless the run resumes from a checkpoint
+        preprocess_workers: Number of processes for the pre-processing pass (None or 1 runs it inline);
+            the database phases always run in this process
+        db_workers: Number of threads writing (kind, service) groups concurrently, capped at the
+            engine's connection pool size, and to one on an in-memory SQLite database or a
+            single-connection pool (None or 1 writes groups one after another)
+        reference_cache_size: Number of resolved references remembered across batches so that
+            Phase 2 lookups of already-seen objects skip the database (0 disables the cache)
+        cache_reference_misses: Also remember references that were not found, so repeated lookups
+            of a missing target skip the database until it is written (see ReferenceResolutionCache)
+        resolve_deferred: Queue references whose target isn't written yet and resolve them in a
+            final pass after the last batch, so targets from later batches are still linked
+        deferred_spill_path: Optional JSON-lines file for queued references beyond what is kept
+            in memory (a temporary file is used otherwise)
+        incremental: Only load objects that are new or changed since the last load. The
+            modification timestamp and a content hash of every loaded object are recorded in
+            d2_load_state; objects whose value matches are skipped before reference extraction.
+            Recorded objects missing from a complete run's input are reported as deleted once and
+            dropped from d2_load_state (their D2 rows are kept)
+        checkpoint_path: Optional JSON file updated after every fully committed batch with the
+            number of input records and items done, the namespace cache, the deferred references and the counters.
+            It is removed when the run completes
+        resume: Continue from checkpoint_path, if it exists, skipping the input records already done
+            without parsing them
+        plan_schema: Pre-scan the input and create every table with its final columns and
+            indexes before loading, so no DDL runs during the load (lists and JSON-lines
+            files only; a one-shot iterator can't be scanned twice)
+        use_copy: On PostgreSQL with psycopg2 or psycopg 3, load rows and reference columns by
+            COPY into a temporary staging table followed by one merge statement per chunk;
+            other engines keep the default bulk statements
+        metrics_path: Optional JSON-lines file receiving a metrics record per batch and a summary
+        metrics_callback: Optional callable receiving the same metrics records as dicts
+        pipeline_depth: Read and pre-process up to this many batches ahead in a background
+            thread while the current batch is written (None or 0 runs the batches strictly
+            in sequence); each batch in flight holds its D2Object records in memory
+        queue_logging: Hand log records to the root logger's handlers through a QueueHandler
+            and a listener thread during the load (see queued_log_handlers)
+        coalesce_duplicates: Write one row per (kind, service, uid) and batch: the copy with the
+            latest modification timestamp, with the references of all copies (see
+            PreprocessedBatch.coalesce_duplicates); otherwise the last copy's row is kept
+        bulk_load: Run inside bulk_load_mode(): relaxed durability on the D2 engine and
+            secondary indexes rebuilt after the load (for full migrations)
+
+    Returns:
+        dict: Run totals, the incremental new/changed/unchanged/deleted counts (None unless
+        incremental) and the metrics summary (see PipelineMetrics.summary), or None when
+        there was no input
+    """
+    if bulk_load:
+        # Run this same load inside the bulk-load session
+        arguments = dict(locals(), bulk_load=False)
+        with bulk_load_mode():
+            return process_data_to_d2_with_missing_fields_handling(**arguments)
+
+    # Ensure the D2 database and necessary tables (like d2_skipped_data) are initialized
+    try:
+        init_d2_db() 
+        # Verify d2_skipped_data table exists after init
+        inspector = inspect(engine)
+        if not inspector.has_table(D2SkippedData.__tablename__):
+             logger.error(f"Table '{D2SkippedData.__tablename__}' still does not exist after init_d2_db().")
+             # Optionally raise an error or handle appropriately
+             # raise RuntimeError(f"Failed to create required table: {D2SkippedData.__tablename__}")
+        else:
+             logger.info(f"Table '{D2SkippedData.__tablename__}' confirmed to exist.")
+             
+    except Exception as e:
+        logger.error(f"Failed to initialize D2 database: {e}")
+        # Decide if you want to proceed without the skipped table or stop
+        # return # Example: Stop processing if DB init fails
+
+    # Tables may have been changed since an earlier run in this process
+    table_registry.invalidate()
+
+    if not raw_data_list:
+        logger.warning("No data provided to process_data_to_d2")
+        return
         
-        batch_processed_count = 0 # Counter for successful Phase 1 processing in this batch
+    # The total is only known up front for sized inputs; streams are counted as they are read
+    initial_total_items = None
+    total_batches = None
+    if not isinstance(raw_data_list, (str, os.PathLike)) and hasattr(raw_data_list, '__len__'):
+        initial_total_items = len(raw_data_list) # Store initial count
+        total_batches = (initial_total_items + batch_size - 1) // batch_size  # Ceiling division
+        logger.info(f"Processing {initial_total_items} objects from D1 to D2 with missing fields handling (in {total_batches} batches)")
+    else:
+        logger.info(f"Streaming objects from D1 to D2 with missing fields handling (in batches of {batch_size})")
+    total_received_items = 0
+    
+    # Incremental mode: the keys in this run's input are marked with the run id in
+    # d2_load_state, so deleted objects are those left unmarked at the end
+    load_run_id = uuid.uuid4().hex
+    total_new_items = total_changed_items = total_unchanged_items = 0
+    total_coalesced_items = 0
+    if incremental:
+        ensure_load_state_table()
+        logger.info(f"Incremental mode: {count_load_state()} objects recorded by previous loads")
+
+    # Initialize global tracking data structures (preserved across batches)
+    namespace_cache = {}  # Cache for namespace UIDs by (name, tenant)
+    reference_cache = (ReferenceResolutionCache(reference_cache_size, cache_misses=cache_reference_misses)
+                       if reference_cache_size else None)
+    deferred = None  # Created below, unless restored from the checkpoint
+    deferred_result = None
+    error_records = None  # Key, error type and message only; created below unless restored
+
+    # Global counters for final reporting
+    total_processed_items = 0
+    total_skipped_items = 0 # Renamed from total_error_items for clarity
+    total_fixed_namespace_items = 0
+    total_fixed_name_uid_items = 0
+    skipped_by_error_type = Counter() # Use Counter for easy counting
+
+    # Resume: restore the state saved after the last fully committed batch
+    batches_done = 0
+    records_done = 0  # Input records consumed by the batches done (see iter_raw_data)
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint:
+        batches_done = checkpoint['batches_done']
+        total_received_items = checkpoint['items_done']
+        records_done = checkpoint['records_done']
+        namespace_cache = {(name, tenant): uid for name, tenant, uid in checkpoint['namespace_cache']}
+        if resolve_deferred and checkpoint.get('deferred'):
+            deferred = DeferredReferenceQueue.restore(checkpoint['deferred'])
+        error_records = ErrorRecordStore.restore(checkpoint['error_records'], error_store_size, error_spill_path)
+        counters = checkpoint['counters']
+        total_processed_items = counters['processed']
+        total_skipped_items = counters['skipped']
+        total_fixed_namespace_items = counters['fixed_namespace']
+        total_fixed_name_uid_items = counters['fixed_name_uid']
+        skipped_by_error_type = Counter(counters['skipped_by_error_type'])
+        total_new_items = counters['new']
+        total_changed_items = counters['changed']
+        total_unchanged_items = counters['unchanged']
+        total_coalesced_items = counters.get('coalesced', 0)
+        load_run_id = checkpoint['load_run_id']  # Keys marked before the restart count as seen
+        if checkpoint['batch_size'] != batch_size:
+            logger.info(f"Checkpoint was written with batch_size {checkpoint['batch_size']}; continuing with {batch_size}")
+        logger.info(f"Resuming from checkpoint {checkpoint_path}: {batches_done} batches "
+                    f"({total_received_items} items) already done")
+        if total_batches is not None:
+            total_batches = batches_done + (initial_total_items - total_received_items + batch_size - 1) // batch_size
+    elif resume:
+        logger.info(f"No checkpoint to resume from at {checkpoint_path}; starting from the first item")
+    if resolve_deferred and deferred is None:
+        deferred = DeferredReferenceQueue(spill_path=deferred_spill_path)
+    if error_records is None:
+        error_records = ErrorRecordStore(error_store_size, error_spill_path)
+
+    def save_checkpoint():
+        write_checkpoint(checkpoint_path, {
+            'version': CHECKPOINT_VERSION,
+            'batch_size': batch_size,
+            'batches_done': batches_done,
+            'items_done': total_received_items,
+            'records_done': records_done,
+            'load_run_id': load_run_id,
+            'namespace_cache': [[name, tenant, uid] for (name, tenant), uid in namespace_cache.items()],
+            'deferred': deferred.persist() if deferred is not None else None,
+            'error_records': error_records.persist(),
+            'counters': {
+                'processed': total_processed_items,
+                'skipped': total_skipped_items,
+                'fixed_namespace': total_fixed_namespace_items,
+                'fixed_name_uid': total_fixed_name_uid_items,
+                'skipped_by_error_type': dict(skipped_by_error_type),
+                'new': total_new_items,
+                'changed': total_changed_items,
+                'unchanged': total_unchanged_items,
+                'coalesced': total_coalesced_items,
+            },
+        })
+
+    # Skipped records are buffered and written in bulk
+    skipped_sink = SkippedDataSink()
+
+    # Helper function to save to D2SkippedData with required composite key fields
+    def save_to_d2_skipped_data(key, kind=None, service=None, name=None, uid=None, 
+                               namespace=None, tenant=None, error_type="unknown_error", 
+                               error_message="", size_bytes=0):
+        # Increment global skipped counter and error type counter
+        nonlocal total_skipped_items
+        total_skipped_items += 1
+        skipped_by_error_type[error_type] += 1
+        error_records.add(key, error_type, error_message)
         
-        try:
-            for (kind, service), objects in objects_by_kind_service.items():
-                # Get references for this kind+service
-                references = list(kind_service_references.get((kind, service), set()))
-                
-                # Create or get table with service-aware naming
-                try:
-                    table = get_or_create_table(kind, service, references)
-                except Exception as e:
-                    logger.error(f"Failed to create/get table for kind {kind}, service {service or 'default'}: {e}")
-                    # Mark all objects of this kind/service as failed
-                    for obj in objects:
-                        key = obj['key']
-                        error_records[key] = {
-                            "value": obj['value'],
-                            "error": f"Failed to create/get table for kind {kind}, service {service or 'default'}: {str(e)}",
-                            "kind": kind,
-                            "service": service
-                        }
-                        # Save to skipped data
-                        save_to_d2_skipped_data(
-                            key=key, kind=kind, service=service, name=obj.get('name'), uid=obj.get('uid'),
-                            namespace=obj.get('namespace'), tenant=obj.get('tenant'),
-                            error_type="table_creation_error", error_message=str(e), size_bytes=obj.get('size')
-                        )
-                    continue # Skip processing objects for this kind/service in this batch
-                
-                # Insert data for all objects of this kind - PROCESS EACH OBJECT IN A SEPARATE TRANSACTION
-                for obj in objects:
-                    # Use a fresh session for each object to avoid transaction issues
-                    obj_session = Session()
-                    
-                    try:
-                        # Common data for insert
-                        data = {
-                            'uid': obj['uid'],
-                            'name': obj['name'],
-                            'namespace': obj['namespace'],
-                            'tenant': obj['tenant'],
-                            'service': obj['service'] or '',  # Ensure service is never NULL
-                            'raw_key': obj['key'],
-                            'size_bytes': obj['size']
-                        }
-                        
-                        # Extract timestamps from system_metadata if available
-                        system_metadata = obj['value'].get('system_metadata', {})
-                        from datetime import datetime, timezone
-                        
-                        if system_metadata:
-                            # Extract creation timestamp
-                            if 'creation_timestamp' in system_metadata:
-                                ts = system_metadata['creation_timestamp']
-                                if isinstance(ts, dict) and 'seconds' in ts:
-                                    # Convert to UTC datetime
-                                    data['created_at'] = datetime.fromtimestamp(ts['seconds'], tz=timezone.utc)
-                            
-                            # Extract modification timestamp
-                            if 'modification_timestamp' in system_metadata:
-                                ts = system_metadata['modification_timestamp']
-                                if isinstance(ts, dict) and 'seconds' in ts:
-                                    # Convert to UTC datetime
-                                    data['updated_at'] = datetime.fromtimestamp(ts['seconds'], tz=timezone.utc)
-                        
-                        # Check if record exists
-                        existing = obj_session.execute(
-                            select(table).where(table.c.uid == obj['uid'])
-                        ).fetchone()
-                        
-                        if existing:
-                            # Update existing record
-                            obj_session.execute(
-                                update(table).where(table.c.uid == obj['uid']).values(**data)
-                            )
-                        else:
-                            # Insert new record
-                            obj_session.execute(
-                                insert(table).values(**data)
-                            )
-                        
-                        # Commit this object immediately
-                        obj_session.commit()
-                        batch_processed_count += 1
-                        total_processed_items += 1 # Increment global counter
-                        
-                        if batch_processed_count % 100 == 0:
-                            logger.info(f"Batch {batch_num+1}: Phase 1 - Processed {batch_processed_count} objects")
-                        
-                    except Exception as e:
-                        # If any error occurs, roll back this object's transaction only
-                        obj_session.rollback()
-                        logger.error(f"Error processing object {kind}/{obj['name']} (service: {service or 'default'}): {e}")
-                        
-                        # Track this error
-                        error_records[obj['key']] = {
-                            "value": obj['value'],
-                            "error": f"Database error: {str(e)}",
-                            "kind": kind,
-                            "service": service,
-                            "name": obj['name'],
-                            "uid": obj['uid'],
-                            "namespace": obj['namespace']
-                        }
-                        
-                        # Use helper function to save to D2SkippedData
-                        save_to_d2_skipped_data(
-                            key=obj['key'],
-                            kind=kind,
-                            service=service,
-                            name=obj['name'],
-                            uid=obj['uid'],
-                            namespace=obj['namespace'],
-                            tenant=obj['tenant'],
-                            error_type="database_error",
-                            error_message=str(e),
-                            size_bytes=obj['size']
-                        )
-
-                    finally:
-                        # Close the session for this object
-                        obj_session.close()
-            
-            logger.info(f"Batch {batch_num+1}: Phase 1 - Successfully processed {batch_processed_count} objects into D2 database")
-        except Exception as e:
-            logger.error(f"Critical Error in Batch {batch_num+1} Phase 1: {e}") # Log critical errors
+        skipped_sink.add(
+            key=key,
+            kind=kind,
+            service=service,
+            uid=uid,
+            error_type=error_type,
+            error_message=error_message,
+            size_bytes=size_bytes
+        )
+    
+    # Optional schema pre-scan: all DDL happens here rather than between batches
+    if plan_schema:
+        if is_reiterable(raw_data_list):
+            logger.info("Planning table schemas before loading...")
+            ready = create_planned_tables(plan_table_schemas(raw_data_list, batch_size))
+            logger.info(f"Schema plan: {ready} tables created or verified")
+        else:
+            logger.warning("plan_schema needs a list or a JSON-lines path; an iterator can only be read once, skipping")
+
+    if use_copy and not copy_supported():
+        logger.warning(f"COPY loading needs PostgreSQL with psycopg2 or psycopg (engine: "
+                       f"{engine.dialect.name}+{engine.dialect.driver}); using the default bulk writes")
+        use_copy = False
+
+    # Concurrent group writers can't usefully outnumber the connections the engine pools
+    pool_capacity = engine_pool_capacity()
+    if db_workers and pool_capacity and db_workers > pool_capacity:
+        logger.info(f"Limiting db_workers from {db_workers} to the engine pool size {pool_capacity} "
+                    f"({type(engine.pool).__name__})")
+        db_workers = pool_capacity
+    db_in_flight = 2 * db_workers if db_workers else 1  # Back-pressure on group submissions
+
+    metrics = PipelineMetrics(metrics_callback, metrics_path)
+
+    # Incremental mode: keys of pre-processed batches whose load state isn't saved yet. With
+    # pipeline_depth a batch is pre-processed before the batches ahead of it have saved their
+    # state, so those keys must not be judged against the stored state.
+    unsaved_state_keys = Counter()
+    unsaved_state_lock = threading.Lock()
+
+    def prepare_batches(records_start, batch_start, batch_num):
+        """Read and pre-process the batches (in a background thread when pipelined)"""
+        for positioned_batch in iter_batches(iter_raw_data(raw_data_list, skip=records_start, positions=True),
+                                             batch_size):
+            records_end = positioned_batch[-1][0]
+            current_batch = [item for _, item in positioned_batch]
+            del positioned_batch
+            # Pre-process pass: Extract all objects, get namespaces, normalize kinds, and collect references
+            logger.info(f"Batch {batch_num+1}: Initial pass - collecting objects, namespaces, and references...")
+            prior_state = None
+            state_keys = ()
+            if incremental:
+                batch_keys = Counter(item.get('key', '') for item in current_batch)
+                with unsaved_state_lock:
+                    unsaved = {key for key in batch_keys if unsaved_state_keys[key]}
+                    unsaved_state_keys.update(batch_keys.keys())
+                prior_state = fetch_load_state(batch_keys)
+                # A key repeated within the batch is always reloaded so its last copy wins, as in a
+                # full load; so is a key whose latest copy is in a batch not saved yet
+                for key, copies in batch_keys.items():
+                    if (copies > 1 or key in unsaved) and key in prior_state:
+                        prior_state[key] = (None, None)
+                state_keys = list(batch_keys)
+                del batch_keys
+            started = time.perf_counter()
+            prepared = preprocess_batch(current_batch, batch_start, preprocess_pool, preprocess_workers, prior_state)
+            if coalesce_duplicates:
+                prepared.coalesce_duplicates()
+            preprocess_seconds = time.perf_counter() - started
+            item_count = len(current_batch)
+            # The raw items (and their value dicts) are no longer needed; only D2Object records are kept
+            del current_batch, prior_state
+            yield item_count, records_end, prepared, state_keys, preprocess_seconds
+            batch_start += item_count
+            batch_num += 1
 
-        # Phase 2: Update references with the stored references for this batch
-        logger.info(f"Batch {batch_num+1}: Phase 2 - Updating references...")
+    # Process data in batches; the sink flushes whatever is buffered and the metrics stop
+    # counting statements even if a batch raises
+    with queued_log_handlers() if queue_logging else nullcontext(), metrics.attached(engine), \
+            skipped_sink, _optional_process_pool(preprocess_workers) as preprocess_pool, \
+            _optional_thread_pool(db_workers) as db_pool, \
+            closing(prefetch(prepare_batches(records_done, total_received_items, batches_done),
+                             pipeline_depth)) as batches:
+        for batch_num, (item_count, records_end, prepared, state_keys, preprocess_seconds) in \
+                enumerate(batches, start=batches_done):
+            batch_start = total_received_items
+            batch_end = batch_start + item_count
+            total_received_items = batch_end
+            batch_skipped_before = total_skipped_items
+            batch_coalesced_before = total_coalesced_items
+
+            if total_batches is not None:
+                logger.info(f"Processing batch {batch_num+1}/{total_batches} (items {batch_start} to {batch_end-1})")
+            else:
+                logger.info(f"Processing batch {batch_num+1} (items {batch_start} to {batch_end-1})")
+
+            schema_seconds_before = table_registry.schema_seconds
+            metrics.add_time('preprocess', preprocess_seconds)
+            metrics.add_time('find_references', prepared.reference_seconds)
+
+            # Per-batch data structures that will be cleared after each batch
+            objects_by_kind_service = prepared.objects_by_kind_service  # Objects grouped by kind and service
+            kind_service_references = prepared.kind_service_references  # References by kind and service
+
+            # Keep namespace UIDs across batches
+            namespace_cache.update(prepared.namespace_uids)
+
+            for skipped_record in prepared.skipped:
+                save_to_d2_skipped_data(**skipped_record)
+
+            batch_fixed_namespace_items_counter = prepared.fixed_namespace_count
+            batch_fixed_name_uid_items_counter = prepared.fixed_name_uid_count
+            total_fixed_namespace_items += batch_fixed_namespace_items_counter
+            total_fixed_name_uid_items += batch_fixed_name_uid_items_counter
+            batch_skipped_items_counter = len(prepared.skipped)
+            batch_item_events = prepared.item_events
+            coalesced = prepared.coalesced  # Copies dropped in favour of another copy of their uid
+            total_coalesced_items += len(coalesced)
+            total_new_items += prepared.new_count
+            total_changed_items += prepared.changed_count
+            total_unchanged_items += prepared.unchanged_count
+            if incremental:
+                logger.info(f"Batch {batch_num+1}: {prepared.new_count} new, {prepared.changed_count} changed, "
+                            f"{prepared.unchanged_count} unchanged objects")
+            del prepared
+
+            # Log progress for this batch
+            logger.info(f"Batch {batch_num+1}: Found {len(objects_by_kind_service)} different kind-service combinations")
+            logger.info(f"Batch {batch_num+1}: Fixed {batch_fixed_namespace_items_counter} items with missing namespace")
+            logger.info(f"Batch {batch_num+1}: Fixed {batch_fixed_name_uid_items_counter} items with missing name/UID")
+            logger.info(f"Batch {batch_num+1}: Skipped {batch_skipped_items_counter} items in pre-processing")
+            if coalesced:
+                logger.info(f"Batch {batch_num+1}: Coalesced {len(coalesced)} duplicate copies of the same uid")
+            log_item_event_summary(f"Batch {batch_num+1}: Pre-processing", batch_item_events)
+
+            # Phase 1: Create tables and load data for this batch
+            logger.info(f"Batch {batch_num+1}: Phase 1 - Creating tables and loading data...")
         
-        # Look up UIDs for references without them
-        for (kind, service), objects in objects_by_kind_service.items():
-            all_refs = []
-            for obj in objects:
-                all_refs.extend(obj['references'])
-            
-            # Only process refs without UIDs but with name/namespace
-            refs_missing_uid = [
-                ref for ref in all_refs 
-                if not ref.get('uid') and ref.get('name') and ref.get('namespace') and ref.get('kind')
+            batch_processed_count = 0 # Counter for successful Phase 1 processing in this batch
+            batch_failed_keys = set()  # Objects skipped by either phase don't get a load state
+            # Referenced kinds (namespaces first) before the kinds referring to them
+            group_order = schedule_groups(objects_by_kind_service, kind_service_references)
+            logger.debug(f"Batch {batch_num+1}: Group order: {group_order}")
+            groups = [
+                (kind, service, objects_by_kind_service[(kind, service)],
+                 kind_service_references.get((kind, service), set()), write_chunk_size, reference_cache, use_copy)
+                for kind, service in group_order
             ]
-            
-            if refs_missing_uid:
-                logger.info(f"Looking up UIDs for {len(refs_missing_uid)} references for kind '{kind}' in service '{service or 'default'}'")
-                
-                # Group references by kind for efficient batch lookup
-                refs_by_kind = {}
-                for ref in refs_missing_uid:
-                    ref_kind = ref.get('kind')
-                    if ref_kind not in refs_by_kind:
-                        refs_by_kind[ref_kind] = []
-                    refs_by_kind[ref_kind].append(ref)
-                
-                # Look up UIDs in batches by kind
-                session = Session()
-                try:
-                    for ref_kind, refs in refs_by_kind.items():
-                        # Skip if no references to look up
-                        if not refs:
-                            continue
-                            
-                        # Special case for namespace - use common table
-                        if ref_kind.lower() == 'namespace':
-                            table = find_table_by_kind_service('namespace', None)
-                        else:
-                            # Always use the current service's table for lookups
-                            table = find_table_by_kind_service(ref_kind, service)
-                        
-                        if table is None:
-                            logger.warning(f"Table not found for '{ref_kind}' in service '{service or 'default'}'")
-                            continue
-                        
-                        # Build lookup conditions
-                        conditions = []
-                        params = {}
-                        for i, ref in enumerate(refs):
-                            name = ref.get('name')
-                            namespace = ref.get('namespace')
-                            tenant = ref.get('tenant')
-                            
-                            # Create parameter names
-                            name_param = f"name_{i}"
-                            ns_param = f"ns_{i}"
-                            tenant_param = f"tenant_{i}"
-                            
-                            # Build condition
-                            condition = f"(name = :{name_param} AND namespace = :{ns_param}"
-                            params[name_param] = name
-                            params[ns_param] = namespace
-                            
-                            if tenant:
-                                condition += f" AND tenant = :{tenant_param}"
-                                params[tenant_param] = tenant
-                            
-                            condition += ")"
-                            conditions.append(condition)
-                        
-                        if not conditions:
-                            continue
-                        
-                        # Execute query
-                        query = f"""
-                            SELECT name, namespace, tenant, uid 
-                            FROM {table.name} 
-                            WHERE {' OR '.join(conditions)}
-                        """
-                        
-                        try:
-                            results = session.execute(text(query), params).fetchall()
-                            
-                            # Create mapping for quick lookup
-                            uid_map = {}
-                            for row in results:
-                                name = row[0]
-                                namespace = row[1]
-                                tenant = row[2]
-                                uid = row[3]
-                                
-                                # Use tenant as part of key if available
-                                key = (name, namespace, tenant) if tenant else (name, namespace, None)
-                                uid_map[key] = uid
-                            
-                            # Update references with UIDs
-                            for ref in refs:
-                                name = ref.get('name')
-                                namespace = ref.get('namespace')
-                                tenant = ref.get('tenant')
-                                
-                                # Try with tenant first, then without
-                                key_with_tenant = (name, namespace, tenant)
-                                key_without_tenant = (name, namespace, None)
-                                
-                                if key_with_tenant in uid_map:
-                                    ref['uid'] = uid_map[key_with_tenant]
-                                elif key_without_tenant in uid_map:
-                                    ref['uid'] = uid_map[key_without_tenant]
-                                else:
-                                    logger.debug(f"No match found for {ref_kind}/{name}/{namespace} in service '{service or 'default'}'")
-                        
-                        except Exception as e:
-                            logger.error(f"Error looking up UIDs for {ref_kind} in service '{service or 'default'}': {e}")
-                            continue
-                            
-                except Exception as e:
-                    logger.error(f"Error in reference lookup: {e}")
-                finally:
-                    session.close()
-
-        # Update references using the looked-up UIDs
-        batch_updated_count = 0
-
-        # Process each object in its own transaction
-        for (kind, service), objects in objects_by_kind_service.items():
-            # Get or create table with references
-            references = list(kind_service_references.get((kind, service), set()))
-            
-            # Ensure table exists before attempting to update references
+        
             try:
-                table = get_or_create_table(kind, service, references)
+                # Results come back in group order, so counters and skipped records are
+                # accounted for in the same order whether or not groups run concurrently
+                with metrics.phase('phase1'):
+                    results = run_group_writers(load_group_rows, groups, db_pool, db_in_flight)
+                    for (kind, service, *_), result in zip(groups, results):
+                        batch_processed_count += result.written
+                        total_processed_items += result.written # Increment global counter
+                        metrics.add_group_rows(kind, service, result.written)
+                        for skipped_record in result.skipped:
+                            batch_failed_keys.add(skipped_record['key'])
+                            save_to_d2_skipped_data(**skipped_record)
+
+                logger.info(f"Batch {batch_num+1}: Phase 1 - Successfully processed {batch_processed_count} objects into D2 database")
             except Exception as e:
-                 logger.error(f"Failed to get/create table for reference update (kind={kind}, service={service}): {e}")
-                 # Skip updating references for these objects if table is problematic
-                 continue 
+                logger.error(f"Critical Error in Batch {batch_num+1} Phase 1: {e}") # Log critical errors
 
-            for obj in objects:
-                # New session for each object
-                session = Session()
-                
-                try:
-                    uid = obj['uid']
-                    name = obj['name']
-                    namespace_name = obj['namespace']
-                    tenant = obj['tenant']
-                    obj_service = obj['service']
-                    
-                    # Group references by kind
-                    refs_by_kind = {}
-                    for ref in obj['references']:
-                        ref_kind = ref.get('kind')
-                        # Ensure the reference kind is valid and expected for this table
-                        if ref_kind and ref_kind != kind and ref_kind in kind_service_references.get((kind, service), set()):
-                            if ref_kind not in refs_by_kind:
-                                refs_by_kind[ref_kind] = []
-                            refs_by_kind[ref_kind].append(ref)
-                    
-                    # Special handling for namespace reference
-                    # Make sure every object references its namespace
-                    if kind != 'namespace' and 'namespace' in kind_service_references.get((kind, service), set()):
-                        # Check if we already have a namespace reference
-                        has_namespace_ref = 'namespace' in refs_by_kind and any(
-                            ref.get('uid') for ref in refs_by_kind['namespace']
-                        )
-                        
-                        if not has_namespace_ref:
-                            # Look up the namespace UID from the cache
-                            cache_key = (namespace_name, tenant) if tenant else (namespace_name, None)
-                            namespace_uid = namespace_cache.get(cache_key)
-                            
-                            # Try without tenant if not found
-                            if not namespace_uid and tenant:
-                                cache_key = (namespace_name, None)
-                                namespace_uid = namespace_cache.get(cache_key)
-                            
-                            if namespace_uid:
-                                # Add namespace reference
-                                if 'namespace' not in refs_by_kind:
-                                    refs_by_kind['namespace'] = []
-                                
-                                refs_by_kind['namespace'].append({
-                                    'kind': 'namespace',
-                                    'name': namespace_name,
-                                    'namespace': 'system',
-                                    'uid': namespace_uid,
-                                    'tenant': tenant,
-                                    'service': None  # Namespaces use common table with no service
-                                })
-                            else:
-                                logger.warning(f"Could not find UID for namespace {namespace_name} (tenant: {tenant}) for object {uid}")
-                    
-                    # Prepare updates for each reference kind
-                    updates = {}
-                    for ref_kind, refs in refs_by_kind.items():
-                        ref_uids = []
-                        
-                        for ref in refs:
-                            ref_uid = ref.get('uid')
-                            if ref_uid and ref_uid not in ref_uids:
-                                ref_uids.append(ref_uid)
-                        
-                        if ref_uids:
-                            # Add the reference UIDs to our updates as a simple array
-                            ref_col = f"ref_{ref_kind.lower()}"
-                            # Ensure the column exists in the table before trying to update
-                            if ref_col in table.c:
-                                updates[ref_col] = ref_uids
-                            else:
-                                logger.warning(f"Reference column '{ref_col}' not found in table '{table.name}' for object {uid}. Skipping update.")
-
-                    # Update the record with references if we have any
-                    if updates:
-                        try:
-                            # Update each reference kind one at a time
-                            for ref_col, ref_uids in updates.items():
-                                session.execute(
-                                    update(table).where(table.c.uid == obj['uid']).values({ref_col: ref_uids})
-                                )
-                            
-                            # Commit immediately after processing this object
-                            session.commit()
-                            batch_updated_count += 1
-                            
-                            if batch_updated_count % 100 == 0:
-                                logger.info(f"Batch {batch_num+1}: Phase 2 - Updated references for {batch_updated_count} objects")
-                        except Exception as e:
-                            # Roll back this object's transaction
-                            session.rollback()
-                            logger.error(f"Error updating references for {kind}/{name} (service: {service or 'default'}, uid: {uid}): {e}")
-                            
-                            # Track this error
-                            error_records[obj['key']] = {
-                                "value": obj['value'],
-                                "error": f"Reference update error: {str(e)}",
-                                "kind": kind,
-                                "service": service,
-                                "name": name,
-                                "uid": uid,
-                                "namespace": namespace_name
-                            }
-                            
-                            # Use helper function to save to D2SkippedData
-                            save_to_d2_skipped_data(
-                                key=obj['key'],
-                                kind=kind,
-                                service=service,
-                                name=name,
-                                uid=uid,
-                                namespace=namespace_name,
-                                tenant=tenant,
-                                error_type="reference_update_error",
-                                error_message=str(e),
-                                size_bytes=obj['size']
-                            )
-                                
-                except Exception as e:
-                    # Roll back this object's transaction
-                    session.rollback()
-                    logger.error(f"Error processing references for {kind}/{name} (service: {service or 'default'}, uid: {uid}): {e}")
-                    
-                    # Track this error
-                    error_records[obj['key']] = {
-                        "value": obj['value'],
-                        "error": f"Reference processing error: {str(e)}",
-                        "kind": kind,
-                        "service": service,
-                        "name": name,
-                        "uid": uid,
-                        "namespace": namespace_name
-                    }
-                    
-                    # Use helper function to save to D2SkippedData
-                    save_to_d2_skipped_data(
-                        key=obj['key'],
-                        kind=kind,
-                        service=service,
-                        name=name,
-                        uid=uid,
-                        namespace=namespace_name,
-                        tenant=tenant,
-                        error_type="reference_processing_error",
-                        error_message=str(e),
-                        size_bytes=obj['size']
-                    )
-                        
-                finally:
-                    session.close()
+            # Phase 2: Update references with the stored references for this batch
+            logger.info(f"Batch {batch_num+1}: Phase 2 - Updating references...")
+            batch_updated_count = 0
+            groups = [
+                (kind, service, objects_by_kind_service[(kind, service)],
+                 kind_service_references.get((kind, service), set()), namespace_cache,
+                 write_chunk_size, reference_cache, deferred, use_copy)
+                for kind, service in group_order
+            ]
+
+            phase2_item_events = Counter()
+            try:
+                with metrics.phase('phase2'):
+                    for result in run_group_writers(write_group_references, groups, db_pool, db_in_flight):
+                        batch_updated_count += result.written
+                        metrics.add_time('uid_lookups', result.lookup_seconds)
+                        if result.item_events:
+                            phase2_item_events.update(result.item_events)
+                        for skipped_record in result.skipped:
+                            batch_failed_keys.add(skipped_record['key'])
+                            save_to_d2_skipped_data(**skipped_record)
+            except Exception as e:
+                logger.error(f"Critical Error in Batch {batch_num+1} Phase 2: {e}") # Log critical errors
+            del groups
         
-        logger.info(f"Batch {batch_num+1}: Phase 2 - Successfully updated references for {batch_updated_count} objects")
+            logger.info(f"Batch {batch_num+1}: Phase 2 - Successfully updated references for {batch_updated_count} objects")
+            log_item_event_summary(f"Batch {batch_num+1}: Phase 2", phase2_item_events)
+
+            # Write this batch's skipped records
+            with metrics.phase('skipped_flush'):
+                skipped_sink.flush()
+
+            if incremental:
+                with metrics.phase('load_state'):
+                    # A dropped copy under its own key is recorded once the copy kept for its uid is written
+                    save_load_state(
+                        chain(
+                            (obj for objects in objects_by_kind_service.values() for obj in objects
+                             if obj.key not in batch_failed_keys),
+                            (obj for obj, kept_key in coalesced
+                             if obj.key != kept_key and kept_key not in batch_failed_keys)
+                        ),
+                        chunk_size=write_chunk_size
+                    )
+                    mark_load_state_seen(state_keys, load_run_id)
+                with unsaved_state_lock:
+                    unsaved_state_keys.subtract(state_keys)
+                    for key in state_keys:
+                        if unsaved_state_keys[key] <= 0:
+                            del unsaved_state_keys[key]
         
-        # Explicitly clear batch data structures and run garbage collection
-        del objects_by_kind_service
-        del kind_service_references
-        del current_batch
-        gc.collect()
-        logger.info(f"Batch {batch_num+1}: Memory cleanup complete.")
+            # Release this batch's records before reading the next one
+            del objects_by_kind_service
+            del kind_service_references
+            del coalesced, group_order
+
+            # Everything this batch wrote is committed; record it so a restart can skip it
+            batches_done = batch_num + 1
+            records_done = records_end
+            if checkpoint_path:
+                with metrics.phase('checkpoint'):
+                    save_checkpoint()
+
+            metrics.add_time('table_ddl', table_registry.schema_seconds - schema_seconds_before)
+            metrics.end_batch(
+                batch_num + 1, batch_end - batch_start,
+                written=batch_processed_count,
+                references_updated=batch_updated_count,
+                skipped=total_skipped_items - batch_skipped_before,
+                coalesced=total_coalesced_items - batch_coalesced_before,
+                item_events=dict(batch_item_events + phase2_item_events),
+            )
+
+        # Final pass: references to objects that arrived in later batches
+        if deferred:
+            logger.info(f"Final pass - Resolving {len(deferred)} deferred references...")
+            try:
+                with metrics.phase('deferred_references'):
+                    deferred_result = resolve_deferred_references(
+                        deferred, namespace_cache, reference_cache, chunk_size=write_chunk_size
+                    )
+            except Exception as e:
+                logger.error(f"Critical Error in the deferred reference pass: {e}")
+            finally:
+                deferred.close()
+
+    # The run is complete; a later run starts from the first item again
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if total_received_items == 0:
+        logger.warning("No data provided to process_data_to_d2")
+        return
 
     # Final Summary Report
     logger.info("="*30 + " Processing Summary " + "="*30)
-    logger.info(f"Total items received: {initial_total_items}")
+    logger.info(f"Total items received: {total_received_items}")
     logger.info(f"Total items successfully processed: {total_processed_items}")
     logger.info(f"Total items skipped: {total_skipped_items}")
+    logger.info(f"Skipped records written to {D2SkippedData.__tablename__}: {skipped_sink.flushed_count} (failed: {skipped_sink.failed_count})")
     logger.info(f"Items fixed (missing namespace): {total_fixed_namespace_items}")
     logger.info(f"Items fixed (missing name/UID): {total_fixed_name_uid_items}")
+    if total_coalesced_items:
+        logger.info(f"Duplicate copies coalesced (same uid in a batch): {total_coalesced_items}")
+    incremental_counts = None
+    if incremental:
+        # Objects recorded before but absent from this dump are reported (their D2 rows are
+        # kept) and dropped from d2_load_state, so the next run doesn't report them again
+        total_deleted_items = delete_unseen_load_state(load_run_id)
+        logger.info(f"Incremental: {total_new_items} new, {total_changed_items} changed, "
+                    f"{total_unchanged_items} unchanged, {total_deleted_items} deleted since the last load")
+        incremental_counts = {
+            "new": total_new_items,
+            "changed": total_changed_items,
+            "unchanged": total_unchanged_items,
+            "deleted": total_deleted_items,
+        }
     
     if total_skipped_items > 0:
         logger.info("Skipped item breakdown by error type:")
         for error_type, count in skipped_by_error_type.items():
             logger.info(f"  - {error_type}: {count}")
+
+    logger.debug(f"Table registry: {table_registry.hits} cached, {table_registry.schema_calls} schema calls")
+    for parser_name, stats in parser_cache_info().items():
+        logger.debug(f"Parser cache {parser_name}: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries")
+
+    if deferred_result is not None:
+        logger.info(f"Deferred references resolved: {deferred_result.resolved} "
+                    f"(still unresolved: {deferred_result.unresolved}, objects updated: {deferred_result.updated})")
+
+    if reference_cache is not None:
+        stats = reference_cache.stats()
+        logger.info(f"Reference cache: {stats['hits'] + stats['negative_hits']} hits "
+                    f"({stats['negative_hits']} known misses), {stats['misses']} database lookups, "
+                    f"hit rate {stats['hit_rate']:.1%}, {stats['size']} entries, {stats['evictions']} evicted")
+
+    if error_records.spill_path:
+        error_records.spill()
+        logger.info(f"Error details written to {error_records.spill_path}: {error_records.spilled_count}")
             
     logger.info("="*78) # Match the length of the header line
 
-    # Optionally return summary data
-    # return {
-    #     "total_received": initial_total_items,
-    #     "total_processed": total_processed_items,
-    #     "total_skipped": total_skipped_items,
-    #     "fixed_namespace": total_fixed_namespace_items,
-    #     "fixed_name_uid": total_fixed_name_uid_items,
-    #     "skipped_details": dict(skipped_by_error_type)
-    # }
\ No newline at end of file
+    metrics_summary = metrics.summary(total_received_items, skipped_by_error_type)
+    metrics.emit(metrics_summary)
+    logger.info(f"Run time {metrics_summary['seconds']:.1f}s ({metrics_summary['items_per_sec']} items/sec), "
+                f"{metrics_summary['statements']} SQL statements, peak RSS {metrics_summary['peak_rss_kb']} KiB")
+
+    return {
+        "total_received": total_received_items,
+        "total_processed": total_processed_items,
+        "total_skipped": total_skipped_items,
+        "fixed_namespace": total_fixed_namespace_items,
+        "fixed_name_uid": total_fixed_name_uid_items,
+        "coalesced": total_coalesced_items,
+        "skipped_details": dict(skipped_by_error_type),
+        "incremental": incremental_counts,
+        "metrics": metrics_summary,
+    }
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Shared fixtures for the d2_operations tests
+
+d2_operations imports its engine and table helpers from db.d2_models, which is not part of
+this repository. The tests always install the stand-in in d2_models_standin.py under that
+name, so they never touch a real D2 database, and give every test a fresh SQLite file.
+Tests marked for PostgreSQL run against D2_TEST_POSTGRES_URL (each in its own schema) and
+are skipped when it isn't set.
+"""
+import os
+import sys
+import types
+import uuid
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, TESTS_DIR)
+
+import d2_models_standin  # noqa: E402
+
+db_package = types.ModuleType('db')
+db_package.__path__ = []
+db_package.d2_models = d2_models_standin
+sys.modules['db'] = db_package
+sys.modules['db.d2_models'] = d2_models_standin
+d2_models_standin.use_database('sqlite://')
+
+import d2_operations  # noqa: E402
+from sqlalchemy import MetaData, Table, create_engine, select, text  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+
+
+def _bind(monkeypatch, url, **engine_kwargs):
+    bind = d2_models_standin.use_database(url, **engine_kwargs)
+    # d2_operations imported these names from db.d2_models at import time
+    monkeypatch.setattr(d2_operations, 'engine', bind)
+    monkeypatch.setattr(d2_operations, 'Session', d2_models_standin.Session)
+    d2_operations.table_registry.invalidate()
+    d2_operations.clear_parser_caches()
+    return bind
+
+
+@pytest.fixture
+def d2_database(tmp_path, monkeypatch):
+    """Function switching the loader to a fresh SQLite D2 database (named name) and returning its engine"""
+    def use(name='d2.db'):
+        return _bind(monkeypatch, f"sqlite:///{tmp_path / name}")
+    yield use
+    d2_models_standin.engine.dispose()
+
+
+@pytest.fixture
+def d2_db(d2_database):
+    """Engine of a fresh SQLite D2 database"""
+    return d2_database()
+
+
+@pytest.fixture
+def d2_memory_db(monkeypatch):
+    """Engine of a fresh in-memory SQLite D2 database (SQLAlchemy's default pool for it)"""
+    yield _bind(monkeypatch, 'sqlite://')
+    d2_models_standin.engine.dispose()
+
+
+@pytest.fixture
+def postgres_database(monkeypatch):
+    """Function switching the loader to an empty schema in the PostgreSQL database at
+    D2_TEST_POSTGRES_URL and returning its engine; the schemas are dropped afterwards"""
+    url = os.environ.get('D2_TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip("D2_TEST_POSTGRES_URL is not set")
+    pytest.importorskip(make_url(url).get_dialect().driver)
+    schemas = []
+
+    def use():
+        schema = f"d2_test_{uuid.uuid4().hex[:12]}"
+        bind = _bind(monkeypatch, url, connect_args={'options': f"-csearch_path={schema}"})
+        with bind.begin() as conn:
+            conn.execute(text(f'CREATE SCHEMA "{schema}"'))
+        schemas.append(schema)
+        return bind
+
+    yield use
+    d2_models_standin.engine.dispose()
+    cleanup = create_engine(url)
+    with cleanup.begin() as conn:
+        for schema in schemas:
+            conn.execute(text(f'DROP SCHEMA "{schema}" CASCADE'))
+    cleanup.dispose()
+
+
+@pytest.fixture
+def postgres_db(postgres_database):
+    """Engine of an empty schema in the PostgreSQL database at D2_TEST_POSTGRES_URL"""
+    return postgres_database()
+
+
+def _snapshot(bind, exclude=('d2_load_state',)):
+    contents = {}
+    metadata = MetaData()
+    metadata.reflect(bind=bind)
+    with bind.connect() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in exclude:
+                contents[table.name] = [
+                    dict(row._mapping) for row in conn.execute(select(table).order_by(*table.primary_key.columns))
+                ]
+    return contents
+
+
+@pytest.fixture
+def d2_snapshot():
+    """Function returning the contents of every table of a D2 database (but d2_load_state), sorted"""
+    return _snapshot
+
+
+@pytest.fixture
+def table_rows():
+    """Function returning the rows of a table of the current D2 database as dicts, sorted"""
+    def rows(table_name, order_by='uid'):
+        table = Table(table_name, MetaData(), autoload_with=d2_operations.engine)
+        with d2_operations.engine.connect() as conn:
+            result = conn.execute(select(table).order_by(*(table.c[col] for col in order_by.split(','))))
+            return [dict(row._mapping) for row in result]
+    return rows
@@ -0,0 +1,48 @@
+"""Builders for small D1 items used by the tests"""
+
+TENANT = 'acme'
+
+
+def namespace_uid(name):
+    return f"ns-uid-{name}"
+
+
+def namespace_item(name, tenant=TENANT):
+    """A namespace object (stored in the service-less 'namespace' table)"""
+    uid = namespace_uid(name)
+    return {
+        'key': f"/ares/db/ves.io.schema.namespace.Object.default/primary/{uid}",
+        'value': {
+            'metadata': {'name': name, 'uid': uid},
+            'system_metadata': {'uid': uid, 'tenant': tenant},
+        },
+    }
+
+
+def ref(kind, name, namespace='shared', tenant=TENANT, uid=None):
+    """A reference to another object, by name (and uid if given)"""
+    reference = {'kind': kind, 'name': name, 'namespace': namespace, 'tenant': tenant}
+    if uid:
+        reference['uid'] = uid
+    return reference
+
+
+def item(kind, uid, name=None, namespace='shared', service='akar', tenant=TENANT, refs=(), modified=1700000000,
+         key=None, **spec):
+    """A D1 object of kind in namespace, referring to refs from its spec"""
+    system_metadata = {
+        'uid': uid,
+        'tenant': tenant,
+        'namespace': [{'kind': 'namespace', 'name': namespace, 'uid': namespace_uid(namespace), 'tenant': tenant}],
+        'creation_timestamp': {'seconds': 1600000000, 'nanos': 0},
+    }
+    if modified is not None:
+        system_metadata['modification_timestamp'] = {'seconds': modified, 'nanos': 0}
+    return {
+        'key': key or f"/{service}/db/ves.io.schema.{kind}.Object.default/primary/{uid}",
+        'value': {
+            'metadata': {'name': name or f"{kind}-{uid}", 'namespace': namespace, 'uid': uid},
+            'system_metadata': system_metadata,
+            'spec': {'gc_spec': {'refs': list(refs), **spec}},
+        },
+    }
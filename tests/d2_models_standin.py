@@ -0,0 +1,93 @@
+"""
+Minimal stand-in for db.d2_models, used by the tests only
+
+Provides the names d2_operations imports from db.d2_models: the engine, a Session factory,
+the D2SkippedData model and the kind table helpers. Kind tables are keyed on uid and get
+one ref_<kind> column per reference kind (a text array on PostgreSQL, JSON elsewhere).
+use_database() points everything at a fresh database.
+"""
+from sqlalchemy import JSON, Column, DateTime, Integer, MetaData, String, Table, create_engine, inspect, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+Base = declarative_base()
+
+engine = None
+Session = None
+metadata = MetaData()
+
+
+class D2SkippedData(Base):
+    __tablename__ = "d2_skipped_data"
+
+    uid = Column(String(255), primary_key=True)
+    service = Column(String(255), primary_key=True)
+    object_type = Column(String(255), primary_key=True)
+    key = Column(String)
+    size_bytes = Column(Integer)
+    error_type = Column(String(255))
+    error_message = Column(String(1000))
+
+
+def use_database(url, **engine_kwargs):
+    """Bind the stand-in to the database at url, forgetting the tables of the previous one"""
+    global engine, Session, metadata
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(url, **engine_kwargs)
+    Session = sessionmaker(bind=engine)
+    metadata = MetaData()
+    return engine
+
+
+def init_d2_db():
+    Base.metadata.create_all(engine)
+
+
+def table_name_for(kind, service):
+    return f"{kind}_{service}".replace('-', '_') if service else kind
+
+
+def _reference_column(name):
+    column_type = ARRAY(String) if engine.dialect.name == 'postgresql' else JSON
+    return Column(name, column_type)
+
+
+def get_or_create_table(kind, service, references):
+    name = table_name_for(kind, service)
+    table = metadata.tables.get(name)
+    if table is None:
+        table = Table(
+            name, metadata,
+            Column('uid', String(255), primary_key=True),
+            Column('name', String(255)),
+            Column('namespace', String(255)),
+            Column('tenant', String(255)),
+            Column('service', String(255)),
+            Column('raw_key', String),
+            Column('size_bytes', Integer),
+            Column('created_at', DateTime(timezone=True)),
+            Column('updated_at', DateTime(timezone=True)),
+        )
+        table.create(engine, checkfirst=True)
+        for column in inspect(engine).get_columns(name):
+            if column['name'].startswith('ref_') and column['name'] not in table.c:
+                table.append_column(_reference_column(column['name']))
+
+    for reference in references:
+        column_name = f"ref_{reference.lower()}"
+        if column_name not in table.c:
+            column = _reference_column(column_name)
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE "{name}" ADD COLUMN "{column_name}" {column_type}'))
+            table.append_column(column)
+    return table
+
+
+def get_all_tables():
+    return list(metadata.tables.values())
+
+
+def find_table_by_kind_service(kind, service):
+    return metadata.tables.get(table_name_for(kind, service))
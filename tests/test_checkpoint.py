@@ -0,0 +1,147 @@
+import json
+import os
+
+import pytest
+
+import d2_operations
+from d2_operations import DeferredReferenceQueue, process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item, ref
+
+
+def _dump():
+    """Two namespaces, objects referring to each other across batches, and items that are skipped"""
+    items = [namespace_item('shared'), namespace_item('team')]
+    for i in range(12):
+        items.append(item('origin_pool', f"pool-uid-{i}", name=f"pool-{i}", namespace='team' if i % 2 else 'shared'))
+        items.append(item('http_loadbalancer', f"lb-uid-{i}", refs=[ref('origin_pool', f"pool-{(i + 3) % 12}")]))
+        if i % 4 == 0:
+            items.append({'key': f"/akar/db/ves.io.schema.route.Object.default/primary/bad-{i}", 'value': "not a dict"})
+            items.append({'key': f"/akar/db/ves.io.schema.route.Object.default-{i}/primary/", 'value': {'metadata': {}}})
+    return items
+
+
+def _fail_on_call(monkeypatch, name, call_number):
+    """Make d2_operations.<name> raise on its call_number-th call, as if the process died there"""
+    original = getattr(d2_operations, name)
+    calls = []
+
+    def failing(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == call_number:
+            raise RuntimeError("preempted")
+        return original(*args, **kwargs)
+    monkeypatch.setattr(d2_operations, name, failing)
+    return lambda: monkeypatch.setattr(d2_operations, name, original)
+
+
+def test_crash_and_resume_gives_the_same_tables_as_a_clean_load(d2_database, d2_snapshot, tmp_path, monkeypatch):
+    items = _dump()
+    clean = d2_database('clean.db')
+    clean_result = process_data_to_d2_with_missing_fields_handling(items, batch_size=8)
+    expected = d2_snapshot(clean)
+
+    resumed = d2_database('resumed.db')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    options = dict(batch_size=8, checkpoint_path=checkpoint_path, deferred_spill_path=str(tmp_path / 'deferred.jsonl'))
+    # Fails after the third batch's skipped records are buffered, before its writes
+    restore = _fail_on_call(monkeypatch, 'schedule_groups', 3)
+    with pytest.raises(RuntimeError):
+        process_data_to_d2_with_missing_fields_handling(items, **options)
+    restore()
+    assert os.path.exists(checkpoint_path)
+
+    result = process_data_to_d2_with_missing_fields_handling(items, resume=True, **options)
+
+    assert d2_snapshot(resumed) == expected
+    assert result['total_skipped'] == clean_result['total_skipped'] == len(expected['d2_skipped_data'])
+    assert result['total_processed'] == clean_result['total_processed']
+    assert not os.path.exists(checkpoint_path)
+
+
+def test_rewriting_skipped_records_updates_the_same_rows(d2_db, table_rows):
+    bad_items = [{'key': "/akar/db/ves.io.schema.route.Object.default/primary/", 'value': {'metadata': {}}},
+                 {'key': "/akar/db/ves.io.schema.route.Object.default/primary/bad", 'value': "not a dict"}]
+    process_data_to_d2_with_missing_fields_handling(bad_items)
+    first = table_rows('d2_skipped_data', order_by='uid,service,object_type')
+    process_data_to_d2_with_missing_fields_handling(bad_items)
+
+    assert len(first) == 2
+    assert table_rows('d2_skipped_data', order_by='uid,service,object_type') == first
+
+
+def _entries(queue):
+    return [entry.owner_uid for chunk in queue.iter_chunks(10) for entry in chunk]
+
+
+def _add(queue, owners):
+    for owner in owners:
+        queue.add('route', 'akar', owner, 'origin_pool', 'pool', 'shared', None)
+
+
+@pytest.mark.parametrize('saved', [[], ['saved-1', 'saved-2']])
+def test_restore_drops_entries_spilled_after_the_checkpoint(tmp_path, saved):
+    spill_path = tmp_path / 'deferred.jsonl'
+    queue = DeferredReferenceQueue(max_in_memory=2, spill_path=str(spill_path))
+    _add(queue, saved)
+    state = queue.persist()
+    # The crashed batch queued more entries, spilled past the memory limit
+    _add(queue, ['lost-1', 'lost-2', 'lost-3'])
+    assert spill_path.stat().st_size > state['size']
+
+    restored = DeferredReferenceQueue.restore(state, max_in_memory=2)
+    assert _entries(restored) == saved
+    assert len(restored) == len(saved)
+
+    _add(restored, ['redone-1', 'redone-2'])
+    assert _entries(restored) == saved + ['redone-1', 'redone-2']
+
+
+def test_resume_skips_input_lines_not_items_when_the_dump_has_an_invalid_line(
+        d2_database, d2_snapshot, tmp_path, monkeypatch):
+    lines = [json.dumps(it) for it in _dump()[:12]]
+    lines.insert(2, '{"key": "/akar/db/truncated')
+    dump_path = tmp_path / 'dump.jsonl'
+    dump_path.write_text('\n'.join(lines) + '\n\n')
+
+    clean = d2_database('clean.db')
+    clean_result = process_data_to_d2_with_missing_fields_handling(str(dump_path), batch_size=3)
+    expected = d2_snapshot(clean)
+
+    resumed = d2_database('resumed.db')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    restore = _fail_on_call(monkeypatch, 'schedule_groups', 3)
+    with pytest.raises(RuntimeError):
+        process_data_to_d2_with_missing_fields_handling(str(dump_path), batch_size=3, checkpoint_path=checkpoint_path)
+    restore()
+    result = process_data_to_d2_with_missing_fields_handling(str(dump_path), batch_size=3,
+                                                             checkpoint_path=checkpoint_path, resume=True)
+
+    assert d2_snapshot(resumed) == expected
+    for counter in ('total_received', 'total_processed', 'total_skipped'):
+        assert result[counter] == clean_result[counter]
+    assert clean_result['total_received'] == 12
+
+
+def _error_lines(path):
+    return [json.loads(line)['key'] for line in path.read_text().splitlines()]
+
+
+def test_error_spill_file_holds_the_errors_of_the_current_run_only(d2_db, tmp_path, monkeypatch):
+    error_path = tmp_path / 'errors.jsonl'
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    options = dict(batch_size=8, error_store_size=2, error_spill_path=str(error_path), checkpoint_path=checkpoint_path)
+    items = _dump()
+    expected = [it['key'] for it in items if not isinstance(it['value'], dict) or not it['value'].get('metadata', 1)]
+
+    process_data_to_d2_with_missing_fields_handling(items, **options)
+    assert len(expected) == 6
+    assert _error_lines(error_path) == expected
+
+    # A second run, interrupted after the third batch's errors are recorded, then resumed
+    restore = _fail_on_call(monkeypatch, 'schedule_groups', 3)
+    with pytest.raises(RuntimeError):
+        process_data_to_d2_with_missing_fields_handling(items, **options)
+    restore()
+    process_data_to_d2_with_missing_fields_handling(items, resume=True, **options)
+
+    assert _error_lines(error_path) == expected
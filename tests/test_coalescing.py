@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+from d2_operations import D2Object, PreprocessedBatch, process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item, ref
+
+
+def _object(key, uid, modified, refs):
+    updated_at = datetime.fromtimestamp(modified, tz=timezone.utc) if modified is not None else None
+    return D2Object(key=key, uid=uid, name=key, namespace='shared', tenant='acme', service='akar', size=None,
+                    original_kind='route', created_at=None, updated_at=updated_at, references=list(refs))
+
+
+def _ref(kind, name):
+    return {'kind': kind, 'name': name, 'namespace': 'shared', 'tenant': 'acme'}
+
+
+def _batch(objects):
+    batch = PreprocessedBatch()
+    batch.objects_by_kind_service[('route', 'akar')] = objects
+    return batch
+
+
+def test_latest_copy_wins_and_takes_the_references_of_the_others():
+    batch = _batch([
+        _object('old', 'uid-1', 100, [_ref('namespace', 'shared'), _ref('origin_pool', 'a')]),
+        _object('other', 'uid-2', 100, []),
+        _object('new', 'uid-1', 200, [_ref('namespace', 'team'), _ref('origin_pool', 'b'), _ref('origin_pool', 'a')]),
+        _object('undated', 'uid-1', None, [_ref('namespace', 'other'), _ref('origin_pool', 'c')]),
+    ])
+
+    assert batch.coalesce_duplicates() == 2
+
+    kept, other = batch.objects_by_kind_service[('route', 'akar')]
+    assert (kept.key, other.key) == ('new', 'other')
+    assert [(r['kind'], r['name']) for r in kept.references] == [
+        ('namespace', 'team'), ('origin_pool', 'b'), ('origin_pool', 'a'), ('origin_pool', 'c')
+    ]
+    assert [(dropped.key, kept_key) for dropped, kept_key in batch.coalesced] == [('old', 'new'), ('undated', 'new')]
+
+
+def test_later_copy_wins_a_timestamp_tie_and_a_group_without_duplicates_is_untouched():
+    batch = _batch([_object('first', 'uid-1', 100, []), _object('second', 'uid-1', 100, [])])
+    batch.objects_by_kind_service[('origin_pool', 'akar')] = pools = [_object('pool', 'uid-9', None, [])]
+
+    assert batch.coalesce_duplicates() == 1
+
+    assert [obj.key for obj in batch.objects_by_kind_service[('route', 'akar')]] == ['second']
+    assert batch.objects_by_kind_service[('origin_pool', 'akar')] is pools
+
+
+def test_loader_writes_one_row_per_uid_with_the_merged_references(d2_db, table_rows):
+    items = [
+        namespace_item('shared'),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+        item('origin_pool', 'pool-uid-b', name='pool-b'),
+        item('http_loadbalancer', 'lb-uid', name='lb-new', modified=1700000200, refs=[ref('origin_pool', 'pool-b')],
+             key='/akar/db/ves.io.schema.http_loadbalancer.Object.default/primary/lb-new'),
+        item('http_loadbalancer', 'lb-uid', name='lb-old', modified=1700000100, refs=[ref('origin_pool', 'pool-a')],
+             key='/akar/db/ves.io.schema.http_loadbalancer.Object.default/primary/lb-old'),
+    ]
+
+    result = process_data_to_d2_with_missing_fields_handling(items, batch_size=10)
+
+    [lb] = table_rows('http_loadbalancer_akar')
+    assert lb['name'] == 'lb-new'
+    assert sorted(lb['ref_origin_pool']) == ['pool-uid-a', 'pool-uid-b']
+    assert result['coalesced'] == 1
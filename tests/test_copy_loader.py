@@ -0,0 +1,36 @@
+from d2_operations import copy_supported, process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item, ref
+
+# Characters COPY's text format or PostgreSQL's array literals have to escape
+AWKWARD = ['tab\there', 'new\nline', 'carriage\rreturn', 'back\\slash', '"quoted"', 'comma,{brace}', 'NULL', 'ünïcødé', '\\N']
+
+
+def _dump():
+    """Objects of a few kinds with awkward names and uids, referring to each other across batches"""
+    items = [namespace_item('shared'), namespace_item('team')]
+    for i, word in enumerate(AWKWARD * 2):
+        namespace = 'team' if i % 2 else 'shared'
+        items.append(item('origin_pool', f"pool-uid-{i}-{word}", name=f"pool-{i}-{word}", namespace=namespace))
+        items.append(item('http_loadbalancer', f"lb-uid-{i}", name=f"lb {word}",
+                          refs=[ref('origin_pool', f"pool-{(i + 5) % 18}-{AWKWARD[(i + 5) % 9]}",
+                                    namespace='team' if (i + 5) % 2 else 'shared'),
+                                ref('origin_pool', f"pool-{i}-{word}", namespace=namespace)]))
+        items.append(item('route', f"route-uid-{i}", modified=None, refs=[ref('http_loadbalancer', f"lb {word}")]))
+    # A second copy of an object, the later one wins
+    items.append(item('origin_pool', 'pool-uid-0-tab\there', name='pool-0-tab\there', modified=1700000900, port=8080))
+    return items
+
+
+def test_copy_path_loads_the_same_tables_as_the_upsert_path(postgres_database, d2_snapshot):
+    items = _dump()
+    upsert_bind = postgres_database()
+    upsert_result = process_data_to_d2_with_missing_fields_handling(items, batch_size=7, use_copy=False)
+    expected = d2_snapshot(upsert_bind)
+
+    copy_bind = postgres_database()
+    assert copy_supported(copy_bind)
+    copy_result = process_data_to_d2_with_missing_fields_handling(items, batch_size=7, use_copy=True)
+
+    assert d2_snapshot(copy_bind) == expected
+    assert copy_result['total_processed'] == upsert_result['total_processed']
+    assert any(row['ref_origin_pool'] for row in expected['http_loadbalancer_akar'])
@@ -0,0 +1,107 @@
+import os
+
+from d2_operations import DeferredReference, DeferredReferenceQueue, process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item, ref
+
+
+def _entries(queue):
+    return [entry for chunk in queue.iter_chunks(2) for entry in chunk]
+
+
+def test_queue_spills_beyond_memory_limit_and_keeps_order(tmp_path):
+    spill_path = tmp_path / 'deferred.jsonl'
+    queue = DeferredReferenceQueue(max_in_memory=3, spill_path=str(spill_path))
+    for i in range(7):
+        queue.add('route', 'akar', f"owner-{i}", 'origin_pool', f"pool-{i}", 'shared', None)
+
+    assert len(queue) == 7
+    assert queue.spilled_count == 6
+    assert [entry.owner_uid for entry in _entries(queue)] == [f"owner-{i}" for i in range(7)]
+    assert _entries(queue)[0] == DeferredReference('route', 'akar', 'owner-0', 'origin_pool', 'pool-0', 'shared', None)
+
+    queue.close()
+    assert spill_path.read_text() == ""
+    assert _entries(queue) == []
+
+
+def test_new_queue_ignores_entries_left_in_a_callers_spill_file(tmp_path):
+    spill_path = tmp_path / 'deferred.jsonl'
+    spill_path.write_text('["route", "akar", "stale", "origin_pool", "pool", "shared", null]\n')
+
+    queue = DeferredReferenceQueue(max_in_memory=1, spill_path=str(spill_path))
+    queue.add('route', 'akar', 'fresh', 'origin_pool', 'pool', 'shared', None)
+
+    assert [entry.owner_uid for entry in _entries(queue)] == ['fresh']
+
+
+def test_temporary_spill_file_is_removed_on_close():
+    queue = DeferredReferenceQueue(max_in_memory=1)
+    queue.add('route', 'akar', 'owner', 'origin_pool', 'pool', 'shared', None)
+    spill_path = queue.spill_path
+
+    queue.close()
+    assert not os.path.exists(spill_path)
+
+
+def test_reference_to_a_later_batch_is_resolved_by_the_final_pass(d2_db, table_rows):
+    items = [
+        namespace_item('shared'),
+        item('http_loadbalancer', 'lb-1', refs=[ref('origin_pool', 'pool-a')]),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+    ]
+    process_data_to_d2_with_missing_fields_handling(items, batch_size=1)
+
+    [lb] = table_rows('http_loadbalancer_akar')
+    assert lb['ref_origin_pool'] == ['pool-uid-a']
+
+
+def test_second_run_with_the_same_spill_path_only_applies_its_own_entries(d2_db, table_rows, tmp_path):
+    spill_path = tmp_path / 'deferred.jsonl'
+    options = dict(batch_size=1, deferred_spill_path=str(spill_path), checkpoint_path=str(tmp_path / 'checkpoint.json'))
+
+    # First run: the load balancer refers to pool-a, which only arrives in a later batch
+    process_data_to_d2_with_missing_fields_handling([
+        namespace_item('shared'),
+        item('http_loadbalancer', 'lb-1', refs=[ref('origin_pool', 'pool-a')]),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+    ], **options)
+    assert table_rows('http_loadbalancer_akar')[0]['ref_origin_pool'] == ['pool-uid-a']
+    assert spill_path.read_text() == ""
+
+    # Second run: lb-1 now refers to pool-b instead (pool-a still exists), and lb-2 queues
+    # an entry of its own
+    process_data_to_d2_with_missing_fields_handling([
+        namespace_item('shared'),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+        item('origin_pool', 'pool-uid-b', name='pool-b'),
+        item('http_loadbalancer', 'lb-1', refs=[ref('origin_pool', 'pool-b')], modified=1700000100),
+        item('http_loadbalancer', 'lb-2', refs=[ref('origin_pool', 'pool-c')]),
+        item('origin_pool', 'pool-uid-c', name='pool-c'),
+    ], **options)
+
+    lb_1, lb_2 = table_rows('http_loadbalancer_akar')
+    assert lb_1['ref_origin_pool'] == ['pool-uid-b']
+    assert lb_2['ref_origin_pool'] == ['pool-uid-c']
+    assert spill_path.read_text() == ""
+
+
+def test_stale_spill_file_of_an_interrupted_run_is_not_applied(d2_db, table_rows, tmp_path):
+    spill_path = tmp_path / 'deferred.jsonl'
+    process_data_to_d2_with_missing_fields_handling([
+        namespace_item('shared'),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+        item('origin_pool', 'pool-uid-b', name='pool-b'),
+    ], batch_size=10)
+    # Left behind by a run that died before its final pass (lb-1 used to refer to pool-a)
+    spill_path.write_text('["http_loadbalancer", "akar", "lb-1", "origin_pool", "pool-a", "shared", "acme"]\n')
+
+    # lb-2's pool arrives in a later batch, so this run queues (and spills) entries of its own
+    process_data_to_d2_with_missing_fields_handling([
+        item('http_loadbalancer', 'lb-1', refs=[ref('origin_pool', 'pool-b')]),
+        item('http_loadbalancer', 'lb-2', refs=[ref('origin_pool', 'pool-c')]),
+        item('origin_pool', 'pool-uid-c', name='pool-c'),
+    ], batch_size=1, deferred_spill_path=str(spill_path), checkpoint_path=str(tmp_path / 'checkpoint.json'))
+
+    lb_1, lb_2 = table_rows('http_loadbalancer_akar')
+    assert lb_1['ref_origin_pool'] == ['pool-uid-b']
+    assert lb_2['ref_origin_pool'] == ['pool-uid-c']
@@ -0,0 +1,61 @@
+import d2_operations
+from d2_operations import process_data_to_d2_with_missing_fields_handling, schedule_groups
+from d1_items import item, namespace_item, ref
+
+
+def test_namespaces_first_then_referenced_kinds_before_their_referrers():
+    groups = [('route', 'akar'), ('http_loadbalancer', 'ares'), ('origin_pool', 'akar'), ('namespace', None),
+              ('http_loadbalancer', 'akar'), ('healthcheck', 'akar')]
+    references = {
+        ('route', 'akar'): {'http_loadbalancer', 'namespace'},
+        ('http_loadbalancer', 'akar'): {'origin_pool', 'namespace'},
+        ('origin_pool', 'akar'): {'healthcheck', 'namespace', 'origin_pool'},
+        ('healthcheck', 'akar'): {'namespace', 'unknown_kind'},
+    }
+
+    assert schedule_groups(groups, references) == [
+        ('namespace', None), ('healthcheck', 'akar'), ('origin_pool', 'akar'),
+        ('http_loadbalancer', 'akar'), ('http_loadbalancer', 'ares'), ('route', 'akar'),
+    ]
+
+
+def test_a_cycle_is_broken_the_same_way_whatever_the_input_order():
+    references = {
+        ('a_kind', 'akar'): {'b_kind'},
+        ('b_kind', 'akar'): {'a_kind', 'c_kind'},
+        ('c_kind', 'akar'): {'a_kind'},
+        ('d_kind', 'akar'): {'c_kind'},
+    }
+    groups = list(references)
+
+    order = schedule_groups(groups, references)
+
+    # No kind is ready: b_kind has two unscheduled dependencies, the others one, so a_kind goes first
+    assert [kind for kind, _ in order] == ['a_kind', 'c_kind', 'b_kind', 'd_kind']
+    assert schedule_groups(reversed(groups), dict(reversed(references.items()))) == order
+
+
+def test_loader_writes_groups_in_dependency_order_whatever_the_item_order(d2_db, monkeypatch):
+    written = []
+    original = d2_operations.load_group_rows
+
+    def load_group_rows(kind, service, *args):
+        written.append((kind, service))
+        return original(kind, service, *args)
+    monkeypatch.setattr(d2_operations, 'load_group_rows', load_group_rows)
+    items = [
+        item('route', 'route-uid', refs=[ref('http_loadbalancer', 'lb')]),
+        item('http_loadbalancer', 'lb-uid', name='lb', refs=[ref('origin_pool', 'pool')]),
+        item('http_loadbalancer', 'lb-uid', name='lb', service='ares', refs=[ref('origin_pool', 'pool')]),
+        item('origin_pool', 'pool-uid', name='pool'),
+        namespace_item('shared'),
+    ]
+
+    process_data_to_d2_with_missing_fields_handling(items, batch_size=10)
+    in_input_order, written[:] = list(written), []
+    process_data_to_d2_with_missing_fields_handling(list(reversed(items)), batch_size=10)
+
+    assert in_input_order == written == [
+        ('namespace', None), ('origin_pool', 'akar'), ('http_loadbalancer', 'akar'), ('http_loadbalancer', 'ares'),
+        ('route', 'akar'),
+    ]
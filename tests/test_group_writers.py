@@ -0,0 +1,30 @@
+from sqlalchemy.pool import SingletonThreadPool
+
+from d2_operations import engine_pool_capacity, process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item, ref
+
+
+def _dump():
+    items = [namespace_item('shared')]
+    for i in range(20):
+        items.append(item('origin_pool', f"pool-uid-{i}", name=f"pool-{i}"))
+        items.append(item('http_loadbalancer', f"lb-uid-{i}", service='ares' if i % 2 else 'akar',
+                          refs=[ref('origin_pool', f"pool-{i}")]))
+        items.append(item('healthcheck', f"hc-uid-{i}", service='maurice'))
+    return items
+
+
+def test_file_database_pool_allows_several_writers(d2_db):
+    assert engine_pool_capacity() == d2_db.pool.size()
+
+
+def test_in_memory_database_gets_one_writer_and_every_row(d2_memory_db, table_rows):
+    assert isinstance(d2_memory_db.pool, SingletonThreadPool)
+    assert engine_pool_capacity() == 1
+
+    result = process_data_to_d2_with_missing_fields_handling(_dump(), batch_size=15, db_workers=4)
+
+    assert result['total_processed'] == 61
+    assert len(table_rows('origin_pool_akar')) == 20
+    assert len(table_rows('healthcheck_maurice')) == 20
+    assert [row['ref_origin_pool'] for row in table_rows('http_loadbalancer_akar')][0] == ['pool-uid-0']
@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect
+
+import d2_operations
+from d2_operations import process_data_to_d2_with_missing_fields_handling
+from d1_items import item, namespace_item
+
+
+def _pools(numbers, modified=1700000000):
+    return [item('origin_pool', f"pool-uid-{n}", name=f"pool-{n}", modified=modified) for n in numbers]
+
+
+def _failing_after(items, count):
+    """Yield the first count items, then fail as if the process died"""
+    for i, it in enumerate(items):
+        if i == count:
+            raise RuntimeError("preempted")
+        yield it
+
+
+def test_second_run_counts_new_changed_and_unchanged(d2_db):
+    first = [namespace_item('shared')] + _pools(range(6))
+    process_data_to_d2_with_missing_fields_handling(first, batch_size=3, incremental=True)
+
+    second = [namespace_item('shared')] + _pools(range(4)) + _pools([4, 5], modified=1700000500) + _pools([6, 7])
+    result = process_data_to_d2_with_missing_fields_handling(second, batch_size=3, incremental=True)
+
+    assert result['incremental'] == {'new': 2, 'changed': 2, 'unchanged': 5, 'deleted': 0}
+
+
+def test_deleted_counts_distinct_keys_when_keys_repeat_across_batches(d2_db):
+    first = [namespace_item('shared')] + _pools(range(10))
+    process_data_to_d2_with_missing_fields_handling(first, batch_size=4, incremental=True)
+
+    # 3 objects removed from the dump, and 4 keys exported again in a later batch
+    second = [namespace_item('shared')] + _pools(range(7)) + _pools(range(4))
+    result = process_data_to_d2_with_missing_fields_handling(second, batch_size=4, incremental=True)
+
+    assert result['incremental']['deleted'] == 3
+
+
+def test_deleted_count_survives_a_resume(d2_db, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    first = [namespace_item('shared')] + _pools(range(10))
+    process_data_to_d2_with_missing_fields_handling(first, batch_size=3, incremental=True)
+
+    second = [namespace_item('shared')] + _pools(range(8)) + _pools(range(3))
+    with pytest.raises(RuntimeError):
+        process_data_to_d2_with_missing_fields_handling(
+            _failing_after(second, 7), batch_size=3, incremental=True, checkpoint_path=checkpoint_path
+        )
+    result = process_data_to_d2_with_missing_fields_handling(
+        second, batch_size=3, incremental=True, checkpoint_path=checkpoint_path, resume=True
+    )
+
+    assert result['total_received'] == len(second)
+    assert result['incremental']['deleted'] == 2
+
+
+def test_load_state_table_of_an_older_version_gets_the_new_columns(d2_db):
+    legacy = Table(
+        d2_operations.load_state_table.name, MetaData(),
+        Column('raw_key', String(768), primary_key=True),
+        Column('uid', String(255)),
+        Column('modified_seconds', String(20)),
+        Column('content_hash', String(64)),
+        Column('loaded_at', DateTime(timezone=True)),
+    )
+    legacy.create(d2_db)
+
+    result = process_data_to_d2_with_missing_fields_handling(_pools(range(3)), incremental=True)
+
+    columns = {col['name'] for col in inspect(d2_db).get_columns(legacy.name)}
+    assert 'seen_run' in columns
+    assert result['incremental'] == {'new': 3, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+
+
+def test_deleted_objects_are_reported_by_one_run_only(d2_db):
+    process_data_to_d2_with_missing_fields_handling([namespace_item('shared')] + _pools(range(6)), incremental=True)
+
+    second = process_data_to_d2_with_missing_fields_handling([namespace_item('shared')] + _pools(range(4)),
+                                                             incremental=True)
+    third = process_data_to_d2_with_missing_fields_handling([namespace_item('shared')] + _pools(range(4)),
+                                                            incremental=True)
+    # pool-5 comes back after being reported deleted, pool-3 goes
+    fourth = process_data_to_d2_with_missing_fields_handling(
+        [namespace_item('shared')] + _pools([0, 1, 2, 5]), incremental=True
+    )
+
+    assert second['incremental']['deleted'] == 2
+    assert third['incremental'] == {'new': 0, 'changed': 0, 'unchanged': 5, 'deleted': 0}
+    assert fourth['incremental'] == {'new': 1, 'changed': 0, 'unchanged': 4, 'deleted': 1}
@@ -0,0 +1,91 @@
+import pytest
+
+import d2_operations
+from d2_operations import (
+    ReferenceResolutionCache, _select_uids_by_name, process_data_to_d2_with_missing_fields_handling, resolve_reference_uids
+)
+from d1_items import TENANT, item, namespace_item, ref
+
+
+@pytest.fixture
+def pools(d2_db):
+    """origin_pool_akar holding pool-0..pool-5 in namespace shared, pool-9 twice (tenant and tenant-less)"""
+    table = d2_operations.get_or_create_table('origin_pool', 'akar', [])
+    rows = [{'uid': f"pool-uid-{i}", 'name': f"pool-{i}", 'namespace': 'shared', 'tenant': TENANT} for i in range(6)]
+    rows += [
+        {'uid': 'pool-uid-9-acme', 'name': 'pool-9', 'namespace': 'shared', 'tenant': TENANT},
+        {'uid': 'pool-uid-9-any', 'name': 'pool-9', 'namespace': 'shared', 'tenant': None},
+        {'uid': 'pool-uid-8-any', 'name': 'pool-8', 'namespace': 'shared', 'tenant': ''},
+        {'uid': 'pool-uid-0-team', 'name': 'pool-0', 'namespace': 'team', 'tenant': TENANT},
+    ]
+    with d2_db.begin() as conn:
+        conn.execute(table.insert(), rows)
+    d2_operations.table_registry.invalidate()
+    return table
+
+
+@pytest.mark.parametrize('tuple_in', [True, False], ids=['tuple-in', 'or-chain'])
+def test_lookup_matches_name_namespace_and_tenant_in_chunks(pools, monkeypatch, tuple_in):
+    if not tuple_in:
+        monkeypatch.setattr(d2_operations, '_TUPLE_IN_DIALECTS', ())
+    refs = [ref('origin_pool', f"pool-{i}") for i in range(6)] + [ref('origin_pool', 'pool-0', namespace='team'),
+                                                                  ref('origin_pool', 'pool-7')]
+
+    with d2_operations.Session() as session:
+        uid_map = _select_uids_by_name(session, pools, refs + refs, chunk_size=3)
+
+    expected = {(f"pool-{i}", 'shared', TENANT): f"pool-uid-{i}" for i in range(6)}
+    expected[('pool-0', 'team', TENANT)] = 'pool-uid-0-team'
+    assert uid_map == expected
+
+
+def test_tenant_specific_row_wins_over_the_tenant_less_fallback(pools):
+    refs = [ref('origin_pool', 'pool-9'), ref('origin_pool', 'pool-9', tenant='other'), ref('origin_pool', 'pool-8'),
+            ref('origin_pool', 'pool-7')]
+
+    resolve_reference_uids('akar', refs)
+
+    assert [reference.get('uid') for reference in refs] == ['pool-uid-9-acme', 'pool-uid-9-any', 'pool-uid-8-any', None]
+
+
+def test_cached_references_are_not_looked_up_again(pools, monkeypatch):
+    cache = ReferenceResolutionCache()
+    resolve_reference_uids('akar', [ref('origin_pool', 'pool-1'), ref('origin_pool', 'pool-7')], cache)
+    queries = []
+    original = d2_operations._select_uids_by_name
+    monkeypatch.setattr(d2_operations, '_select_uids_by_name',
+                        lambda session, table, refs: queries.append(refs) or original(session, table, refs))
+
+    refs = [ref('origin_pool', 'pool-1'), ref('origin_pool', 'pool-7'), ref('origin_pool', 'pool-2')]
+    resolve_reference_uids('akar', refs, cache)
+
+    assert [reference.get('uid') for reference in refs] == ['pool-uid-1', None, 'pool-uid-2']
+    assert [[reference['name'] for reference in refs] for refs in queries] == [['pool-2']]
+
+
+@pytest.mark.parametrize('cache_misses', [True, False], ids=['misses-cached', 'misses-not-cached'])
+def test_target_missing_in_one_batch_resolves_once_it_arrives_in_a_later_one(d2_db, table_rows, monkeypatch,
+                                                                             cache_misses):
+    caches = []
+
+    class RecordedCache(ReferenceResolutionCache):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            caches.append(self)
+    monkeypatch.setattr(d2_operations, 'ReferenceResolutionCache', RecordedCache)
+    items = [
+        namespace_item('shared'),
+        item('http_loadbalancer', 'lb-1', refs=[ref('origin_pool', 'pool-a'), ref('origin_pool', 'pool-a', tenant=None)]),
+        item('origin_pool', 'pool-uid-a', name='pool-a'),
+        item('http_loadbalancer', 'lb-2', refs=[ref('origin_pool', 'pool-a'), ref('origin_pool', 'pool-a', tenant=None)]),
+    ]
+
+    process_data_to_d2_with_missing_fields_handling(items, batch_size=2, resolve_deferred=False,
+                                                    cache_reference_misses=cache_misses)
+
+    lb_1, lb_2 = table_rows('http_loadbalancer_akar')
+    assert lb_1['ref_origin_pool'] is None
+    assert lb_2['ref_origin_pool'] == ['pool-uid-a']
+    [cache] = caches
+    assert cache.cache_misses is cache_misses
+    assert cache.stats()['hits'] >= 1
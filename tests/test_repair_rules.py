@@ -0,0 +1,42 @@
+from collections import Counter
+
+import pytest
+
+from d2_operations import NAME_UID_RULES, NAMESPACE_RULES, RepairContext
+
+
+def _context(key, kind='route', name='name', uid='uid', system_metadata=None):
+    return RepairContext(key, {}, {}, system_metadata or {}, kind, 'akar', name, uid)
+
+
+@pytest.mark.parametrize('key, namespace, rule', [
+    ('/akar/db/namespace/team-a/route/x', 'team-a', 'namespace_from_key'),
+    ('/akar/db/by-namespace/team-b/route/x', 'team-b', 'namespace_from_key'),
+    # NAME ends where another 'namespace/' starts
+    ('/akar/db/namespace/teamnamespace/x', 'team', 'namespace_from_key'),
+    ('/akar/db/namespace/teamnamespace', 'teamnamespace', 'namespace_from_key'),
+    # An empty name after the first 'namespace/' leaves it to the segment rules
+    ('/akar/db/xnamespace//namespace/team-c/x', 'team-c', 'namespace_from_namespace_segment'),
+    ('/akar/db/route/x', 'tenant-acme', 'namespace_from_tenant'),
+])
+def test_namespace_rules_read_the_key_segments(key, namespace, rule):
+    events = Counter()
+    context = _context(key, system_metadata={'tenant': 'acme'})
+
+    assert NAMESPACE_RULES.apply(context, events) == (namespace, True)
+    assert events[rule] == 1
+    assert context.segments == key.split('/')
+
+
+def test_segment_position_ignores_the_last_segment():
+    context = _context('/akar/by-namespace/namespace')
+
+    assert context.segment_position('by-namespace') == 2
+    assert context.segment_position('namespace') is None
+
+
+def test_status_object_without_name_or_uid_takes_them_from_the_last_key_segment():
+    context = _context('/akar/db/ves.io.schema.x.StatusObject.default/primary/0123456789abcdef',
+                       kind='StatusObject', name=None, uid=None)
+
+    assert NAME_UID_RULES.apply(context, Counter()) == (('derived-01234567', '0123456789abcdef'), True)
@@ -0,0 +1,81 @@
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table
+
+import d2_operations
+from d2_operations import SkippedDataSink, _write_isolating_failures, bulk_upsert_rows
+
+
+@pytest.fixture
+def skipped_table(d2_db):
+    d2_operations.init_d2_db()
+    return d2_db
+
+
+def _poisoned(monkeypatch, bad_uids):
+    """Make every upsert of a chunk holding one of bad_uids fail, and record the chunk sizes tried"""
+    original = d2_operations._execute_upsert
+    attempts = []
+
+    def upsert(session, table, rows, **kwargs):
+        attempts.append(len(rows))
+        if any(row['uid'] in bad_uids for row in rows):
+            raise ValueError("poisoned row")
+        return original(session, table, rows, **kwargs)
+    monkeypatch.setattr(d2_operations, '_execute_upsert', upsert)
+    return attempts
+
+
+def test_sink_flushes_when_the_buffer_is_full(skipped_table, table_rows):
+    sink = SkippedDataSink(max_rows=3, max_seconds=3600)
+    for i in range(7):
+        sink.add(f"/akar/db/bad/{i}", kind='route', service='akar', uid=f"uid-{i}", error_type='invalid_value')
+
+    assert sink.flushed_count == 6
+    assert len(sink) == 1
+    assert sink.flush() == 1
+    assert [row['uid'] for row in table_rows('d2_skipped_data')] == [f"uid-{i}" for i in range(7)]
+
+
+def test_sink_flushes_when_its_block_raises(skipped_table, table_rows):
+    with pytest.raises(RuntimeError):
+        with SkippedDataSink(max_rows=100, max_seconds=3600) as sink:
+            sink.add("/akar/db/bad/0", error_type='invalid_value', error_message="x" * 2000)
+            raise RuntimeError("failed mid-batch")
+
+    [row] = table_rows('d2_skipped_data')
+    assert (row['service'], row['object_type']) == ('unknown', 'unknown')
+    assert len(row['error_message']) == 1000
+
+
+def test_flush_bisects_a_failing_chunk_down_to_the_bad_rows(skipped_table, table_rows, monkeypatch):
+    attempts = _poisoned(monkeypatch, {'uid-5'})
+    sink = SkippedDataSink(max_rows=8, max_seconds=3600)
+    for i in range(7):
+        sink.add(f"/akar/db/bad/{i}", kind='route', service='akar', uid=f"uid-{i}")
+
+    assert sink.flush() == 6
+    assert sink.failed_count == 1
+    assert attempts == [7, 3, 4, 2, 2, 1, 1]
+    assert [row['uid'] for row in table_rows('d2_skipped_data')] == ['uid-0', 'uid-1', 'uid-2', 'uid-3', 'uid-4', 'uid-6']
+
+
+def test_rows_rejected_by_the_database_are_reported_and_the_rest_written(d2_db, table_rows):
+    table = Table('strict', MetaData(), Column('uid', String(255), primary_key=True),
+                  Column('name', String(255), nullable=False), Column('size_bytes', Integer))
+    table.create(d2_db)
+    rows = [{'uid': f"uid-{i}", 'name': None if i in (2, 9) else f"name-{i}", 'size_bytes': i} for i in range(12)]
+    rejected = []
+
+    written = bulk_upsert_rows(table, rows, chunk_size=5, on_row_error=lambda row, error: rejected.append(row['uid']))
+
+    assert written == 10
+    assert rejected == ['uid-2', 'uid-9']
+    assert [row['uid'] for row in table_rows('strict')] == sorted(f"uid-{i}" for i in range(12) if i not in (2, 9))
+
+
+def test_chunks_are_written_in_input_order(d2_db):
+    seen = []
+    written = _write_isolating_failures(lambda session, chunk: seen.extend(chunk), list(range(10)), 3)
+
+    assert written == 10
+    assert seen == list(range(10))